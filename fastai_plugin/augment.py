@@ -0,0 +1,375 @@
+"""Augmentation of whole batches of uint8 chips.
+
+fastai's transforms augment each chip on its own, through PIL and fastai
+Image objects holding float tensors, and resize chips even when they already
+have the right size. Here, chips are loaded as uint8 tensors (see
+ByteImageList) and augmented a batch at a time after collation (see
+AugmentCollate), still in the dataloader workers:
+- dihedral transforms (or horizontal flips) as flips and transposes
+- rotations and zooms as one affine resampling of the chips that need one
+- brightness and contrast as a lookup table of the 256 pixel values per chip
+Segmentation masks and detection boxes are transformed along with the chips.
+Batches stay uint8 until they are on the device, where to_float_batch turns
+them into model inputs.
+"""
+import inspect
+import warnings
+
+import numpy as np
+import PIL
+import torch
+import torch.nn.functional as F
+from fastai.basic_data import data_collate
+from fastai.torch_core import Tensor
+from fastai.vision import (Image, ImageSegment, ImageList, ObjectItemList,
+                           SegmentationItemList, SegmentationLabelList,
+                           pil2tensor)
+
+from fastai_plugin.inference import dihedral
+from fastai_plugin.utils import set_collate_fn
+
+# Sample at pixel centers, which matches how fastai scales boxes to [-1, 1].
+# torch < 1.3 has no align_corners argument, and always aligns corners.
+_ALIGN = ({
+    'align_corners': False
+} if 'align_corners' in inspect.signature(F.grid_sample).parameters else {})
+
+
+def open_byte_image(fn, convert_mode='RGB', cls=Image, after_open=None):
+    """Return an Image (or cls) of the image in file fn, as a uint8 tensor."""
+    with warnings.catch_warnings():
+        # EXIF warning from TiffPlugin
+        warnings.simplefilter('ignore', UserWarning)
+        x = PIL.Image.open(fn).convert(convert_mode)
+    if after_open:
+        x = after_open(x)
+    return cls(pil2tensor(x, np.uint8))
+
+
+class ByteImageSegment(ImageSegment):
+    """ImageSegment whose data stays uint8, instead of being int64."""
+
+    @property
+    def data(self):
+        return self.px
+
+
+class ByteImageList(ImageList):
+    """ImageList of uint8 images, to be augmented with AugmentCollate."""
+
+    def open(self, fn):
+        return open_byte_image(
+            fn, convert_mode=self.convert_mode, after_open=self.after_open)
+
+
+class ByteSegmentationLabelList(SegmentationLabelList):
+    def open(self, fn):
+        return open_byte_image(
+            fn, convert_mode='L', cls=ByteImageSegment,
+            after_open=self.after_open)
+
+
+class ByteSegmentationItemList(ByteImageList, SegmentationItemList):
+    _label_cls = ByteSegmentationLabelList
+
+
+class ByteObjectItemList(ByteImageList, ObjectItemList):
+    pass
+
+
+def _resize(px, size, mode):
+    kwargs = _ALIGN if mode == 'bilinear' else {}
+    resized = F.interpolate(
+        px[None].float(), size=size, mode=mode, **kwargs)[0]
+    return resized.round_().clamp_(0, 255).to(px.dtype)
+
+
+def resize_sample(sample, size):
+    """Resize the chip (and mask) of a sample to size, unless it has that size.
+
+    Boxes are relative to the size of the chip, so they don't change.
+    """
+    x, y = sample
+    if tuple(x.size) == size:
+        return sample
+    x = x.__class__(_resize(x.px, size, 'bilinear'))
+    if isinstance(y, ImageSegment):
+        y = y.__class__(_resize(y.px, size, 'nearest'))
+    return x, y
+
+
+def _uniform(n, low, high):
+    return torch.rand(n) * (high - low) + low
+
+
+def _apply(n, p):
+    return torch.rand(n) < p
+
+
+def _dihedral_mat(k):
+    """Return the matrix moving (x, y) points like dihedral(x, k) moves pixels."""
+    m = torch.eye(3)
+    if k & 1:
+        m[1] *= -1
+    if k & 2:
+        m[0] *= -1
+    if k & 4:
+        m = m[[1, 0, 2]]
+    return m
+
+
+def _box_corners(boxes):
+    """Return the (x, y) corners of (y1, x1, y2, x2) boxes."""
+    y1, x1, y2, x2 = boxes.unbind(-1)
+    xs = torch.stack([x1, x2, x1, x2], -1)
+    ys = torch.stack([y1, y1, y2, y2], -1)
+    return torch.stack([xs, ys], -1)
+
+
+def _corner_boxes(corners):
+    """Return the (y1, x1, y2, x2) boxes bounding (x, y) corners."""
+    mins, maxes = corners.min(-2)[0], corners.max(-2)[0]
+    return torch.stack(
+        [mins[..., 1], mins[..., 0], maxes[..., 1], maxes[..., 0]], -1)
+
+
+def pack_boxes(boxes, labels, pad_idx=0):
+    """Clip boxes to the chip and drop those left empty.
+
+    Like in bb_pad_collate, the padding is moved before the boxes of each
+    chip, as RetinaNet expects.
+    """
+    boxes = boxes.clamp(-1, 1)
+    keep = ((labels != pad_idx) & (boxes[..., 2] > boxes[..., 0]) &
+            (boxes[..., 3] > boxes[..., 1])).long()
+    nb_boxes = labels.shape[1]
+    # Sort keeping the order of boxes, with the padding first.
+    order = (keep * nb_boxes + torch.arange(nb_boxes)).sort(1)[1]
+    keep = keep.gather(1, order)
+    boxes = boxes.gather(1, order[..., None].expand_as(boxes)).clone()
+    labels = labels.gather(1, order).clone()
+    boxes[keep == 0] = 0
+    labels[keep == 0] = pad_idx
+    return boxes, labels
+
+
+class BatchAugment():
+    """Random augmentation of batches of uint8 chips.
+
+    The options and their defaults are those of fastai's get_transforms, which
+    this replaces, except that there is no perspective warp. Random numbers
+    come from torch, which seeds each dataloader worker differently.
+    """
+
+    def __init__(self,
+                 flip_vert=False,
+                 max_rotate=10.,
+                 max_zoom=1.1,
+                 max_lighting=0.2,
+                 p_affine=0.75,
+                 p_lighting=0.75,
+                 pad_idx=0):
+        """Constructor.
+
+        Args:
+            flip_vert: (bool) use all 8 dihedral transforms instead of only
+                horizontal flips
+            max_rotate: (float) maximum rotation in degrees
+            max_zoom: (float) maximum zoom, 1 to not zoom
+            max_lighting: (float) maximum change of brightness and contrast
+            p_affine: (float) probability of rotating and of zooming each chip
+            p_lighting: (float) probability of changing the brightness and
+                the contrast of each chip
+            pad_idx: (int) class id padding the boxes of each chip
+        """
+        self.flip_vert = flip_vert
+        self.max_rotate = max_rotate
+        self.max_zoom = max_zoom
+        self.max_lighting = max_lighting
+        self.p_affine = p_affine
+        self.p_lighting = p_lighting
+        self.pad_idx = pad_idx
+
+    def sample_dihedral(self, n, square=True):
+        """Return the dihedral transform of each of n chips."""
+        if not self.flip_vert:
+            # k = 2 flips columns, ie. horizontally.
+            return torch.randint(2, (n, )) * 2
+        # Transposing only keeps the shape of square chips.
+        return torch.randint(8 if square else 4, (n, ))
+
+    def sample_affine(self, n):
+        """Return the affine matrices sampling n chips, and which to sample.
+
+        Like for F.affine_grid, the matrices map (x, y) points of the output
+        to the input. Chips not to transform get the identity.
+        """
+        mats = torch.eye(3).repeat(n, 1, 1)
+        if self.max_rotate:
+            rotate = _apply(n, self.p_affine)
+            angle = _uniform(n, -self.max_rotate, self.max_rotate) * \
+                rotate.float() * np.pi / 180
+            cos, sin = angle.cos(), angle.sin()
+            mats[:, 0, 0], mats[:, 0, 1] = cos, -sin
+            mats[:, 1, 0], mats[:, 1, 1] = sin, cos
+        else:
+            rotate = _apply(n, 0.)
+        if self.max_zoom > 1:
+            zoom = _apply(n, self.p_affine)
+            scale = torch.where(zoom, _uniform(n, 1., self.max_zoom),
+                                torch.ones(n))
+            # Zoom on a random point, keeping the chip inside the image.
+            shift = (1 - 1 / scale)[:, None] * _uniform((n, 2), -1., 1.)
+            zoom_mats = torch.eye(3).repeat(n, 1, 1)
+            zoom_mats[:, 0, 0] = zoom_mats[:, 1, 1] = 1 / scale
+            zoom_mats[:, :2, 2] = shift
+            mats = mats @ zoom_mats
+        else:
+            zoom = _apply(n, 0.)
+        return mats, rotate | zoom
+
+    def lighting(self, x):
+        """Change the brightness and contrast of uint8 chips x in place."""
+        n = len(x)
+        m = self.max_lighting
+        brighten = _apply(n, self.p_lighting)
+        contrast = _apply(n, self.p_lighting)
+        inds = (brighten | contrast).nonzero().view(-1)
+        if not m or len(inds) == 0:
+            return x
+        # Like fastai, change the logits of pixel values.
+        change = torch.where(brighten, _uniform(n, 0.5 * (1 - m),
+                                                0.5 * (1 + m)),
+                             torch.full((n, ), 0.5))[inds]
+        scale = torch.where(contrast,
+                            _uniform(n, np.log(1 - m), -np.log(1 - m)).exp(),
+                            torch.ones(n))[inds]
+        values = (torch.arange(256).float() / 255).clamp(1e-7, 1 - 1e-7)
+        logits = (values / (1 - values)).log()
+        lut = torch.sigmoid(
+            (logits[None] + (change / (1 - change)).log()[:, None]) *
+            scale[:, None])
+        lut = lut.mul_(255).round_().byte()
+        chips = x[inds]
+        x[inds] = lut.gather(1, chips.view(len(inds), -1).long()).view_as(chips)
+        return x
+
+    def __call__(self, x, mask=None, boxes=None, labels=None):
+        """Augment a batch.
+
+        Args:
+            x: (Tensor) uint8 chips of shape (batch_sz, nb_channels, height,
+                width)
+            mask: (Tensor or None) segmentation masks of shape (batch_sz, 1,
+                height, width)
+            boxes: (Tensor or None) boxes padded by bb_pad_collate, of shape
+                (batch_sz, nb_boxes, 4), as (y1, x1, y2, x2) in [-1, 1]
+            labels: (Tensor or None) class ids of the boxes, of shape
+                (batch_sz, nb_boxes)
+
+        Returns:
+            (x, mask, boxes, labels) augmented
+        """
+        n, _, h, w = x.shape
+        box_mats = torch.eye(3).repeat(n, 1, 1)
+
+        ks = self.sample_dihedral(n, square=h == w)
+        for k in ks.unique().tolist():
+            if k == 0:
+                continue
+            inds = (ks == k).nonzero().view(-1)
+            x[inds] = dihedral(x[inds], k)
+            if mask is not None:
+                mask[inds] = dihedral(mask[inds], k)
+            box_mats[inds] = _dihedral_mat(k)
+
+        mats, warp = self.sample_affine(n)
+        inds = warp.nonzero().view(-1)
+        if len(inds):
+            theta = mats[inds, :2]
+            grid = F.affine_grid(
+                theta, torch.Size((len(inds), 1, h, w)), **_ALIGN)
+            chips = F.grid_sample(
+                x[inds].float(), grid, padding_mode='reflection', **_ALIGN)
+            x[inds] = chips.round_().clamp_(0, 255).byte()
+            if mask is not None:
+                masks = F.grid_sample(
+                    mask[inds].float(), grid, mode='nearest',
+                    padding_mode='reflection', **_ALIGN)
+                mask[inds] = masks.round_().to(mask.dtype)
+            # Boxes move from the input to the output.
+            box_mats[inds] = torch.inverse(mats[inds]) @ box_mats[inds]
+
+        x = self.lighting(x)
+
+        if boxes is not None:
+            corners = _box_corners(boxes)
+            corners = corners @ box_mats[:, None, :2, :2].transpose(-1, -2) + \
+                box_mats[:, None, None, :2, 2]
+            boxes, labels = pack_boxes(
+                _corner_boxes(corners), labels, self.pad_idx)
+        return x, mask, boxes, labels
+
+
+class AugmentCollate():
+    """Collate samples of uint8 chips into a batch, resized and augmented.
+
+    Args:
+        collate_fn: function turning a list of samples into a batch, like
+            data_collate or bb_pad_collate
+        size: (int) size of the chips in batches. Only chips of another size
+            are resized.
+        augment: (BatchAugment or None) augmentation of the batches, None to
+            only collate them (eg. for validation)
+    """
+
+    def __init__(self, collate_fn=data_collate, size=None, augment=None):
+        self.collate_fn = collate_fn
+        self.size = None if size is None else (size, size)
+        self.augment = augment
+
+    def __call__(self, samples):
+        if self.size is not None:
+            samples = [resize_sample(s, self.size) for s in samples]
+        xb, yb = self.collate_fn(samples)
+        if self.augment is None:
+            return xb, yb
+        if isinstance(yb, (tuple, list)):
+            xb, _, boxes, labels = self.augment(
+                xb, boxes=yb[0], labels=yb[1])
+            return xb, (boxes, labels)
+        if yb.dim() == 4:
+            xb, yb, _, _ = self.augment(xb, mask=yb)
+            return xb, yb
+        return self.augment(xb)[0], yb
+
+
+def to_float_batch(b):
+    """Turn a batch of uint8 chips (and masks), on the device, into floats.
+
+    Chips are scaled to [0, 1] like fastai's open_image does, and masks are
+    converted to int64 like ImageSegment does.
+    """
+    x, y = b
+    x = x.float().div_(255.)
+    if isinstance(y, Tensor) and y.dtype == torch.uint8:
+        y = y.long()
+    return x, y
+
+
+def augment_batches(data, size, augment, collate_fn=data_collate):
+    """Set up a DataBunch of ByteImageList to collate and augment by batch.
+
+    Training batches are augmented with augment, and batches of every split
+    are resized to size if needed and converted to floats on the device.
+
+    Args:
+        data: (DataBunch) data made without transforms
+        size: (int) size of the chips
+        augment: (BatchAugment) augmentation of training batches
+        collate_fn: function turning a list of samples into a batch
+    """
+    for dl in data.dls:
+        set_collate_fn(dl, AugmentCollate(collate_fn, size))
+    set_collate_fn(data.train_dl, AugmentCollate(collate_fn, size, augment))
+    data.add_tfm(to_float_batch)
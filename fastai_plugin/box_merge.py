@@ -0,0 +1,133 @@
+from collections import defaultdict
+
+import numpy as np
+
+
+def box_iou(box, boxes):
+    """Compute the IoU of a box with each of a set of boxes.
+
+    Args:
+        box: (np.ndarray) of shape (4,) in (ymin, xmin, ymax, xmax) format
+        boxes: (np.ndarray) of shape (n, 4) in the same format
+
+    Returns:
+        (np.ndarray) of shape (n,) with IoU values
+    """
+    ymin = np.maximum(box[0], boxes[:, 0])
+    xmin = np.maximum(box[1], boxes[:, 1])
+    ymax = np.minimum(box[2], boxes[:, 2])
+    xmax = np.minimum(box[3], boxes[:, 3])
+    inter = np.maximum(ymax - ymin, 0) * np.maximum(xmax - xmin, 0)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / (area + areas - inter + 1e-8)
+
+
+class BoxGrid():
+    """A uniform grid spatial index over a set of boxes.
+
+    Each box is put in the cell containing its top left corner. The cell size
+    is at least the extent of every box in the grid, so any two boxes that
+    intersect are in the same or in adjacent cells. A few very large boxes
+    would make cells so large that most boxes end up neighbors, so boxes more
+    than large_factor times the median extent are kept out of the grid, in
+    large, and are neighbors of every cell.
+    """
+
+    def __init__(self, boxes, large_factor=4.):
+        extents = np.maximum(boxes[:, 2:] - boxes[:, :2], 0).max(axis=1)
+        is_large = np.zeros(len(boxes), dtype=bool)
+        if len(boxes):
+            is_large = extents > large_factor * max(np.median(extents), 1.)
+        self.is_large = is_large
+        self.large = np.nonzero(is_large)[0]
+        small = np.nonzero(~is_large)[0]
+        self.cell_sz = max(float(extents[small].max()), 1.) \
+            if len(small) else 1.
+        self.box_cells = [
+            tuple(c)
+            for c in np.floor(boxes[:, :2] / self.cell_sz).astype(np.int64)
+        ]
+        cells = defaultdict(list)
+        for box_ind in small:
+            cells[self.box_cells[box_ind]].append(box_ind)
+        self.cells = {c: np.array(inds) for c, inds in cells.items()}
+
+    def neighbor_cells(self, cell):
+        """Return the cells of the 3x3 neighborhood of cell that hold boxes."""
+        y, x = cell
+        return [(y + dy, x + dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                if (y + dy, x + dx) in self.cells]
+
+    def neighbors(self, cell):
+        """Return indices of boxes in the 3x3 neighborhood of cell."""
+        return np.concatenate(
+            [self.cells[c] for c in self.neighbor_cells(cell)] + [self.large])
+
+
+def merge_window_boxes(boxes, scores, class_ids, window_ids, iou_thresh=0.5):
+    """Remove duplicate detections of objects seen by overlapping windows.
+
+    Predictions are made per window and already had NMS applied within each
+    window, so duplicates can only occur where boxes from different windows
+    meet, ie. in the strips where windows overlap. Boxes are indexed with a
+    BoxGrid, and greedy NMS (by decreasing score) is only run on boxes that have
+    a box from another window in their neighborhood, and only against boxes of
+    the same class from other windows. This keeps the cost roughly linear in the
+    number of boxes instead of quadratic.
+
+    Args:
+        boxes: (np.ndarray) of shape (n, 4) in global (ymin, xmin, ymax, xmax)
+            pixel coordinates
+        scores: (np.ndarray) of shape (n,)
+        class_ids: (np.ndarray) of shape (n,)
+        window_ids: (np.ndarray) of shape (n,) with the index of the window each
+            box was predicted in
+        iou_thresh: (float) boxes with an IoU above this with a higher scoring
+            box of the same class from another window are removed
+
+    Returns:
+        (np.ndarray) boolean mask of shape (n,) of the boxes to keep
+    """
+    keep = np.ones(len(boxes), dtype=bool)
+    if len(boxes) == 0:
+        return keep
+
+    grid = BoxGrid(boxes)
+    candidates = [grid.large]
+    for cell, box_inds in grid.cells.items():
+        nbr_windows = window_ids[grid.neighbors(cell)]
+        if np.any(nbr_windows != nbr_windows[0]):
+            candidates.append(box_inds)
+    candidates = np.concatenate(candidates).astype(np.int64)
+    if len(candidates) == 0:
+        return keep
+
+    candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+    kept = defaultdict(list)
+    kept_large = []
+    for box_ind in candidates:
+        cell = grid.box_cells[box_ind]
+        if grid.is_large[box_ind]:
+            # Large boxes can overlap boxes in any cell.
+            nbrs = [j for inds in kept.values() for j in inds]
+        else:
+            y, x = cell
+            nbrs = [
+                j for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                for j in kept.get((y + dy, x + dx), [])
+            ]
+        nbrs += kept_large
+        if nbrs:
+            nbrs = np.array(nbrs)
+            nbrs = nbrs[(window_ids[nbrs] != window_ids[box_ind])
+                        & (class_ids[nbrs] == class_ids[box_ind])]
+            if len(nbrs) and np.any(
+                    box_iou(boxes[box_ind], boxes[nbrs]) > iou_thresh):
+                keep[box_ind] = False
+                continue
+        if grid.is_large[box_ind]:
+            kept_large.append(box_ind)
+        else:
+            kept[cell].append(box_ind)
+    return keep
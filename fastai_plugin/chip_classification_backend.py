@@ -13,10 +13,8 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from fastai.vision import (ImageList, get_transforms, models, cnn_learner,
-                           Image, ImageSegment)
+from fastai.vision import models, cnn_learner, Image, ImageSegment
 from fastai.callbacks import CSVLogger, TrackEpochCallback
-from fastai.basic_train import load_learner
 from fastai.basic_data import DatasetType
 from fastai.vision.transform import dihedral
 from torch.utils.data.sampler import WeightedRandomSampler
@@ -31,7 +29,25 @@ from rastervision.data.label_source.utils import color_to_triple
 
 from fastai_plugin.utils import (SyncCallback, MySaveModelCallback,
                                  ExportCallback, MyCSVLogger, Precision,
-                                 Recall, FBeta, zipdir)
+                                 Recall, FBeta, StepCheckpointCallback,
+                                 TrainBudgetCallback, ValidationCallback,
+                                 DistributedCallback, budget_epochs,
+                                 shard_batches, stratified_subset, zipdir,
+                                 class_map_meta, load_inference_model,
+                                 to_precision)
+from fastai_plugin.inference import (ChipPreprocessor, InferenceRunner,
+                                     model_dtype, is_channels_last)
+from fastai_plugin.pipeline import PredictPipeline, window_batches
+from fastai_plugin.predict import sum_labels
+from fastai_plugin.file_cache import get_file_cache, cached_download
+from fastai_plugin.lr_cache import lr_find_key, cached_lr_find
+from fastai_plugin.model_server import ModelClient
+from fastai_plugin.quantize import quantize_export, argmax_accuracy
+from fastai_plugin.augment import ByteImageList, BatchAugment, augment_batches
+from fastai_plugin.precision import get_precision
+from fastai_plugin.distributed import (launch, is_distributed,
+                                       is_main_process, is_local_main_process,
+                                       barrier, broadcast_value)
 
 log = logging.getLogger(__name__)
 
@@ -167,7 +183,9 @@ class ChipClassificationBackend(Backend):
         self.task_config = task_config
         self.backend_opts = backend_opts
         self.train_opts = train_opts
-        self.inf_learner = None
+        self.model = None
+        self.client = None
+        self.cache = get_file_cache(backend_opts)
 
     def print_options(self):
         # TODO get logging to work for plugins
@@ -249,14 +267,23 @@ class ChipClassificationBackend(Backend):
         dataset_files.upload()
 
     def train(self, tmp_dir):
-        """Train a model."""
+        """Train a model.
+
+        With the train_workers option, this runs in that many processes
+        training in parallel (see fastai_plugin.distributed).
+        """
+        if self.backend_opts.train_workers and not is_distributed():
+            return launch(self.train, self.backend_opts.train_workers, tmp_dir,
+                          backend=self.backend_opts.dist_backend or 'gloo')
         self.print_options()
 
         # Sync output of previous training run from cloud.
         train_uri = self.backend_opts.train_uri
         train_dir = get_local_path(train_uri, tmp_dir)
-        make_dir(train_dir)
-        sync_from_dir(train_uri, train_dir)
+        # In distributed training, one process per machine gets the data.
+        if is_local_main_process():
+            make_dir(train_dir)
+            sync_from_dir(train_uri, train_dir)
         '''
             Get zip file for each group, and unzip them into chip_dir in a
             way that works well with FastAI.
@@ -294,18 +321,20 @@ class ChipClassificationBackend(Backend):
 
         '''
         chip_dir = join(tmp_dir, 'chips/')
-        make_dir(chip_dir)
-        for zip_uri in list_paths(self.backend_opts.chip_uri, 'zip'):
-            zip_name = Path(zip_uri).name
-            if zip_name.startswith('train'):
-                extract_dir = chip_dir + 'train/'
-            elif zip_name.startswith('val'):
-                extract_dir = chip_dir + 'val/'
-            else:
-                continue
-            zip_path = download_if_needed(zip_uri, tmp_dir)
-            with zipfile.ZipFile(zip_path, 'r') as zipf:
-                zipf.extractall(extract_dir)
+        if is_local_main_process():
+            make_dir(chip_dir)
+            for zip_uri in list_paths(self.backend_opts.chip_uri, 'zip'):
+                zip_name = Path(zip_uri).name
+                if zip_name.startswith('train'):
+                    extract_dir = chip_dir + 'train/'
+                elif zip_name.startswith('val'):
+                    extract_dir = chip_dir + 'val/'
+                else:
+                    continue
+                zip_path = cached_download(zip_uri, tmp_dir, self.cache)
+                with zipfile.ZipFile(zip_path, 'r') as zipf:
+                    zipf.extractall(extract_dir)
+        barrier()
 
         # Setup data loader.
         def get_label_path(im_path):
@@ -315,20 +344,20 @@ class ChipClassificationBackend(Backend):
         class_map = self.task_config.class_map
         classes = class_map.get_class_names()
         num_workers = 0 if self.train_opts.debug else 4
-        tfms = get_transforms(flip_vert=self.train_opts.flip_vert)
+        augment = BatchAugment(flip_vert=self.train_opts.flip_vert)
 
         def get_data(train_sampler=None):
-            data = (ImageList.from_folder(chip_dir).split_by_folder(
-                train='train', valid='val').label_from_folder().transform(
-                    tfms, size=size).databunch(
-                        bs=self.train_opts.batch_sz,
-                        num_workers=num_workers,
-                    ))
+            data = (ByteImageList.from_folder(chip_dir).split_by_folder(
+                train='train', valid='val').label_from_folder().databunch(
+                    bs=self.train_opts.batch_sz,
+                    num_workers=num_workers,
+                ))
+            augment_batches(data, size, augment)
             return data
 
         data = get_data()
 
-        if self.train_opts.debug:
+        if self.train_opts.debug and is_main_process():
             make_debug_chips(data, class_map, tmp_dir, train_uri)
 
         # Setup learner.
@@ -349,19 +378,24 @@ class ChipClassificationBackend(Backend):
 
         learn.unfreeze()
 
-        if self.train_opts.fp16 and torch.cuda.is_available():
-            # This loss_scale works for Resnet 34 and 50. You might need to adjust this
-            # for other models.
-            learn = learn.to_fp16(loss_scale=256)
+        # This loss_scale works for Resnet 34 and 50 in fp16. You might need to
+        # adjust this for other models.
+        learn = to_precision(
+            learn, get_precision(self.train_opts), loss_scale=256)
 
         # Setup callbacks and train model.
         model_path = get_local_path(self.backend_opts.model_uri, tmp_dir)
+        artifact_meta = {
+            'classes': list(data.classes),
+            'class_map': class_map_meta(self.task_config.class_map)
+        }
 
+        # Other processes get the weights of the main one when training begins.
         pretrained_uri = self.backend_opts.pretrained_uri
-        if pretrained_uri:
+        if pretrained_uri and is_main_process():
             print('Loading weights from pretrained_uri: {}'.format(
                 pretrained_uri))
-            pretrained_path = download_if_needed(pretrained_uri, tmp_dir)
+            pretrained_path = cached_download(pretrained_uri, tmp_dir, self.cache)
             learn.model.load_state_dict(
                 torch.load(pretrained_path, map_location=learn.data.device),
                 strict=False)
@@ -370,25 +404,72 @@ class ChipClassificationBackend(Backend):
         # TrackEpochCallback will work.
         callbacks = [
             TrackEpochCallback(learn),
-            MySaveModelCallback(learn, every='epoch'),
-            MyCSVLogger(learn, filename='log'),
-            ExportCallback(learn, model_path, monitor='f_beta'),
-            SyncCallback(train_dir, self.backend_opts.train_uri,
-                         self.train_opts.sync_interval)
+            MySaveModelCallback(learn, every='epoch')
         ]
+        if is_main_process():
+            callbacks += [
+                MyCSVLogger(learn, filename='log'),
+                ExportCallback(
+                    learn, model_path, monitor='f_beta',
+                    artifact_meta=artifact_meta,
+                    artifact_fp16=bool(self.backend_opts.artifact_fp16),
+                    graph_formats=self.backend_opts.export_graph_formats,
+                    simplify=self.backend_opts.export_simplify is not False),
+                SyncCallback(train_dir, self.backend_opts.train_uri,
+                             self.train_opts.sync_interval)
+            ]
+        if is_distributed():
+            callbacks.append(DistributedCallback(learn))
+        if self.train_opts.checkpoint_steps:
+            callbacks.append(StepCheckpointCallback(
+                learn, self.train_opts.checkpoint_steps,
+                sync_uri=self.backend_opts.train_uri))
 
-        lr = self.train_opts.lr
         num_epochs = self.train_opts.num_epochs
+        max_hours = self.train_opts.max_hours
+        max_steps = self.train_opts.max_steps
+        if max_hours or max_steps:
+            # The budget decides when to stop instead of num_epochs.
+            num_epochs = budget_epochs(shard_batches(data.train_dl), max_steps)
+            callbacks.append(TrainBudgetCallback(
+                learn, max_time=max_hours * 3600 if max_hours else None,
+                max_steps=max_steps))
+        validate_every = self.train_opts.validate_every or 1
+        valid_count = self.train_opts.valid_count
+        if validate_every > 1 or valid_count:
+            subset = None
+            if valid_count:
+                # Stratify by the rarest class in each chip.
+                label_sets = [[int(y)] for y in data.valid_ds.y.items]
+                subset = stratified_subset(label_sets, valid_count)
+            callbacks.append(
+                ValidationCallback(learn, validate_every, subset))
+
+        lr = self.train_opts.lr
         if self.train_opts.one_cycle:
             if lr is None:
-                learn.lr_find()
-                learn.recorder.plot(suggestion=True, return_fig=True)
-                lr = learn.recorder.min_grad_lr
-                print('lr_find() found lr: {}'.format(lr))
+                if is_main_process():
+                    key = lr_find_key(
+                        self.backend_opts.chip_uri, type(self).__name__,
+                        self.train_opts.model_arch, self.train_opts.batch_sz,
+                        self.train_opts.weight_decay)
+                    lr = cached_lr_find(learn, key, train_dir,
+                                        self.backend_opts.lr_cache_uri)
+                lr = broadcast_value(lr)
             learn.fit_one_cycle(num_epochs, lr, callbacks=callbacks)
         else:
             learn.fit(num_epochs, lr, callbacks=callbacks)
 
+        if not is_main_process():
+            return
+
+        if self.backend_opts.quantize:
+            quantize_export(
+                model_path, data.valid_dl, learn.loss_func,
+                mode=self.backend_opts.quantize,
+                nb_calib_batches=self.backend_opts.quantize_calib_batches,
+                metric=argmax_accuracy)
+
         # Since model is exported every epoch, we need some other way to
         # show that training is finished.
         str_to_file('done!', self.backend_opts.train_done_uri)
@@ -398,14 +479,38 @@ class ChipClassificationBackend(Backend):
 
     def load_model(self, tmp_dir):
         """Load the model in preparation for one or more prediction calls."""
-        if self.inf_learner is None:
+        if self.model is None and self.client is None:
             self.print_options()
-            model_uri = self.backend_opts.model_uri
-            model_path = download_if_needed(model_uri, tmp_dir)
-            self.inf_learner = load_learner(
-                dirname(model_path), basename(model_path))
-            self.device = torch.device("cuda:0" if torch.cuda.
-                                       is_available() else "cpu")
+            self.pipeline = PredictPipeline(
+                self._preprocess, self._infer, self._make_labels,
+                prefetch=self.backend_opts.predict_prefetch,
+                label_queue_size=self.backend_opts.predict_label_queue_size)
+            if self.backend_opts.model_server:
+                # The model runs in the server, see fastai_plugin.model_server.
+                self.client = ModelClient(
+                    self.backend_opts.model_server,
+                    authkey=self.backend_opts.model_server_authkey)
+                self.model_info = self.client.info()
+                return
+
+            # Quantized models only run on the CPU.
+            use_cuda = (torch.cuda.is_available()
+                        and not self.backend_opts.predict_quantized)
+            self.device = torch.device("cuda:0" if use_cuda else "cpu")
+            self.model = load_inference_model(
+                self.backend_opts.model_uri, tmp_dir, self.device,
+                engine=self.backend_opts.predict_engine,
+                quantized=bool(self.backend_opts.predict_quantized),
+                cache=self.cache, precision=get_precision(self.train_opts))
+            self.preprocessor = ChipPreprocessor(
+                self.device, model_dtype(self.model),
+                n_buffers=self.pipeline.n_buffers,
+                channels_last=is_channels_last(self.model))
+            mem_budget = self.backend_opts.predict_mem_mb
+            self.runner = InferenceRunner(
+                self.model,
+                mem_budget=mem_budget * 2**20 if mem_budget else None)
+            self.model_info = {}
 
     def predict(self, chips, windows, tmp_dir):
         """Return predictions for a chip using model.
@@ -418,14 +523,76 @@ class ChipClassificationBackend(Backend):
             Labels object containing predictions
         """
         self.load_model(tmp_dir)
+        return self._make_labels(
+            self._infer(self._preprocess(chips)), windows)
+
+    def predict_batches(self, batches, tmp_dir):
+        """Return predictions for batches of chips.
+
+        Unlike predict, this reads and preprocesses the next batches and makes
+        labels for the previous ones while the model runs, see
+        PredictPipeline.
+
+        Args:
+            batches: iterable of (chips, windows) as passed to predict, see
+                window_batches
+
+        Return:
+            generator of Labels objects, one per batch
+        """
+        return self._results_to_labels(self._batch_results(batches, tmp_dir))
+
+    def predict_scene(self, task, scene, tmp_dir):
+        """Return predictions for a scene, like Task.predict_scene.
+
+        Chips are read in batches of task.config.predict_batch_size and
+        passed to predict_batches, skipping empty ones.
+
+        Args:
+            task: Task the prediction is for
+            scene: activated Scene to predict on
+
+        Return:
+            Labels object containing predictions
+        """
+        raster_source = scene.raster_source
+        windows = task.get_predict_windows(raster_source.get_extent())
+        batches = self._window_batches(raster_source, windows,
+                                       task.config.predict_batch_size)
+        return self._scene_labels(task, scene,
+                                  self.predict_batches(batches, tmp_dir))
+
+    def _window_batches(self, raster_source, windows, batch_sz):
+        return window_batches(raster_source, windows, batch_sz,
+                              skip_empty=True)
+
+    def _batch_results(self, batches, tmp_dir):
+        self.load_model(tmp_dir)
+        return self.pipeline.run(batches)
+
+    def _results_to_labels(self, batch_labels):
+        # Labels are made for each batch by the pipeline.
+        return batch_labels
+
+    def _scene_labels(self, task, scene, batch_labels):
+        labels = sum_labels(batch_labels,
+                            scene.prediction_label_store.empty_labels())
+        return task.post_process_predictions(labels, scene)
 
+    def _preprocess(self, chips):
+        if self.client is not None:
+            # The server does the preprocessing.
+            return chips
         # (batch_size, h, w, nchannels) --> (batch_size, nchannels, h, w)
-        chips = torch.Tensor(chips).permute((0, 3, 1, 2)) / 255.
-        chips = chips.to(self.device)
+        return self.preprocessor(chips)
 
-        model = self.inf_learner.model.eval()
-        preds = model(chips).detach().cpu()
+    def _infer(self, x):
+        if self.client is not None:
+            return self.client.infer(x)
+        return self.runner(x)
 
+    def _make_labels(self, preds, windows):
+        preds = preds.cpu()
         labels = ChipClassificationLabels()
 
         for class_probs, window in zip(preds, windows):
@@ -2,8 +2,6 @@ from copy import deepcopy
 
 import rastervision as rv
 
-from fastai_plugin.chip_classification_backend import (
-    ChipClassificationBackend)
 from fastai_plugin.simple_backend_config import (
     SimpleBackendConfig, SimpleBackendConfigBuilder)
 
@@ -15,7 +13,9 @@ class TrainOptions():
                  one_cycle=None,
                  num_epochs=None, model_arch=None, fp16=None,
                  flip_vert=None, sync_interval=None, debug=None,
-                 train_prop=None, train_count=None, tta=None, oversample=None):
+                 train_prop=None, train_count=None, tta=None, oversample=None,
+                 checkpoint_steps=None, max_hours=None, max_steps=None,
+                 validate_every=None, valid_count=None, precision=None):
         self.batch_sz = batch_sz
         self.weight_decay = weight_decay
         self.lr = lr
@@ -26,9 +26,17 @@ class TrainOptions():
         self.flip_vert = flip_vert
         self.sync_interval = sync_interval
         self.debug = debug
+        self.checkpoint_steps = checkpoint_steps
+        self.max_hours = max_hours
+        self.max_steps = max_steps
+        self.validate_every = validate_every
+        self.valid_count = valid_count
+        self.precision = precision
 
     def __setattr__(self, name, value):
-        if name in ['batch_sz', 'num_epochs', 'sync_interval']:
+        if name in ['batch_sz', 'num_epochs', 'sync_interval',
+                    'checkpoint_steps', 'max_steps', 'validate_every',
+                    'valid_count']:
             value = int(value) if isinstance(value, float) else value
         super().__setattr__(name, value)
 
@@ -36,7 +44,8 @@ class TrainOptions():
 class ChipClassificationBackendConfig(SimpleBackendConfig):
     train_opts_class = TrainOptions
     backend_type = FASTAI_CHIP_CLASSIFICATION
-    backend_class = ChipClassificationBackend
+    backend_class_path = (
+        'fastai_plugin.chip_classification_backend.ChipClassificationBackend')
 
 
 class ChipClassificationBackendConfigBuilder(SimpleBackendConfigBuilder):
@@ -56,14 +65,49 @@ class ChipClassificationBackendConfigBuilder(SimpleBackendConfigBuilder):
             fp16=False,
             flip_vert=False,
             sync_interval=1,
-            debug=False):
-
+            debug=False,
+            checkpoint_steps=None,
+            max_hours=None,
+            max_steps=None,
+            validate_every=1,
+            valid_count=None,
+            precision=None):
+        """Set options for training models.
+
+        Args:
+            checkpoint_steps: (int or None) if set, save a checkpoint every
+                checkpoint_steps training steps, so that training can resume
+                from the middle of an epoch (eg. after a spot instance is
+                preempted) instead of from the last completed epoch.
+            max_hours: (float or None) wall-clock time budget of training in
+                hours. If set, training stops when the budget is used up,
+                regardless of num_epochs, and one_cycle schedules are
+                stretched to fit it, based on the measured throughput.
+            max_steps: (int or None) maximum number of training steps
+                (batches). If set, training stops after max_steps steps,
+                regardless of num_epochs, and one_cycle schedules end there.
+            validate_every: (int) validate every validate_every epochs. The
+                last epoch is always validated.
+            valid_count: (int or None) if set, validate on a fixed subset of
+                about valid_count validation chips, stratified by the rarest
+                class in each chip. The full validation set is only used for
+                the last epoch and to confirm that a model is better before
+                exporting it.
+            precision: (str or None) precision to train and predict in,
+                'fp32', 'fp16' (CUDA only) or 'bf16' (CPU or CUDA, needs
+                torch >= 1.10). Defaults to 'fp16' if fp16 is True and 'fp32'
+                otherwise. See fastai_plugin.precision.
+        """
         b = deepcopy(self)
         b.train_opts = TrainOptions(
             batch_sz=batch_sz, weight_decay=weight_decay, lr=lr,
             one_cycle=one_cycle,
             num_epochs=num_epochs, model_arch=model_arch, fp16=fp16,
-            flip_vert=flip_vert, sync_interval=sync_interval, debug=debug)
+            flip_vert=flip_vert, sync_interval=sync_interval, debug=debug,
+            checkpoint_steps=checkpoint_steps,
+            max_hours=max_hours, max_steps=max_steps,
+            validate_every=validate_every, valid_count=valid_count,
+            precision=precision)
         return b
 
     def with_pretrained_uri(self, pretrained_uri):
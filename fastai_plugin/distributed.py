@@ -0,0 +1,214 @@
+"""Data-parallel training in several processes with torch.distributed.
+
+launch forks a number of workers on this machine, which join a process group
+and each run the training function. The gloo backend is used by default, so
+this works on CPU-only machines. Each worker trains on its own shard of the
+training data (see DistributedCallback in utils), with gradients averaged
+across workers after every backward pass, so the effective batch size is the
+number of workers times the batch size of each.
+
+To train on several machines, run the same command on each one with these
+environment variables set:
+- NNODES: number of machines
+- NODE_RANK: rank of this machine, from 0 to NNODES - 1
+- MASTER_ADDR, MASTER_PORT: address and port of the machine with NODE_RANK 0
+
+Processes started by another launcher (eg. torchrun), with RANK and
+WORLD_SIZE set, join the process group directly instead of forking workers.
+"""
+from datetime import timedelta
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.utils.data import Sampler
+
+# Processes only wait for each other that long. This needs to cover what the
+# main process does alone, like running lr_find or exporting the model.
+DEFAULT_TIMEOUT = timedelta(hours=2)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    """Return True unless this is a worker other than rank 0."""
+    return rank() == 0
+
+
+def is_local_main_process():
+    """Return True unless this is a worker other than the first on its machine."""
+    return local_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def _device():
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def broadcast_value(value):
+    """Return the value (a number or None) passed by the process of rank 0."""
+    if not is_distributed():
+        return value
+    t = torch.tensor(
+        [value is not None, value or 0], dtype=torch.float64, device=_device())
+    dist.broadcast(t, 0)
+    return t[1].item() if t[0].item() else None
+
+
+def broadcast_tensors(tensors):
+    """Set tensors in place to those of the process of rank 0."""
+    if not is_distributed() or not tensors:
+        return
+    flat = _flatten_dense_tensors(tensors)
+    dist.broadcast(flat, 0)
+    for t, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+        t.copy_(synced)
+
+
+def all_reduce_mean(tensors):
+    """Set tensors in place to their mean over all processes."""
+    if not is_distributed() or not tensors:
+        return
+    flat = _flatten_dense_tensors(tensors)
+    dist.all_reduce(flat)
+    flat /= world_size()
+    for t, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+        t.copy_(synced)
+
+
+class DistributedWeightedSampler(Sampler):
+    """Shards the indices drawn by a weighted random sampler between processes.
+
+    Every process draws the same num_samples indices, with a generator
+    seeded by seed and the epoch, and keeps every world_size-th one from its
+    rank on. Like DistributedSampler, the draw is padded so that every
+    process gets the same number of indices, and set_epoch needs to be
+    called at the start of each epoch.
+    """
+
+    def __init__(self, weights, num_samples, num_replicas, rank,
+                 replacement=True, seed=0):
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.num_samples = num_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.replacement = replacement
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.multinomial(
+            self.weights, self.num_samples, self.replacement,
+            generator=generator).tolist()
+        indices += indices[:len(self) * self.num_replicas - len(indices)]
+        return iter(indices[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return math.ceil(self.num_samples / self.num_replicas)
+
+
+def _init_process_group(backend, timeout):
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank())
+    dist.init_process_group(backend, init_method='env://', timeout=timeout)
+
+
+def _worker(fn, args, env, nb_threads, seed, backend, timeout):
+    os.environ.update(env)
+    torch.set_num_threads(nb_threads)
+    # Forked workers start with the same RNG states, which would give them
+    # the same augmentations and dropout masks.
+    seed += int(env['RANK'])
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2**32)
+    random.seed(seed)
+    _init_process_group(backend, timeout)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, nb_workers, *args, backend='gloo', timeout=DEFAULT_TIMEOUT):
+    """Run fn(*args) in nb_workers processes forming a process group.
+
+    Workers are forked and each use an equal share of the CPUs for torch
+    (and the GPU matching their local rank if there are GPUs). If one of them
+    fails, the others are stopped.
+
+    Args:
+        fn: function to run in each worker
+        nb_workers: (int) number of workers on this machine
+        backend: (str) torch.distributed backend, 'gloo' works on the CPU
+            and GPU, 'nccl' only on the GPU
+        timeout: (timedelta) timeout of operations between workers
+    """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        _init_process_group(backend, timeout)
+        try:
+            return fn(*args)
+        finally:
+            dist.destroy_process_group()
+
+    nb_nodes = int(os.environ.get('NNODES', 1))
+    node_rank = int(os.environ.get('NODE_RANK', 0))
+    nb_threads = max((os.cpu_count() or 1) // nb_workers, 1)
+    seed = int(torch.randint(2**31, (1, )))
+    ctx = multiprocessing.get_context('fork')
+    workers = []
+    for i in range(nb_workers):
+        env = {
+            'RANK': str(node_rank * nb_workers + i),
+            'LOCAL_RANK': str(i),
+            'WORLD_SIZE': str(nb_nodes * nb_workers),
+            'MASTER_ADDR': os.environ.get('MASTER_ADDR', '127.0.0.1'),
+            'MASTER_PORT': os.environ.get('MASTER_PORT', '29500')
+        }
+        workers.append(
+            ctx.Process(
+                target=_worker,
+                args=(fn, args, env, nb_threads, seed, backend, timeout)))
+    try:
+        for worker in workers:
+            worker.start()
+        while any(worker.exitcode is None for worker in workers):
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                raise RuntimeError('A training worker failed.')
+            time.sleep(1)
+        if any(worker.exitcode != 0 for worker in workers):
+            raise RuntimeError('A training worker failed.')
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,192 @@
+"""A local cache of downloaded files shared by runs on the same machine.
+
+Files are keyed by their URI and a fingerprint of their content: the ETag
+for S3, and the size and modification time otherwise. A changed file is
+therefore downloaded again, while an unchanged one is reused by every train,
+predict and bundle run on the machine.
+
+The cache is safe to share between processes. Each entry is downloaded by a
+single process holding a lock on its key, into a staging directory, and then
+moved into place atomically, so readers never see partial files. When the
+cache grows over its size cap, the least recently used entries are evicted.
+"""
+from contextlib import contextmanager
+from os.path import basename, isfile, join
+from urllib.parse import urlparse
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from rastervision.filesystem import FileSystem
+from rastervision.utils.files import download_if_needed
+
+
+def is_local(uri):
+    return urlparse(uri).scheme in ('', 'file')
+
+
+def _s3_etag(uri):
+    import boto3
+
+    parsed = urlparse(uri)
+    head = boto3.client('s3').head_object(
+        Bucket=parsed.netloc, Key=parsed.path[1:])
+    return 'etag={} size={}'.format(head['ETag'], head['ContentLength'])
+
+
+def uri_fingerprint(uri):
+    """Return a string that changes when the file at uri changes, or None."""
+    if is_local(uri):
+        stat = os.stat(urlparse(uri).path)
+        return 'size={} mtime={}'.format(stat.st_size, stat.st_mtime)
+    if urlparse(uri).scheme == 's3':
+        try:
+            return _s3_etag(uri)
+        except Exception:
+            pass
+    last_modified = FileSystem.get_file_system(uri, 'r').last_modified(uri)
+    return None if last_modified is None else str(last_modified)
+
+
+@contextmanager
+def _locked(path):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FileCache():
+    """Content-addressed cache of files in a local directory.
+
+    Each entry is a directory named after the key of the file, holding the
+    file under its original name. Lock files are kept apart, in a directory
+    that is never evicted: if they were in the entries, a process waiting on
+    the lock of an evicted entry would hold a lock on a deleted file, while
+    another process locks a new one, and both would download the file.
+    """
+
+    def __init__(self, cache_dir, max_bytes, min_age=300):
+        """Constructor.
+
+        Args:
+            cache_dir: (str) local directory of the cache
+            max_bytes: (int) size cap of the cache
+            min_age: (float) entries used in the last min_age seconds are not
+                evicted, as other processes may be about to open them
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.entries_dir = join(cache_dir, 'entries')
+        self.staging_dir = join(cache_dir, 'staging')
+        self.locks_dir = join(cache_dir, 'locks')
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+    def key(self, uri, fingerprint):
+        return hashlib.sha256(
+            '{}\n{}'.format(uri, fingerprint).encode('utf-8')).hexdigest()
+
+    def lock_path(self, key):
+        return join(self.locks_dir, key)
+
+    def get(self, uri):
+        """Return the local path of the file at uri, downloading it if needed.
+
+        Returns:
+            path of the file in the cache, or None if the file has no
+                fingerprint and can't be cached
+        """
+        fingerprint = uri_fingerprint(uri)
+        if fingerprint is None:
+            return None
+        key = self.key(uri, fingerprint)
+        entry_dir = join(self.entries_dir, key)
+        path = join(entry_dir, basename(urlparse(uri).path))
+        while True:
+            if not isfile(path):
+                with _locked(self.lock_path(key)):
+                    if not isfile(path):
+                        # The entry may have been evicted while waiting.
+                        os.makedirs(entry_dir, exist_ok=True)
+                        self._download(uri, path)
+                self.evict(keep=key)
+            try:
+                # The modification time of entries records their last use.
+                os.utime(path)
+                return path
+            except FileNotFoundError:
+                pass
+
+    def _download(self, uri, path):
+        staging_dir = tempfile.mkdtemp(dir=self.staging_dir)
+        try:
+            download_path = download_if_needed(uri, staging_dir)
+            staged_path = join(staging_dir, 'file')
+            if is_local(uri):
+                shutil.copyfile(download_path, staged_path)
+            else:
+                os.replace(download_path, staged_path)
+            os.replace(staged_path, path)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def entries(self):
+        """Return (last_used, size, key) of each complete entry."""
+        entries = []
+        for key in os.listdir(self.entries_dir):
+            entry_dir = join(self.entries_dir, key)
+            try:
+                names = os.listdir(entry_dir)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                try:
+                    stat = os.stat(join(entry_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, key))
+        return entries
+
+    def evict(self, keep=None):
+        """Evict least recently used entries until under the size cap."""
+        with _locked(join(self.cache_dir, '.lock')):
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            now = time.time()
+            for last_used, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                if key == keep or now - last_used < self.min_age:
+                    continue
+                entry_dir = join(self.entries_dir, key)
+                with _locked(self.lock_path(key)):
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+
+
+def get_file_cache(backend_opts):
+    """Return the FileCache set up with with_cache_options, or None."""
+    if not getattr(backend_opts, 'cache_dir', None):
+        return None
+    return FileCache(backend_opts.cache_dir,
+                     backend_opts.cache_size_mb * 2**20)
+
+
+def cached_download(uri, tmp_dir, cache=None):
+    """Download a file like download_if_needed, through cache if there is one.
+
+    Local files are used in place, as with download_if_needed.
+    """
+    if cache is not None and not is_local(uri):
+        path = cache.get(uri)
+        if path is not None:
+            return path
+    return download_if_needed(uri, tmp_dir)
@@ -0,0 +1,142 @@
+"""Predict engine for models exported as TorchScript or ONNX graphs.
+
+This only depends on torch (and onnxruntime for ONNX), not on fastai, so
+loading a model doesn't import fastai or unpickle any of its classes.
+
+The latency of an exported model on the CPU can be measured with:
+
+    python -m fastai_plugin.graph_engine <model_uri> --format torchscript \
+        --chip-size 300 --batch-size 8
+"""
+import argparse
+import json
+import statistics
+import time
+
+import torch
+
+from fastai_plugin.uris import graph_uri, graph_meta_uri
+
+GRAPH_FORMATS = ['torchscript', 'onnx']
+
+
+class GraphModel():
+    """Runs an exported graph like the model it was exported from.
+
+    Models whose output is a list with non-tensor elements (ie. RetinaNet,
+    which also returns its feature map sizes) are exported with only the
+    tensors as outputs. Sizes are exported as tensors, and converted back to
+    lists here. Other values are stored in the metadata and added back here.
+    """
+
+    def __init__(self, path, meta, fmt='torchscript', device=None):
+        """Constructor.
+
+        Args:
+            path: (str) path of the exported graph
+            meta: (dict) metadata written with it
+            fmt: (str) one of GRAPH_FORMATS
+            device: (torch.device or None) device to run the model on
+        """
+        if fmt not in GRAPH_FORMATS:
+            raise ValueError('Unknown graph format {}.'.format(fmt))
+        self.meta = meta
+        self.fmt = fmt
+        self.device = device or torch.device('cpu')
+        # Attributes of the original model used to interpret its output.
+        for k, v in meta.get('attrs', {}).items():
+            setattr(self, k, v)
+
+        if fmt == 'torchscript':
+            self.module = torch.jit.load(path, map_location=self.device)
+            self.module.eval()
+        else:
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(path)
+
+    def parameters(self):
+        if self.fmt == 'torchscript':
+            return self.module.parameters()
+        return iter([])
+
+    def modules(self):
+        return []
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        if self.fmt == 'torchscript':
+            self.module.share_memory()
+        return self
+
+    def __call__(self, x):
+        if self.fmt == 'torchscript':
+            outputs = self.module(x)
+        else:
+            outputs = self.session.run(
+                None, {'input': x.detach().cpu().float().numpy()})
+            outputs = [torch.from_numpy(o).to(x.device) for o in outputs]
+        if isinstance(outputs, torch.Tensor):
+            outputs = [outputs]
+
+        template = self.meta.get('output')
+        if template is None:
+            return outputs[0]
+        outputs = iter(outputs)
+        return [
+            next(outputs) if o is None else
+            next(outputs).tolist() if isinstance(o, dict) and o.get('tolist')
+            else o for o in template
+        ]
+
+
+def load_graph_model(path, meta_path, fmt='torchscript', device=None):
+    """Load an exported graph and its metadata as a GraphModel."""
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return GraphModel(path, meta, fmt=fmt, device=device)
+
+
+def benchmark(model, x, nb_runs=10, nb_warmup=2):
+    """Return the median latency in ms of running model on x."""
+    times = []
+    with torch.no_grad():
+        for i in range(nb_warmup + nb_runs):
+            start = time.perf_counter()
+            model(x)
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            if i >= nb_warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the CPU latency of an exported model.')
+    parser.add_argument('model_path', help='path of the exported model '
+                        '(without the format extension)')
+    parser.add_argument('--format', default='torchscript',
+                        choices=GRAPH_FORMATS)
+    parser.add_argument('--chip-size', type=int, default=300)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--nb-channels', type=int, default=3)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = load_graph_model(
+        graph_uri(args.model_path, args.format),
+        graph_meta_uri(args.model_path), fmt=args.format)
+    x = torch.rand(args.batch_size, args.nb_channels, args.chip_size,
+                   args.chip_size)
+    latency = benchmark(model, x, nb_runs=args.runs)
+    print('{} latency for a batch of {}: {:.1f} ms ({:.2f} ms per chip)'.format(
+        args.format, args.batch_size, latency, latency / args.batch_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import copy
+import inspect
+import json
+import warnings
+
+import torch
+from torch import nn
+
+from fastai_plugin.graph_engine import GRAPH_FORMATS, GraphModel, benchmark
+from fastai_plugin.uris import graph_uri, graph_meta_uri
+
+# Attributes of models needed to interpret their output.
+MODEL_ATTRS = ['ratios', 'scales']
+
+
+def set_tensor_sizes(model, tensor_sizes=True):
+    """Make modules that output sizes (ie. RetinaNet) output them as tensors.
+
+    Otherwise the sizes are Python ints, which a traced graph would keep as
+    the constants seen when tracing, whatever the size of its input.
+    """
+    for module in model.modules():
+        if hasattr(module, 'tensor_sizes'):
+            module.tensor_sizes = tensor_sizes
+
+
+class TensorOutputs(nn.Module):
+    """Wraps a model so that it only returns the tensors of its output.
+
+    This sets tensor_sizes on the model, see set_tensor_sizes.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        set_tensor_sizes(model)
+        self.model = model
+
+    def forward(self, x):
+        output = self.model(x)
+        if isinstance(output, (list, tuple)):
+            return tuple(o for o in output if isinstance(o, torch.Tensor))
+        return output
+
+
+def output_template(model, x):
+    """Return the metadata GraphModel needs to rebuild the output of model.
+
+    Tensors of the output are returned by the graph (None in the template),
+    as are sizes, which GraphModel converts back to lists ({'tolist': True}).
+    Other values are stored as is. This leaves tensor_sizes set on model.
+    """
+    with torch.no_grad():
+        set_tensor_sizes(model, False)
+        output = model(x)
+        set_tensor_sizes(model)
+        graph_output = model(x)
+    if not isinstance(output, (list, tuple)):
+        return None
+    return [
+        None if isinstance(o, torch.Tensor) else
+        {'tolist': True} if isinstance(g, torch.Tensor) else o
+        for o, g in zip(output, graph_output)
+    ]
+
+
+def max_diff(outputs, other_outputs):
+    """Return the max absolute difference of outputs, inf if others differ."""
+    if isinstance(outputs, torch.Tensor):
+        outputs, other_outputs = [outputs], [other_outputs]
+    return max(
+        float((o.float() - other.float()).abs().max())
+        if isinstance(o, torch.Tensor) else 0. if o == other else float('inf')
+        for o, other in zip(outputs, other_outputs))
+
+
+def _export_onnx(model, x, path, outputs):
+    output_names = ['output{}'.format(i) for i in range(len(outputs))]
+    kwargs = {'input_names': ['input'], 'output_names': output_names}
+    if 'dynamic_axes' in inspect.signature(torch.onnx.export).parameters:
+        # The batch and chip sizes vary, and so does every output dimension.
+        dynamic_axes = {'input': {0: 'batch', 2: 'height', 3: 'width'}}
+        for name, output in zip(output_names, outputs):
+            dynamic_axes[name] = {
+                i: '{}_{}'.format(name, i)
+                for i in range(output.dim())
+            }
+        kwargs['dynamic_axes'] = dynamic_axes
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # The dynamo exporter specializes on dimensions it sees as constant.
+        kwargs['dynamo'] = False
+    torch.onnx.export(model, x, path, **kwargs)
+
+
+def export_graphs(model, x, model_path, formats=('torchscript', ),
+                  meta=None, tolerance=1e-3):
+    """Export a model as graphs for use with graph_engine.
+
+    The model is traced on the CPU in fp32 with x. The exported graphs are
+    then checked against the model on a batch of a different size, and on a
+    chip of a different size, and their CPU latency is compared with the
+    model's. These results are stored in the metadata and printed.
+
+    Args:
+        model: (nn.Module) model to export
+        x: (Tensor) of shape (batch_sz, nb_channels, height, width), example
+            input with the chip size used for predictions
+        model_path: (str) path of the exported fastai model, the graphs are
+            written next to it (see graph_uri and graph_meta_uri)
+        formats: list of formats in GRAPH_FORMATS to export
+        meta: (dict or None) JSON serializable metadata to store
+        tolerance: (float) maximum absolute difference between the outputs of
+            the model and graphs before warning
+
+    Returns:
+        (dict) metadata written with the graphs
+    """
+    for fmt in formats:
+        if fmt not in GRAPH_FORMATS:
+            raise ValueError('Unknown graph format {}.'.format(fmt))
+
+    model = copy.deepcopy(model).float().cpu().eval()
+    x = x[:1].float().cpu()
+    trace_x = torch.cat([x, x])
+    check_x = torch.cat([x, x, torch.rand_like(x)])
+    # Larger by the stride of common encoders, so the model accepts it.
+    resized_x = torch.rand(1, x.shape[1], x.shape[2] + 32, x.shape[3] + 32)
+    check_inputs = [check_x, resized_x]
+    with torch.no_grad():
+        outputs = [model(inputs) for inputs in check_inputs]
+    template = output_template(model, check_x)
+    wrapper = TensorOutputs(model)
+    with torch.no_grad():
+        tensor_output = wrapper(check_x)
+    if isinstance(tensor_output, torch.Tensor):
+        tensor_output = (tensor_output, )
+
+    graph_meta = {
+        'meta': meta or {},
+        'formats': [],
+        'output': template,
+        'attrs': {k: getattr(model, k) for k in MODEL_ATTRS
+                  if hasattr(model, k)},
+        'parity': {},
+        'latency_ms': {'eager': benchmark(model, check_x)}
+    }
+    meta_path = graph_meta_uri(model_path)
+    with torch.no_grad():
+        for fmt in formats:
+            path = graph_uri(model_path, fmt)
+            if fmt == 'torchscript':
+                traced = torch.jit.trace(wrapper, trace_x, check_trace=False)
+                traced.save(path)
+            else:
+                try:
+                    _export_onnx(wrapper, trace_x, path, tensor_output)
+                except Exception as e:
+                    # Don't stop training over the optional ONNX export.
+                    warnings.warn('ONNX export failed: {!r}'.format(e))
+                    continue
+            graph_meta['formats'].append(fmt)
+
+            try:
+                graph_model = GraphModel(path, graph_meta, fmt=fmt)
+            except ImportError:
+                print('Cannot check the {} export without {}.'.format(
+                    fmt, 'onnxruntime'))
+                continue
+            diff = max(
+                max_diff(output, graph_model(inputs))
+                for output, inputs in zip(outputs, check_inputs))
+            graph_meta['parity'][fmt] = diff
+            graph_meta['latency_ms'][fmt] = benchmark(graph_model, check_x)
+            if diff > tolerance:
+                warnings.warn(
+                    'The {} export differs from the model by up to {}.'.format(
+                        fmt, diff))
+
+    with open(meta_path, 'w') as f:
+        json.dump(graph_meta, f)
+    print('Exported {} graphs. Max difference with model: {}. CPU latency '
+          'for a batch of {} (ms): {}'.format(
+              ', '.join(graph_meta['formats']), graph_meta['parity'], len(check_x),
+              graph_meta['latency_ms']))
+    return graph_meta
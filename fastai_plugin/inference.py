@@ -0,0 +1,292 @@
+import logging
+
+import numpy as np
+import torch
+
+log = logging.getLogger(__name__)
+
+# When the activations of a model can't be measured, its memory use on a chip
+# is estimated as this many times the size of its input and output.
+IO_BYTES_FACTOR = 16
+
+
+def model_dtype(model):
+    """Return the floating point type of the parameters of a model."""
+    for p in model.parameters():
+        if p.is_floating_point():
+            return p.dtype
+    return torch.float32
+
+
+def is_channels_last(model):
+    """Return whether the convolution weights of a model are channels last."""
+    for p in model.parameters():
+        if p.dim() == 4 and p.shape[1] > 1 and p.shape[2] * p.shape[3] > 1:
+            return p.stride(1) == 1
+    return False
+
+
+def to_channels_last(model):
+    """Convert a model to the channels last layout if torch supports it."""
+    if not hasattr(torch, 'channels_last'):
+        return False
+    model.to(memory_format=torch.channels_last)
+    return True
+
+
+class ChipPreprocessor():
+    """Turns batches of chips from Raster Vision into model inputs.
+
+    The chips are wrapped without copying, moved to the device in their
+    original (usually uint8) type, and then converted, laid out as
+    (batch_sz, nb_channels, height, width) and scaled to [0, 1] in place in a
+    preallocated buffer. Compared to converting to float32 on the host, this
+    avoids two full size temporary tensors per batch and moves 4x less data to
+    the device.
+
+    The returned tensor is a view of a buffer, so it is overwritten
+    n_buffers calls later. With channels_last, the buffer is laid out like the
+    chips, so the copy doesn't need to transpose them.
+    """
+
+    def __init__(self, device, dtype=torch.float32, n_buffers=1,
+                 channels_last=False):
+        """Constructor.
+
+        Args:
+            device: (torch.device) device the model is on
+            dtype: (torch.dtype) type of the model inputs
+            n_buffers: (int) number of buffers to cycle through, ie. the
+                number of preprocessed batches that can be in use at once
+            channels_last: (bool) return tensors in the channels last layout,
+                for models converted to it (see is_channels_last)
+        """
+        self.device = device
+        self.dtype = dtype
+        self.channels_last = channels_last
+        self.buffers = [None] * n_buffers
+        self.buffer_ind = 0
+
+    def get_buffer(self, shape):
+        """Return a (view of a) buffer of shape, reallocating it if needed."""
+        batch_sz = shape[0]
+        buffer = self.buffers[self.buffer_ind]
+        if (buffer is None or buffer.shape[1:] != shape[1:]
+                or buffer.shape[0] < batch_sz):
+            if self.channels_last:
+                n, c, h, w = shape
+                buffer = torch.empty(
+                    (n, h, w, c), dtype=self.dtype,
+                    device=self.device).permute(0, 3, 1, 2)
+            else:
+                buffer = torch.empty(
+                    shape, dtype=self.dtype, device=self.device)
+            self.buffers[self.buffer_ind] = buffer
+        self.buffer_ind = (self.buffer_ind + 1) % len(self.buffers)
+        return buffer[:batch_sz]
+
+    def __call__(self, chips):
+        """Preprocess a batch of chips.
+
+        Args:
+            chips: (numpy.ndarray) of shape
+                (batch_sz, height, width, nb_channels)
+
+        Returns:
+            (Tensor) of shape (batch_sz, nb_channels, height, width) with
+                values in [0, 1]
+        """
+        chips = np.ascontiguousarray(chips)
+        if chips.dtype not in (np.uint8, np.int16, np.int32, np.float32,
+                               np.float64):
+            chips = chips.astype(np.float32)
+        x = torch.from_numpy(chips).to(self.device)
+        n, h, w, c = x.shape
+        buffer = self.get_buffer((n, c, h, w))
+        # copy_ converts the type and does the channel layout in one pass.
+        buffer.copy_(x.permute(0, 3, 1, 2))
+        return buffer.div_(255.)
+
+
+def dihedral(x, k):
+    """Apply the k-th dihedral transform to a batch of images.
+
+    This matches fastai.vision.transform.dihedral, on tensors of shape
+    (batch_sz, nb_channels, height, width).
+    """
+    flips = []
+    if k & 1:
+        flips.append(2)
+    if k & 2:
+        flips.append(3)
+    if flips:
+        x = torch.flip(x, flips)
+    if k & 4:
+        x = x.transpose(2, 3)
+    return x
+
+
+def inverse_dihedral(x, k):
+    """Undo dihedral(x, k)."""
+    return dihedral(x, {5: 6, 6: 5}.get(k, k))
+
+
+def is_oom_error(e):
+    """Return True if e is an out of memory error raised by torch."""
+    msg = str(e)
+    return isinstance(e, RuntimeError) and (
+        'out of memory' in msg or "can't allocate memory" in msg)
+
+
+def cat_outputs(outputs):
+    """Concatenate the outputs of a model on consecutive micro-batches.
+
+    Tensors are concatenated along the batch dimension, lists and tuples are
+    concatenated elementwise, and anything else (eg. the feature map sizes
+    returned by RetinaNet) is assumed to be the same for all micro-batches.
+    """
+    output = outputs[0]
+    if len(outputs) == 1:
+        return output
+    if isinstance(output, torch.Tensor):
+        return torch.cat(outputs)
+    if isinstance(output, (list, tuple)):
+        return type(output)(cat_outputs(o) for o in zip(*outputs))
+    return output
+
+
+def tensor_bytes(x):
+    """Return the total size of the tensors in a model input or output."""
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    if isinstance(x, (list, tuple)):
+        return sum(tensor_bytes(o) for o in x)
+    return 0
+
+
+def activation_bytes(model, x):
+    """Estimate the memory used by the activations of a model on a batch.
+
+    This is the total size of the outputs of the leaf modules on x, which
+    overestimates the peak memory used without autograd.
+
+    Returns:
+        the number of bytes, or None if the leaf modules can't be hooked, as
+            for TorchScript and exported graph models
+    """
+    sizes = []
+
+    def hook(module, input, output):
+        if isinstance(output, torch.Tensor):
+            sizes.append(output.numel() * output.element_size())
+
+    handles = []
+    try:
+        for m in model.modules():
+            if not list(m.children()):
+                handles.append(m.register_forward_hook(hook))
+        if handles:
+            model(x)
+    except RuntimeError:
+        # Hooks are not supported on ScriptModules.
+        return None
+    finally:
+        for h in handles:
+            h.remove()
+    return sum(sizes) if sizes else None
+
+
+class InferenceRunner():
+    """Runs a model on batches of any size without building autograd graphs.
+
+    Batches are split into micro-batches of at most batch_sz chips. If
+    mem_budget is set, batch_sz is found by measuring the memory used by one
+    chip on the first call: the peak allocated memory on CUDA, and the size of
+    the activations otherwise, or a multiple of the size of the input and
+    output if they can't be measured. When running out of memory, batch_sz is
+    halved and the micro-batch retried.
+    """
+
+    def __init__(self, model, mem_budget=None, batch_sz=None):
+        """Constructor.
+
+        Args:
+            model: model in eval mode
+            mem_budget: (int or None) bytes of memory a micro-batch may use
+            batch_sz: (int or None) maximum micro-batch size, unlimited if
+                None and mem_budget is None
+        """
+        self.model = model
+        self.mem_budget = mem_budget
+        self.batch_sz = batch_sz
+
+    def bytes_per_chip(self, x):
+        """Measure the memory used by running the model on one chip of x."""
+        x = x[:1]
+        if x.is_cuda and hasattr(torch.cuda, 'reset_max_memory_allocated'):
+            torch.cuda.synchronize(x.device)
+            start = torch.cuda.memory_allocated(x.device)
+            torch.cuda.reset_max_memory_allocated(x.device)
+            self.model(x)
+            return torch.cuda.max_memory_allocated(x.device) - start
+        nb_bytes = activation_bytes(self.model, x)
+        if nb_bytes is None:
+            nb_bytes = IO_BYTES_FACTOR * (
+                tensor_bytes(x) + tensor_bytes(self.model(x)))
+            log.warning(
+                'Cannot measure the activations of the model, so the memory '
+                'budget is applied to an estimate of {:.1f} MB per '
+                'chip.'.format(nb_bytes / 2**20))
+        return nb_bytes
+
+    def __call__(self, x):
+        """Run the model on a batch.
+
+        Args:
+            x: (Tensor) of shape (batch_sz, nb_channels, height, width)
+
+        Returns:
+            output of the model on x
+        """
+        with torch.no_grad():
+            if self.batch_sz is None and self.mem_budget is not None:
+                self.batch_sz = max(
+                    int(self.mem_budget // max(self.bytes_per_chip(x), 1)),
+                    1)
+
+            outputs = []
+            start = 0
+            while start < len(x):
+                batch_sz = self.batch_sz or len(x)
+                try:
+                    outputs.append(self.model(x[start:start + batch_sz]))
+                except RuntimeError as e:
+                    if not is_oom_error(e) or batch_sz == 1:
+                        raise
+                    self.batch_sz = batch_sz // 2
+                    if x.is_cuda:
+                        torch.cuda.empty_cache()
+                    continue
+                start += batch_sz
+            return cat_outputs(outputs)
+
+
+def slice_outputs(output, start, end):
+    """Return the part of a model output for chips start to end of a batch.
+
+    This is the inverse of cat_outputs.
+    """
+    if isinstance(output, (torch.Tensor, np.ndarray)):
+        return output[start:end]
+    if isinstance(output, (list, tuple)):
+        return type(output)(slice_outputs(o, start, end) for o in output)
+    return output
+
+
+def outputs_to_cpu(output):
+    """Move the tensors in a model output to the CPU."""
+    if isinstance(output, torch.Tensor):
+        return output.cpu()
+    if isinstance(output, (list, tuple)):
+        return type(output)(outputs_to_cpu(o) for o in output)
+    return output
@@ -0,0 +1,83 @@
+"""Reuse of learning rates found by lr_find across runs.
+
+lr_find sweeps over many batches and usually suggests the same learning rate
+for a given dataset and model. Its result is stored in the training directory,
+so that reruns and resumed runs skip the sweep, and optionally in a shared
+directory, so that other experiments on the same chips can reuse it. Results
+are keyed by a fingerprint of the chip zip files, the backend, the model
+architecture, the batch size and the weight decay.
+"""
+from os.path import basename, join, isfile
+import hashlib
+import json
+
+from rastervision.utils.files import (file_exists, file_to_str, list_paths,
+                                      str_to_file)
+
+from fastai_plugin.file_cache import uri_fingerprint
+
+LR_FIND_FILE = 'lr_find.json'
+
+
+def lr_find_key(chip_uri, backend, model_arch, batch_sz, weight_decay):
+    """Return the key of lr_find results, or None if chips can't be fingerprinted.
+
+    Args:
+        chip_uri: (str) URI of the directory of chip zip files
+        backend: (str) type of the backend, as models differ between backends
+        model_arch: (str) model architecture
+        batch_sz: (int) batch size
+        weight_decay: (float) weight decay
+    """
+    chips = []
+    for zip_uri in sorted(list_paths(chip_uri, 'zip')):
+        fingerprint = uri_fingerprint(zip_uri)
+        if fingerprint is None:
+            return None
+        chips.append([basename(zip_uri), fingerprint])
+    key = json.dumps([chips, backend, model_arch, batch_sz, weight_decay])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _read_lr(uri, key):
+    if not file_exists(uri):
+        return None
+    result = json.loads(file_to_str(uri))
+    return result['lr'] if result.get('key') == key else None
+
+
+def cached_lr_find(learn, key, train_dir, shared_uri=None):
+    """Return the learning rate suggested by lr_find, reusing past results.
+
+    The result is looked up in train_dir, then in shared_uri. If neither has
+    a result for key, lr_find is run and its result is written to both.
+
+    Args:
+        learn: (Learner) the learner to train
+        key: (str or None) from lr_find_key, None to always run lr_find
+        train_dir: (str) local training directory, synced to train_uri
+        shared_uri: (str or None) URI of a directory of results shared
+            between experiments
+    """
+    path = join(train_dir, LR_FIND_FILE)
+    shared_result_uri = join(shared_uri, '{}.json'.format(key)) \
+        if shared_uri and key else None
+    if key is not None:
+        for uri in [path, shared_result_uri]:
+            lr = _read_lr(uri, key) if uri else None
+            if lr is not None:
+                print('Using lr found by lr_find() in {}: {}'.format(uri, lr))
+                if uri != path:
+                    str_to_file(json.dumps({'key': key, 'lr': lr}), path)
+                return lr
+
+    learn.lr_find()
+    learn.recorder.plot(suggestion=True, return_fig=True)
+    lr = learn.recorder.min_grad_lr
+    print('lr_find() found lr: {}'.format(lr))
+    if key is not None:
+        result = json.dumps({'key': key, 'lr': lr})
+        str_to_file(result, path)
+        if shared_result_uri:
+            str_to_file(result, shared_result_uri)
+    return lr
@@ -0,0 +1,173 @@
+"""Inference model format that loads without unpickling a fastai Learner.
+
+An artifact is a single file holding:
+- the structure of the model, pickled with all tensors emptied,
+- the tensors of its state_dict, each aligned to ALIGNMENT bytes, so they
+  can be memory-mapped,
+- a JSON header with the tensor layout and metadata like the class map,
+- the size of the header and MAGIC.
+
+Loading memory-maps the tensors (copy-on-write), so it only reads the pages
+actually used, and nothing is copied if the model runs on the CPU.
+"""
+import inspect
+import io
+import json
+import struct
+
+import numpy as np
+import torch
+from torch import nn
+
+from fastai_plugin.inference import is_channels_last, to_channels_last
+from fastai_plugin.uris import artifact_uri
+
+MAGIC = b'FPIA'
+VERSION = 1
+ALIGNMENT = 64
+_TRAILER = struct.Struct('<Q4s')
+
+
+def _torch_load(f):
+    kwargs = {'map_location': 'cpu'}
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        kwargs['weights_only'] = False
+    return torch.load(f, **kwargs)
+
+
+def _clear_hook_outputs(model):
+    """Drop activations stored by fastai hooks so they aren't pickled."""
+    for module in model.modules():
+        for value in vars(module).values():
+            hooks = getattr(value, 'hooks', [value])
+            if not isinstance(hooks, (list, tuple)):
+                continue
+            for hook in hooks:
+                if hasattr(hook, 'hook_func') and hasattr(hook, 'stored'):
+                    hook.stored = None
+
+
+def _pickle_structure(model):
+    """Pickle model with all its parameters and buffers emptied."""
+    emptied = []
+    for module in model.modules():
+        for tensors in (module._parameters, module._buffers):
+            for name, tensor in tensors.items():
+                if tensor is None:
+                    continue
+                emptied.append((tensors, name, tensor))
+                empty = torch.empty(0, dtype=tensor.dtype)
+                if isinstance(tensor, nn.Parameter):
+                    empty = nn.Parameter(
+                        empty, requires_grad=tensor.requires_grad)
+                tensors[name] = empty
+    try:
+        f = io.BytesIO()
+        torch.save(model, f)
+        return f.getvalue()
+    finally:
+        for tensors, name, tensor in emptied:
+            tensors[name] = tensor
+
+
+def _pad(f):
+    f.write(b'\0' * (-f.tell() % ALIGNMENT))
+
+
+def save_model_artifact(model, path, meta=None, fp16=False):
+    """Save the inference artifact of a model.
+
+    Args:
+        model: (nn.Module) the model
+        path: (str) path of the artifact file
+        meta: (dict or None) JSON serializable metadata to store with it, eg.
+            the class map
+        fp16: (bool) if True, store floating point tensors in fp16, halving
+            the size of the artifact
+    """
+    _clear_hook_outputs(model)
+    structure = _pickle_structure(model)
+    header = {
+        'version': VERSION,
+        'fp16': fp16,
+        # Tensors are stored contiguously, so the layout is restored on load.
+        'channels_last': is_channels_last(model),
+        'meta': meta or {},
+        'tensors': []
+    }
+    with open(path, 'wb') as f:
+        header['structure'] = [f.tell(), len(structure)]
+        f.write(structure)
+        for name, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu()
+            if fp16 and tensor.is_floating_point():
+                tensor = tensor.half()
+            arr = tensor.contiguous().numpy()
+            _pad(f)
+            header['tensors'].append({
+                'name': name,
+                'dtype': arr.dtype.str,
+                'shape': list(arr.shape),
+                'offset': f.tell()
+            })
+            f.write(arr.tobytes())
+        header_bytes = json.dumps(header).encode('utf-8')
+        f.write(header_bytes)
+        f.write(_TRAILER.pack(len(header_bytes), MAGIC))
+
+
+def read_artifact_header(path):
+    """Return the JSON header of an artifact."""
+    with open(path, 'rb') as f:
+        f.seek(-_TRAILER.size, 2)
+        header_sz, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not a model artifact.'.format(path))
+        f.seek(-_TRAILER.size - header_sz, 2)
+        return json.loads(f.read(header_sz).decode('utf-8'))
+
+
+def _get_submodule(model, name):
+    for attr in name.split('.'):
+        model = getattr(model, attr)
+    return model
+
+
+def load_model_artifact(path, device=None):
+    """Load the model of an inference artifact.
+
+    Args:
+        path: (str) path of the artifact file
+        device: (torch.device or None) device to move the model to. On the
+            CPU, fp16 artifacts are converted to fp32.
+
+    Returns:
+        (model, meta) with the model in eval mode
+    """
+    header = read_artifact_header(path)
+    start, size = header['structure']
+    with open(path, 'rb') as f:
+        f.seek(start)
+        model = _torch_load(io.BytesIO(f.read(size)))
+
+    # Copy-on-write, so the tensors are writable without touching the file.
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    for spec in header['tensors']:
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        arr = data[spec['offset']:spec['offset'] + count * dtype.itemsize]
+        tensor = torch.from_numpy(arr.view(dtype).reshape(spec['shape']))
+        module_name, _, attr = spec['name'].rpartition('.')
+        module = _get_submodule(model, module_name) if module_name else model
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(
+                tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+
+    device = device or torch.device('cpu')
+    if header['fp16'] and device.type == 'cpu':
+        model = model.float()
+    if header.get('channels_last'):
+        to_channels_last(model)
+    return model.to(device).eval(), header['meta']
@@ -0,0 +1,310 @@
+"""A local server that runs a backend's model for many predict processes.
+
+Start it with:
+
+    FASTAI_MODEL_SERVER_AUTHKEY=<secret> \
+        python -m fastai_plugin.model_server <prediction_package_uri> \
+        --address /tmp/model.sock
+
+and point backends to it with with_predict_options(model_server=...), with the
+same key in FASTAI_MODEL_SERVER_AUTHKEY or in
+with_predict_options(model_server_authkey=...).
+
+Messages are pickled, so anyone who can connect can run code in the server.
+Connections are therefore authenticated with a key that is always required,
+TCP addresses default to the loopback interface, and Unix sockets are only
+accessible to their owner.
+"""
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from queue import Queue, Empty
+import argparse
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from fastai_plugin.inference import slice_outputs, outputs_to_cpu
+
+AUTHKEY_ENV = 'FASTAI_MODEL_SERVER_AUTHKEY'
+
+
+def parse_address(address):
+    """Parse a server address.
+
+    Args:
+        address: (str) either host:port for a TCP socket or the path of a
+            Unix socket. The host defaults to 127.0.0.1.
+
+    Returns:
+        address in the format used by multiprocessing.connection
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and '/' not in address and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def get_authkey(authkey=None):
+    """Return the key authenticating connections to a model server.
+
+    Args:
+        authkey: (str, bytes or None) the key, defaults to the
+            FASTAI_MODEL_SERVER_AUTHKEY environment variable
+
+    Returns:
+        (bytes) the key
+    """
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(
+            'A model server needs an authentication key, set {} or pass '
+            'one explicitly.'.format(AUTHKEY_ENV))
+    if isinstance(authkey, str):
+        authkey = authkey.encode('utf-8')
+    return authkey
+
+
+class _Request():
+    def __init__(self, chips):
+        if not (isinstance(chips, np.ndarray) and chips.ndim == 4
+                and len(chips)):
+            raise ValueError(
+                'Chips must be a non-empty array of shape '
+                '(batch_sz, height, width, nb_channels).')
+        self.chips = chips
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ModelServer():
+    """Serves predictions from a backend's model over a local socket.
+
+    Each connection is handled in its own thread, and a single batching
+    thread runs the model. Requests are coalesced into batches of at most
+    max_batch_sz chips, waiting at most max_wait seconds after the first
+    request of a batch for others to arrive. Only chips of the same shape are
+    batched together. If a batch fails, its requests are run one by one, so
+    that an error is only returned to the request that caused it.
+    """
+
+    def __init__(self, backend, address, authkey=None, max_batch_sz=32,
+                 max_wait=0.01):
+        """Constructor.
+
+        Args:
+            backend: backend with a loaded model, ie. load_model was called
+            address: (str) address to listen on, see parse_address
+            authkey: (str, bytes or None) key clients need to connect, see
+                get_authkey
+            max_batch_sz: (int) maximum number of chips in a batch
+            max_wait: (float) maximum seconds to wait for requests to fill a
+                batch
+        """
+        self.backend = backend
+        self.address = parse_address(address)
+        self.max_batch_sz = max_batch_sz
+        self.max_wait = max_wait
+        self.authkey = get_authkey(authkey)
+        self.requests = Queue()
+        self.deferred = deque()
+
+    def next_request(self, timeout=None):
+        if self.deferred:
+            return self.deferred.popleft()
+        try:
+            return self.requests.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def next_batch(self):
+        """Wait for a request and gather others to batch with it."""
+        batch = [self.next_request()]
+        nb_chips = len(batch[0].chips)
+        shape = batch[0].chips.shape[1:]
+        deferred = []
+        deadline = time.time() + self.max_wait
+        while nb_chips < self.max_batch_sz:
+            request = self.next_request(timeout=max(deadline - time.time(), 0))
+            if request is None:
+                break
+            if (request.chips.shape[1:] != shape
+                    or nb_chips + len(request.chips) > self.max_batch_sz):
+                deferred.append(request)
+                continue
+            batch.append(request)
+            nb_chips += len(request.chips)
+        self.deferred.extend(deferred)
+        return batch
+
+    def infer(self, batch):
+        chips = np.concatenate([request.chips for request in batch])
+        output = self.backend._infer(self.backend._preprocess(chips))
+        output = outputs_to_cpu(output)
+        start = 0
+        for request in batch:
+            end = start + len(request.chips)
+            request.output = slice_outputs(output, start, end)
+            start = end
+
+    def run_batch(self, batch):
+        try:
+            self.infer(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = repr(e)
+            else:
+                for request in batch:
+                    self.run_batch([request])
+        for request in batch:
+            request.done.set()
+
+    def batch_loop(self):
+        while True:
+            try:
+                batch = self.next_batch()
+            except Exception:
+                # Requests are checked when received, so this is a bug, but
+                # the clients still waiting need the batch thread alive.
+                traceback.print_exc()
+                continue
+            self.run_batch(batch)
+
+    def handle_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    conn.send(self.handle_message(msg))
+                except Exception as e:
+                    conn.send(('error', repr(e)))
+
+    def handle_message(self, msg):
+        if msg[0] == 'info':
+            return ('ok', self.backend.model_info)
+        if msg[0] == 'infer':
+            request = _Request(msg[1])
+            self.requests.put(request)
+            request.done.wait()
+            if request.error is not None:
+                return ('error', request.error)
+            return ('ok', request.output)
+        return ('error', 'Unknown request {}'.format(msg[0]))
+
+    def listen(self):
+        """Create the listener. Unix sockets are only accessible to their owner."""
+        if isinstance(self.address, tuple):
+            return Listener(self.address, authkey=self.authkey)
+        old_umask = os.umask(0o177)
+        try:
+            return Listener(self.address, authkey=self.authkey)
+        finally:
+            os.umask(old_umask)
+
+    def serve_forever(self):
+        threading.Thread(target=self.batch_loop, daemon=True).start()
+        with self.listen() as listener:
+            print('Model server listening on {}'.format(self.address))
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError) as e:
+                    # Eg. a client with the wrong key, or one that hung up.
+                    print('Rejected connection: {!r}'.format(e))
+                    continue
+                threading.Thread(
+                    target=self.handle_connection, args=(conn, ),
+                    daemon=True).start()
+
+
+class ModelClient():
+    """Thin client for ModelServer, usable from several threads."""
+
+    def __init__(self, address, authkey=None):
+        """Constructor.
+
+        Args:
+            address: (str) address of the server, see parse_address
+            authkey: (str, bytes or None) key of the server, see get_authkey
+        """
+        self.conn = Client(
+            parse_address(address), authkey=get_authkey(authkey))
+        self.lock = threading.Lock()
+
+    def request(self, *msg):
+        with self.lock:
+            self.conn.send(msg)
+            status, result = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError('Model server error: {}'.format(result))
+        return result
+
+    def info(self):
+        """Return the model_info of the backend of the server."""
+        return self.request('info')
+
+    def infer(self, chips):
+        """Run the model on a batch of chips.
+
+        Args:
+            chips: (numpy.ndarray) of shape
+                (batch_sz, height, width, nb_channels)
+
+        Returns:
+            output of the backend's model on the chips, on the CPU
+        """
+        return self.request('infer', chips)
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve predictions from the model of a prediction '
+        'package to local predict processes.')
+    parser.add_argument('prediction_package_uri')
+    parser.add_argument(
+        '--address', required=True,
+        help='host:port or path of a Unix socket to listen on. The host '
+        'defaults to 127.0.0.1.')
+    parser.add_argument(
+        '--authkey',
+        help='key clients need to connect, defaults to the {} environment '
+        'variable, which is safer as arguments are visible to other '
+        'users'.format(AUTHKEY_ENV))
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument(
+        '--max-wait', type=float, default=0.01,
+        help='maximum seconds to wait for requests to fill a batch')
+    args = parser.parse_args()
+    try:
+        authkey = get_authkey(args.authkey)
+    except ValueError as e:
+        parser.error(str(e))
+
+    import rastervision as rv
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        predictor = rv.Predictor(args.prediction_package_uri, tmp_dir)
+        backend_config = predictor.backend_config
+        # The server runs the model itself.
+        backend_config.backend_opts.model_server = None
+        backend = backend_config.create_backend(predictor.task_config)
+        backend.load_model(tmp_dir)
+        ModelServer(
+            backend, args.address, authkey=authkey,
+            max_batch_sz=args.max_batch_size,
+            max_wait=args.max_wait).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,25 +10,39 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from fastai.vision import (
-    ObjectItemList, bb_pad_collate, get_transforms, models,
-    Image, get_annotations)
-from fastai.callbacks import SaveModelCallback, CSVLogger, TrackEpochCallback
-from fastai.basic_train import load_learner, Learner
+from fastai.vision import bb_pad_collate, models, Image, get_annotations
+from fastai.callbacks import CSVLogger, TrackEpochCallback
+from fastai.basic_train import Learner
 
 from rastervision.utils.files import (
-    get_local_path, make_dir, upload_or_copy, list_paths,
-    download_if_needed, sync_from_dir, sync_to_dir, str_to_file,
-    json_to_file)
+    get_local_path, make_dir, upload_or_copy, list_paths, sync_from_dir,
+    sync_to_dir, str_to_file, json_to_file)
 from rastervision.utils.misc import save_img
 from rastervision.backend import Backend
 from rastervision.data import ObjectDetectionLabels
 
 from fastai_plugin.utils import (
-    SyncCallback, ExportCallback, MyCSVLogger, get_last_epoch,
-    Precision, Recall, FBeta, zipdir)
+    SyncCallback, MySaveModelCallback, ExportCallback, MyCSVLogger,
+    StepCheckpointCallback, TrainBudgetCallback, ValidationCallback,
+    DistributedCallback, budget_epochs, shard_batches, stratified_subset,
+    set_collate_fn, zipdir, class_map_meta, load_inference_model,
+    to_precision)
+from fastai_plugin.box_merge import merge_window_boxes
+from fastai_plugin.inference import (ChipPreprocessor, InferenceRunner,
+                                     model_dtype, is_channels_last)
+from fastai_plugin.pipeline import PredictPipeline, window_batches
+from fastai_plugin.predict import sum_labels
+from fastai_plugin.file_cache import get_file_cache, cached_download
+from fastai_plugin.model_server import ModelClient
+from fastai_plugin.quantize import quantize_export
+from fastai_plugin.augment import (ByteObjectItemList, BatchAugment,
+                                   augment_batches)
+from fastai_plugin.precision import get_precision
+from fastai_plugin.distributed import (
+    launch, is_distributed, is_main_process, is_local_main_process, barrier)
 from fastai_plugin.retinanet import (
-    create_body, RetinaNet, RetinaNetFocalLoss, retina_net_split,
+    create_body, RetinaNet, RetinaNetFocalLoss, RetinaNetTargetCollate,
+    MeanAveragePrecision, retina_net_split, model_output_sizes,
     get_predictions, show_results)
 
 
@@ -52,12 +66,128 @@ def make_debug_chips(data, class_map, tmp_dir, train_uri, debug_prob=1.0):
     _make_debug_chips('val')
 
 
+class DetectionAnnotations():
+    """Columnar store of the box annotations of a set of detection chips.
+
+    Boxes of all images are kept in one array, and the boxes of image i are
+    boxes[offsets[i]:offsets[i + 1]]. Boxes are in (ymin, xmin, ymax, xmax)
+    pixel coordinates relative to the chip. This is saved as a single .npz
+    file, which is much faster to write and read than COCO JSON.
+    """
+
+    def __init__(self, file_names, image_shapes, boxes, class_ids, offsets,
+                 category_ids, category_names):
+        self.file_names = np.asarray(file_names, dtype=str)
+        self.image_shapes = np.asarray(image_shapes, dtype=np.int32).reshape(
+            -1, 2)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.category_ids = np.asarray(category_ids, dtype=np.int32)
+        self.category_names = np.asarray(category_names, dtype=str)
+
+    @staticmethod
+    def from_chips(file_names, image_shapes, npboxes, class_ids, class_map):
+        """Build annotations from per-chip arrays.
+
+        Args:
+            file_names: list of chip file names
+            image_shapes: list of (height, width) of chips
+            npboxes: list of (n, 4) arrays of boxes in chip coordinates
+            class_ids: list of (n,) arrays of class ids
+            class_map: (rv.ClassMap) used to name the classes
+        """
+        offsets = np.cumsum([0] + [len(b) for b in npboxes])
+        items = class_map.get_items()
+        return DetectionAnnotations(
+            file_names, image_shapes,
+            np.concatenate(npboxes) if npboxes else [],
+            np.concatenate(class_ids) if class_ids else [], offsets,
+            [item.id for item in items], [item.name for item in items])
+
+    @staticmethod
+    def concat(annotations):
+        """Concatenate a list of DetectionAnnotations with the same classes."""
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for ann in annotations:
+            offsets.append(ann.offsets[1:] + offsets[-1][-1])
+        return DetectionAnnotations(
+            np.concatenate([a.file_names for a in annotations]),
+            np.concatenate([a.image_shapes for a in annotations]),
+            np.concatenate([a.boxes for a in annotations]),
+            np.concatenate([a.class_ids for a in annotations]),
+            np.concatenate(offsets), annotations[0].category_ids,
+            annotations[0].category_names)
+
+    def save(self, path):
+        np.savez(path, file_names=self.file_names,
+                 image_shapes=self.image_shapes, boxes=self.boxes,
+                 class_ids=self.class_ids, offsets=self.offsets,
+                 category_ids=self.category_ids,
+                 category_names=self.category_names)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as ann:
+            return DetectionAnnotations(
+                ann['file_names'], ann['image_shapes'], ann['boxes'],
+                ann['class_ids'], ann['offsets'], ann['category_ids'],
+                ann['category_names'])
+
+    def get_lbl_bbox(self):
+        """Return (file_names, lbl_bbox) like fastai's get_annotations."""
+        names = dict(zip(self.category_ids.tolist(),
+                         self.category_names.tolist()))
+        boxes = self.boxes.tolist()
+        class_names = [names[c] for c in self.class_ids.tolist()]
+        offsets = self.offsets.tolist()
+        lbl_bbox = [[boxes[start:end], class_names[start:end]]
+                    for start, end in zip(offsets[:-1], offsets[1:])]
+        return self.file_names.tolist(), lbl_bbox
+
+    def to_coco(self):
+        """Return the annotations as a COCO format dict for debugging."""
+        images = []
+        annotations = []
+        offsets = self.offsets.tolist()
+        for im_ind, (fn, (height, width)) in enumerate(
+                zip(self.file_names.tolist(), self.image_shapes.tolist())):
+            im_id = fn[:-len('.png')]
+            images.append({
+                'file_name': fn,
+                'id': im_id,
+                'height': height,
+                'width': width
+            })
+            start, end = offsets[im_ind], offsets[im_ind + 1]
+            for box_ind, (box, class_id) in enumerate(
+                    zip(self.boxes[start:end].tolist(),
+                        self.class_ids[start:end].tolist())):
+                bbox = [box[1], box[0], box[3]-box[1], box[2]-box[0]]
+                bbox = [int(i) for i in bbox]
+                annotations.append({
+                    'id': '{}-{}'.format(im_id, box_ind),
+                    'image_id': im_id,
+                    'bbox': bbox,
+                    'category_id': class_id
+                })
+        categories = [{'id': id, 'name': name} for id, name in zip(
+            self.category_ids.tolist(), self.category_names.tolist())]
+        return {
+            'images': images,
+            'annotations': annotations,
+            'categories': categories
+        }
+
+
 class ObjectDetectionBackend(Backend):
     def __init__(self, task_config, backend_opts, train_opts):
         self.task_config = task_config
         self.backend_opts = backend_opts
         self.train_opts = train_opts
-        self.inf_learner = None
+        self.model = None
+        self.client = None
+        self.cache = get_file_cache(backend_opts)
 
     def print_options(self):
         # TODO get logging to work for plugins
@@ -77,7 +207,9 @@ class ObjectDetectionBackend(Backend):
         """Process each scene's training data.
 
         This writes {scene_id}/{scene_id}-{ind}.png and
-        {scene_id}/{scene_id}-labels.json in COCO format.
+        {scene_id}/{scene_id}-labels.npz with DetectionAnnotations. In debug
+        mode, the annotations are also written to
+        {scene_id}/coco/{scene_id}-labels.json in COCO format.
 
         Args:
             scene: Scene
@@ -89,45 +221,33 @@ class ObjectDetectionBackend(Backend):
         """
 
         scene_dir = join(tmp_dir, str(scene.id))
-        labels_path = join(scene_dir, '{}-labels.json'.format(scene.id))
+        labels_path = join(scene_dir, '{}-labels.npz'.format(scene.id))
 
         make_dir(scene_dir)
-        images = []
-        annotations = []
-        categories = [{'id': item.id, 'name': item.name}
-                      for item in self.task_config.class_map.get_items()]
+        file_names = []
+        image_shapes = []
+        npboxes = []
+        class_ids = []
 
         for im_ind, (chip, window, labels) in enumerate(data):
-            im_id = '{}-{}'.format(scene.id, im_ind)
-            fn = '{}.png'.format(im_id)
+            fn = '{}-{}.png'.format(scene.id, im_ind)
             chip_path = join(scene_dir, fn)
             save_img(chip, chip_path)
-            images.append({
-                'file_name': fn,
-                'id': im_id,
-                'height': chip.shape[0],
-                'width': chip.shape[1]
-            })
-
-            npboxes = labels.get_npboxes()
-            npboxes = ObjectDetectionLabels.global_to_local(npboxes, window)
-            for box_ind, (box, class_id) in enumerate(
-                    zip(npboxes, labels.get_class_ids())):
-                bbox = [box[1], box[0], box[3]-box[1], box[2]-box[0]]
-                bbox = [int(i) for i in bbox]
-                annotations.append({
-                    'id': '{}-{}'.format(im_id, box_ind),
-                    'image_id': im_id,
-                    'bbox': bbox,
-                    'category_id': int(class_id)
-                })
-
-        coco_dict = {
-            'images': images,
-            'annotations': annotations,
-            'categories': categories
-        }
-        json_to_file(coco_dict, labels_path)
+            file_names.append(fn)
+            image_shapes.append(chip.shape[0:2])
+            npboxes.append(ObjectDetectionLabels.global_to_local(
+                labels.get_npboxes(), window))
+            class_ids.append(labels.get_class_ids())
+
+        annotations = DetectionAnnotations.from_chips(
+            file_names, image_shapes, npboxes, class_ids,
+            self.task_config.class_map)
+        annotations.save(labels_path)
+        if self.train_opts.debug:
+            coco_dir = join(scene_dir, 'coco')
+            make_dir(coco_dir)
+            json_to_file(annotations.to_coco(), join(
+                coco_dir, '{}-labels.json'.format(scene.id)))
 
         return scene_dir
 
@@ -138,9 +258,12 @@ class ObjectDetectionBackend(Backend):
         This writes a zip file for a group of scenes at {chip_uri}/{uuid}.zip
         containing:
         train/{scene_id}-{ind}.png
-        train/{scene_id}-labels.json
-        val/{scene_id}-{ind}.png
-        val/{scene_id}-labels.json
+        train/{uuid}-labels.npz
+        valid/{scene_id}-{ind}.png
+        valid/{uuid}-labels.npz
+
+        and in debug mode the COCO annotations of each scene in
+        train/coco/{scene_id}-labels.json and valid/coco/{scene_id}-labels.json.
 
         Args:
             training_results: dependent on the ml_backend's process_scene_data
@@ -156,98 +279,182 @@ class ObjectDetectionBackend(Backend):
 
         with zipfile.ZipFile(group_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
             def _write_zip(results, split):
+                annotations = []
                 for scene_dir in results:
-                    scene_paths = glob.glob(join(scene_dir, '*'))
-                    for p in scene_paths:
+                    for p in glob.glob(join(scene_dir, '*.png')):
                         zipf.write(p, join(split, basename(p)))
+                    for p in glob.glob(join(scene_dir, 'coco', '*.json')):
+                        zipf.write(p, join(split, 'coco', basename(p)))
+                    annotations.extend(
+                        DetectionAnnotations.load(p)
+                        for p in glob.glob(join(scene_dir, '*-labels.npz')))
+                if annotations:
+                    # Merge the scenes so training reads one file per group.
+                    labels_path = join(
+                        tmp_dir, '{}-{}-labels.npz'.format(split, group))
+                    DetectionAnnotations.concat(annotations).save(labels_path)
+                    zipf.write(labels_path,
+                               join(split, '{}-labels.npz'.format(group)))
             _write_zip(training_results, 'train')
             _write_zip(validation_results, 'valid')
 
         upload_or_copy(group_path, group_uri)
 
     def train(self, tmp_dir):
-        """Train a model."""
+        """Train a model.
+
+        With the train_workers option, this runs in that many processes
+        training in parallel (see fastai_plugin.distributed).
+        """
+        if self.backend_opts.train_workers and not is_distributed():
+            return launch(self.train, self.backend_opts.train_workers, tmp_dir,
+                          backend=self.backend_opts.dist_backend or 'gloo')
         self.print_options()
 
         # Sync output of previous training run from cloud.
         train_uri = self.backend_opts.train_uri
         train_dir = get_local_path(train_uri, tmp_dir)
-        make_dir(train_dir)
-        sync_from_dir(train_uri, train_dir)
-
-        # Get zip file for each group, and unzip them into chip_dir.
         chip_dir = join(tmp_dir, 'chips')
-        make_dir(chip_dir)
-        for zip_uri in list_paths(self.backend_opts.chip_uri, 'zip'):
-            zip_path = download_if_needed(zip_uri, tmp_dir)
-            with zipfile.ZipFile(zip_path, 'r') as zipf:
-                zipf.extractall(chip_dir)
+        # In distributed training, one process per machine gets the data.
+        if is_local_main_process():
+            make_dir(train_dir)
+            sync_from_dir(train_uri, train_dir)
+
+            # Get zip file for each group, and unzip them into chip_dir.
+            make_dir(chip_dir)
+            for zip_uri in list_paths(self.backend_opts.chip_uri, 'zip'):
+                zip_path = cached_download(zip_uri, tmp_dir, self.cache)
+                with zipfile.ZipFile(zip_path, 'r') as zipf:
+                    zipf.extractall(chip_dir)
+        barrier()
 
         # Setup data loader.
-        train_images = []
-        train_lbl_bbox = []
-        for annotation_path in glob.glob(join(chip_dir, 'train/*.json')):
-            images, lbl_bbox = get_annotations(annotation_path)
-            train_images += images
-            train_lbl_bbox += lbl_bbox
-
-        val_images = []
-        val_lbl_bbox = []
-        for annotation_path in glob.glob(join(chip_dir, 'valid/*.json')):
-            images, lbl_bbox = get_annotations(annotation_path)
-            val_images += images
-            val_lbl_bbox += lbl_bbox
-
-        images = train_images + val_images
-        lbl_bbox = train_lbl_bbox + val_lbl_bbox
+        images = []
+        lbl_bbox = []
+        for split in ['train', 'valid']:
+            for annotation_path in glob.glob(
+                    join(chip_dir, split, '*-labels.npz')):
+                split_images, split_lbl_bbox = DetectionAnnotations.load(
+                    annotation_path).get_lbl_bbox()
+                images += split_images
+                lbl_bbox += split_lbl_bbox
+            # Chips made before DetectionAnnotations have COCO files instead.
+            for annotation_path in glob.glob(join(chip_dir, split, '*.json')):
+                split_images, split_lbl_bbox = get_annotations(annotation_path)
+                images += split_images
+                lbl_bbox += split_lbl_bbox
 
         img2bbox = dict(zip(images, lbl_bbox))
         get_y_func = lambda o: img2bbox[o.name]
         num_workers = 0 if self.train_opts.debug else 4
-        data = ObjectItemList.from_folder(chip_dir)
+        data = ByteObjectItemList.from_folder(chip_dir)
         data = data.split_by_folder()
         data = data.label_from_func(get_y_func)
-        data = data.transform(
-            get_transforms(), size=self.task_config.chip_size, tfm_y=True)
         data = data.databunch(
-            bs=self.train_opts.batch_sz, collate_fn=bb_pad_collate,
-            num_workers=num_workers)
+            bs=self.train_opts.batch_sz, num_workers=num_workers)
+        # Chips and boxes are augmented together by batch.
+        augment_batches(data, self.task_config.chip_size, BatchAugment(),
+                        collate_fn=bb_pad_collate)
         print(data)
 
-        if self.train_opts.debug:
+        if self.train_opts.debug and is_main_process():
             make_debug_chips(
                 data, self.task_config.class_map, tmp_dir, train_uri)
 
         # Setup callbacks and train model.
-        ratios = [1/2, 1, 2]
-        scales = [1, 2**(-1/3), 2**(-2/3)]
+        ratios = self.train_opts.anchor_ratios
+        scales = self.train_opts.anchor_scales
         model_arch = getattr(models, self.train_opts.model_arch)
         encoder = create_body(model_arch, cut=-2)
-        model = RetinaNet(encoder, data.c, final_bias=-4)
+        model = RetinaNet(encoder, data.c, final_bias=-4,
+                          levels=self.train_opts.pyramid_levels,
+                          ratios=ratios, scales=scales)
         crit = RetinaNetFocalLoss(scales=scales, ratios=ratios)
-        learn = Learner(data, model, loss_func=crit, path=train_dir)
+
+        if self.train_opts.precompute_targets:
+            # Do anchor matching and box encoding in the dataloader workers
+            # instead of in the loss on the main process.
+            sizes = model_output_sizes(model, self.task_config.chip_size)
+            # This follows the augmentation, which moves the boxes.
+            for dl in [data.train_dl, data.valid_dl]:
+                set_collate_fn(dl, RetinaNetTargetCollate(
+                    sizes, ratios=ratios, scales=scales,
+                    collate_fn=dl.collate_fn))
+
+        # data.c counts the background class, which has no AP.
+        metrics = [
+            MeanAveragePrecision(data.c - 1, ratios=ratios, scales=scales)]
+        learn = Learner(data, model, loss_func=crit, metrics=metrics,
+                        path=train_dir)
         learn = learn.split(retina_net_split)
+        learn = to_precision(learn, get_precision(self.train_opts))
 
         model_path = get_local_path(self.backend_opts.model_uri, tmp_dir)
+        artifact_meta = {
+            'classes': list(data.classes),
+            'class_map': class_map_meta(self.task_config.class_map)
+        }
 
+        # Other processes get the weights of the main one when training begins.
         pretrained_uri = self.backend_opts.pretrained_uri
-        if pretrained_uri:
+        if pretrained_uri and is_main_process():
             print('Loading weights from pretrained_uri: {}'.format(
                 pretrained_uri))
-            pretrained_path = download_if_needed(pretrained_uri, tmp_dir)
+            pretrained_path = cached_download(pretrained_uri, tmp_dir, self.cache)
             learn.load(pretrained_path[:-4])
 
         callbacks = [
             TrackEpochCallback(learn),
-            SaveModelCallback(learn, every='epoch'),
-            MyCSVLogger(learn, filename='log'),
-            ExportCallback(learn, model_path),
-            SyncCallback(train_dir, self.backend_opts.train_uri,
-                         self.train_opts.sync_interval)
+            MySaveModelCallback(learn, every='epoch')
         ]
+        if is_main_process():
+            callbacks += [
+                MyCSVLogger(learn, filename='log'),
+                ExportCallback(
+                    learn, model_path, monitor='mean_average_precision',
+                    artifact_meta=artifact_meta,
+                    artifact_fp16=bool(self.backend_opts.artifact_fp16),
+                    graph_formats=self.backend_opts.export_graph_formats,
+                    simplify=self.backend_opts.export_simplify is not False),
+                SyncCallback(train_dir, self.backend_opts.train_uri,
+                             self.train_opts.sync_interval)
+            ]
+        if is_distributed():
+            callbacks.append(DistributedCallback(learn))
+        if self.train_opts.checkpoint_steps:
+            callbacks.append(StepCheckpointCallback(
+                learn, self.train_opts.checkpoint_steps,
+                sync_uri=self.backend_opts.train_uri))
+        num_epochs = self.train_opts.num_epochs
+        max_hours = self.train_opts.max_hours
+        max_steps = self.train_opts.max_steps
+        if max_hours or max_steps:
+            # The budget decides when to stop instead of num_epochs.
+            num_epochs = budget_epochs(shard_batches(data.train_dl), max_steps)
+            callbacks.append(TrainBudgetCallback(
+                learn, max_time=max_hours * 3600 if max_hours else None,
+                max_steps=max_steps))
+        validate_every = self.train_opts.validate_every or 1
+        valid_count = self.train_opts.valid_count
+        if validate_every > 1 or valid_count:
+            subset = None
+            if valid_count:
+                # Stratify by the rarest class in each chip.
+                label_sets = [y[1] for y in data.valid_ds.y.items]
+                subset = stratified_subset(label_sets, valid_count)
+            callbacks.append(
+                ValidationCallback(learn, validate_every, subset))
         learn.unfreeze()
-        learn.fit(self.train_opts.num_epochs, self.train_opts.lr,
-                  callbacks=callbacks)
+        learn.fit(num_epochs, self.train_opts.lr, callbacks=callbacks)
+
+        if not is_main_process():
+            return
+
+        if self.backend_opts.quantize:
+            quantize_export(
+                model_path, data.valid_dl, learn.loss_func,
+                mode=self.backend_opts.quantize,
+                nb_calib_batches=self.backend_opts.quantize_calib_batches)
 
         # Since model is exported every epoch, we need some other way to
         # show that training is finished.
@@ -258,13 +465,41 @@ class ObjectDetectionBackend(Backend):
 
     def load_model(self, tmp_dir):
         """Load the model in preparation for one or more prediction calls."""
-        if self.inf_learner is None:
+        if self.model is None and self.client is None:
             self.print_options()
-            model_uri = self.backend_opts.model_uri
-            model_path = download_if_needed(model_uri, tmp_dir)
-            self.inf_learner = load_learner(
-                dirname(model_path), basename(model_path))
-            self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+            self.pipeline = PredictPipeline(
+                self._preprocess, self._infer, self._window_boxes,
+                prefetch=self.backend_opts.predict_prefetch,
+                label_queue_size=self.backend_opts.predict_label_queue_size)
+            if self.backend_opts.model_server:
+                # The model runs in the server, see fastai_plugin.model_server.
+                self.client = ModelClient(
+                    self.backend_opts.model_server,
+                    authkey=self.backend_opts.model_server_authkey)
+                self.model_info = self.client.info()
+                return
+
+            # Quantized models only run on the CPU.
+            use_cuda = (torch.cuda.is_available()
+                        and not self.backend_opts.predict_quantized)
+            self.device = torch.device("cuda:0" if use_cuda else "cpu")
+            self.model = load_inference_model(
+                self.backend_opts.model_uri, tmp_dir, self.device,
+                engine=self.backend_opts.predict_engine,
+                quantized=bool(self.backend_opts.predict_quantized),
+                cache=self.cache, precision=get_precision(self.train_opts))
+            self.preprocessor = ChipPreprocessor(
+                self.device, model_dtype(self.model),
+                n_buffers=self.pipeline.n_buffers,
+                channels_last=is_channels_last(self.model))
+            mem_budget = self.backend_opts.predict_mem_mb
+            self.runner = InferenceRunner(
+                self.model,
+                mem_budget=mem_budget * 2**20 if mem_budget else None)
+            self.model_info = {
+                'ratios': self.model.ratios,
+                'scales': self.model.scales
+            }
 
     def predict(self, chips, windows, tmp_dir):
         """Return predictions for a chip using model.
@@ -332,16 +567,92 @@ class ObjectDetectionBackend(Backend):
 
         #####
 
-        labels = ObjectDetectionLabels.make_empty()
-        chips = torch.Tensor(chips).permute((0, 3, 1, 2)) / 255.
-        chips = chips.to(self.device)
-        model = self.inf_learner.model.eval()
+        return self._make_labels(
+            self._infer(self._preprocess(chips)), windows)
+
+    def predict_batches(self, batches, tmp_dir):
+        """Return predictions for batches of chips.
+
+        Unlike predict, this reads and preprocesses the next batches and makes
+        labels for the previous ones while the model runs, see
+        PredictPipeline.
+
+        Args:
+            batches: iterable of (chips, windows) as passed to predict, see
+                window_batches
+
+        Return:
+            generator of Labels objects, one per batch
+        """
+        return self._results_to_labels(self._batch_results(batches, tmp_dir))
 
-        output = model(chips)
+    def predict_scene(self, task, scene, tmp_dir):
+        """Return predictions for a scene, like Task.predict_scene.
+
+        Chips are read in batches of task.config.predict_batch_size and
+        passed to predict_batches, skipping empty ones.
+
+        Args:
+            task: Task the prediction is for
+            scene: activated Scene to predict on
 
-        for chip_ind, (chip, window) in enumerate(zip(chips, windows)):
+        Return:
+            Labels object containing predictions
+        """
+        raster_source = scene.raster_source
+        windows = task.get_predict_windows(raster_source.get_extent())
+        batches = self._window_batches(raster_source, windows,
+                                       task.config.predict_batch_size)
+        return self._scene_labels(task, scene,
+                                  self.predict_batches(batches, tmp_dir))
+
+    def _window_batches(self, raster_source, windows, batch_sz):
+        return window_batches(raster_source, windows, batch_sz,
+                              skip_empty=True)
+
+    def _batch_results(self, batches, tmp_dir):
+        self.load_model(tmp_dir)
+        return self.pipeline.run(batches)
+
+    def _results_to_labels(self, batch_boxes):
+        merge_thresh = self.backend_opts.window_merge_thresh
+        if merge_thresh is not None:
+            # Duplicates of objects seen by overlapping windows can be in
+            # any batch, so this waits for all of them.
+            return self._merge_batches(batch_boxes, merge_thresh)
+        return (self._boxes_to_labels(*b[:3]) for b in batch_boxes)
+
+    def _scene_labels(self, task, scene, batch_labels):
+        labels = sum_labels(batch_labels,
+                            scene.prediction_label_store.empty_labels())
+        return task.post_process_predictions(labels, scene)
+
+    def _preprocess(self, chips):
+        if self.client is not None:
+            # The server does the preprocessing.
+            return chips
+        # (batch_size, h, w, nchannels) --> (batch_size, nchannels, h, w)
+        return self.preprocessor(chips)
+
+    def _infer(self, x):
+        if self.client is not None:
+            return self.client.infer(x)
+        return self.runner(x)
+
+    def _window_boxes(self, output, windows):
+        """Return the boxes predicted for windows, in global coordinates.
+
+        Returns:
+            (boxes, class_ids, scores, window_ids) arrays, where window_ids
+                holds the (ymin, xmin) of the window of each box, which
+                identifies it within a scene
+        """
+        ratios, scales = self.model_info['ratios'], self.model_info['scales']
+        all_boxes, all_class_ids, all_scores, all_window_ids = [], [], [], []
+        for chip_ind, window in enumerate(windows):
             boxes, class_ids, scores = get_predictions(
-                output, chip_ind, detect_thresh=0.2)
+                output, chip_ind, detect_thresh=0.2, ratios=ratios,
+                scales=scales)
             if isinstance(boxes, torch.Tensor):
                 boxes = boxes.cpu()
                 class_ids = class_ids.cpu()
@@ -356,10 +667,47 @@ class ObjectDetectionBackend(Backend):
                 class_ids = class_ids.detach().numpy()
                 scores = scores.detach().numpy()
 
-                boxes = ObjectDetectionLabels.local_to_global(
-                    boxes, window)
-                class_ids = class_ids.astype(np.int32) + 1
-                labels = (labels + ObjectDetectionLabels(
-                    boxes, class_ids, scores=scores))
+                all_boxes.append(ObjectDetectionLabels.local_to_global(
+                    boxes, window))
+                all_class_ids.append(class_ids.astype(np.int32) + 1)
+                all_scores.append(scores)
+                all_window_ids.append(
+                    np.tile([window.ymin, window.xmin], (len(scores), 1)))
 
-        return labels
+        if not all_boxes:
+            return (np.empty((0, 4)), np.empty((0, ), dtype=np.int32),
+                    np.empty((0, )), np.empty((0, 2)))
+        return (np.concatenate(all_boxes), np.concatenate(all_class_ids),
+                np.concatenate(all_scores), np.concatenate(all_window_ids))
+
+    def _boxes_to_labels(self, boxes, class_ids, scores):
+        if len(boxes) == 0:
+            return ObjectDetectionLabels.make_empty()
+        return ObjectDetectionLabels(boxes, class_ids, scores=scores)
+
+    def _make_labels(self, output, windows):
+        return self._boxes_to_labels(*self._window_boxes(output, windows)[:3])
+
+    def _merge_batches(self, batch_boxes, merge_thresh):
+        """Merge the boxes of all batches of a scene, and make their labels.
+
+        Returns:
+            generator of Labels, one per batch
+        """
+        batch_boxes = list(batch_boxes)
+        if not batch_boxes:
+            return
+        boxes, class_ids, scores, window_ids = [
+            np.concatenate(arrays) for arrays in zip(*batch_boxes)]
+        # Number the windows from their (ymin, xmin).
+        window_ids = np.unique(window_ids, axis=0, return_inverse=True)[1]
+        keep = merge_window_boxes(
+            boxes, scores, class_ids, window_ids.reshape(-1),
+            iou_thresh=merge_thresh)
+        start = 0
+        for batch in batch_boxes:
+            end = start + len(batch[0])
+            inds = start + np.nonzero(keep[start:end])[0]
+            start = end
+            yield self._boxes_to_labels(
+                boxes[inds], class_ids[inds], scores[inds])
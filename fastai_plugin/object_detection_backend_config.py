@@ -2,8 +2,6 @@ from copy import deepcopy
 
 import rastervision as rv
 
-from fastai_plugin.object_detection_backend import (
-    ObjectDetectionBackend)
 from fastai_plugin.simple_backend_config import (
     SimpleBackendConfig, SimpleBackendConfigBuilder)
 
@@ -13,7 +11,11 @@ FASTAI_OBJECT_DETECTION = 'FASTAI_OBJECT_DETECTION'
 class TrainOptions():
     def __init__(self, batch_sz=None, weight_decay=None, lr=None,
                  num_epochs=None, model_arch=None, fp16=None,
-                 sync_interval=None, debug=None):
+                 sync_interval=None, debug=None, precompute_targets=None,
+                 pyramid_levels=None,
+                 anchor_ratios=None, anchor_scales=None,
+                 checkpoint_steps=None, max_hours=None, max_steps=None,
+                 validate_every=None, valid_count=None, precision=None):
         self.batch_sz = batch_sz
         self.weight_decay = weight_decay
         self.lr = lr
@@ -22,9 +24,21 @@ class TrainOptions():
         self.fp16 = fp16
         self.sync_interval = sync_interval
         self.debug = debug
+        self.precompute_targets = precompute_targets
+        self.pyramid_levels = pyramid_levels
+        self.anchor_ratios = anchor_ratios
+        self.anchor_scales = anchor_scales
+        self.checkpoint_steps = checkpoint_steps
+        self.max_hours = max_hours
+        self.max_steps = max_steps
+        self.validate_every = validate_every
+        self.valid_count = valid_count
+        self.precision = precision
 
     def __setattr__(self, name, value):
-        if name in ['batch_sz', 'num_epochs', 'sync_interval']:
+        if name in ['batch_sz', 'num_epochs', 'sync_interval',
+                    'checkpoint_steps', 'max_steps', 'validate_every',
+                    'valid_count']:
             value = int(value) if isinstance(value, float) else value
         super().__setattr__(name, value)
 
@@ -32,7 +46,8 @@ class TrainOptions():
 class ObjectDetectionBackendConfig(SimpleBackendConfig):
     train_opts_class = TrainOptions
     backend_type = FASTAI_OBJECT_DETECTION
-    backend_class = ObjectDetectionBackend
+    backend_class_path = (
+        'fastai_plugin.object_detection_backend.ObjectDetectionBackend')
 
 
 class SemanticSegmentationBackendConfigBuilder(SimpleBackendConfigBuilder):
@@ -50,12 +65,62 @@ class SemanticSegmentationBackendConfigBuilder(SimpleBackendConfigBuilder):
             model_arch='resnet18',
             fp16=False,
             sync_interval=1,
-            debug=False):
+            debug=False,
+            precompute_targets=False,
+            pyramid_levels=None,
+            anchor_ratios=[1 / 2, 1, 2],
+            anchor_scales=[1, 2**(-1 / 3), 2**(-2 / 3)],
+            checkpoint_steps=None,
+            max_hours=None,
+            max_steps=None,
+            validate_every=1,
+            valid_count=None,
+            precision=None):
+        """Set options for training models.
+
+        Args:
+            precompute_targets: (bool) match the anchors to the boxes of each
+                chip and encode the regression targets in the dataloader
+                workers (see RetinaNetTargetCollate), instead of in the loss
+                on the main process
+            pyramid_levels: list of feature pyramid levels (log2 of the stride)
+                to predict from, a subset of [2, 3, 5, 6, 7]. Defaults to all
+                of them.
+            anchor_ratios: aspect ratios of the anchors at each location
+            anchor_scales: scales of the anchors at each location
+            checkpoint_steps: (int or None) if set, save a checkpoint every
+                checkpoint_steps training steps, so that training can resume
+                from the middle of an epoch instead of from the last
+                completed epoch.
+            max_hours: (float or None) wall-clock time budget of training in
+                hours. If set, training stops when the budget is used up,
+                regardless of num_epochs.
+            max_steps: (int or None) maximum number of training steps
+                (batches). If set, training stops after max_steps steps,
+                regardless of num_epochs.
+            validate_every: (int) validate every validate_every epochs. The
+                last epoch is always validated.
+            valid_count: (int or None) if set, validate on a fixed subset of
+                about valid_count validation chips, stratified by the rarest
+                class in each chip. The full validation set is only used for
+                the last epoch and to confirm that a model is better before
+                exporting it.
+            precision: (str or None) precision to train and predict in,
+                'fp32', 'fp16' (CUDA only) or 'bf16' (CPU or CUDA, needs
+                torch >= 1.10). Defaults to 'fp16' if fp16 is True and 'fp32'
+                otherwise. See fastai_plugin.precision.
+        """
         b = deepcopy(self)
         b.train_opts = TrainOptions(
             batch_sz=batch_sz, weight_decay=weight_decay, lr=lr,
             num_epochs=num_epochs, model_arch=model_arch, fp16=fp16,
-            sync_interval=sync_interval, debug=debug)
+            sync_interval=sync_interval, debug=debug,
+            precompute_targets=precompute_targets,
+            pyramid_levels=pyramid_levels, anchor_ratios=anchor_ratios,
+            anchor_scales=anchor_scales, checkpoint_steps=checkpoint_steps,
+            max_hours=max_hours, max_steps=max_steps,
+            validate_every=validate_every, valid_count=valid_count,
+            precision=precision)
         return b
 
     def with_pretrained_uri(self, pretrained_uri):
@@ -0,0 +1,138 @@
+from contextlib import ExitStack
+from queue import Empty
+import multiprocessing
+import os
+import traceback
+
+import torch
+
+
+# Jobs of the current predict_parallel call. Workers are forked, so they
+# inherit them instead of having them (and their raster sources) pickled.
+_jobs = None
+
+
+def _worker(backend, tmp_dir, batch_sz, nb_threads, job_queue,
+            result_queue):
+    torch.set_num_threads(nb_threads)
+    while True:
+        job_ind = job_queue.get()
+        if job_ind is None:
+            return
+        try:
+            raster_source, windows = _jobs[job_ind]
+            with ExitStack() as stack:
+                if hasattr(raster_source, 'activate'):
+                    stack.enter_context(raster_source.activate())
+                batches = backend._window_batches(raster_source, windows,
+                                                  batch_sz)
+                results = list(backend._batch_results(batches, tmp_dir))
+            result_queue.put((job_ind, results, None))
+        except Exception:
+            result_queue.put((job_ind, None, traceback.format_exc()))
+
+
+def _terminate(workers):
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+
+
+def predict_parallel(backend, jobs, tmp_dir, batch_sz, nb_workers=None,
+                     nb_threads=None):
+    """Make predictions in worker processes sharing the model weights.
+
+    The model is loaded once, moved to shared memory, and then nb_workers
+    processes are forked, each using nb_threads threads for torch. Jobs are
+    handed out to the workers through a queue, so a slow scene doesn't hold
+    others up. This is meant for CPU predict nodes.
+
+    The workers are forked before this returns, so raster sources can be
+    activated by the caller while results are waited for. Workers activate
+    the raster source of each of their jobs themselves.
+
+    Args:
+        backend: backend to make predictions with
+        jobs: list of (raster_source, windows), eg. one per scene or per range
+            of windows of a large scene
+        tmp_dir: (str) temporary directory
+        batch_sz: (int) number of chips per batch
+        nb_workers: (int or None) number of processes, defaults to the
+            predict_workers backend option, or the number of CPUs
+        nb_threads: (int or None) number of torch threads per process,
+            defaults to the predict_worker_threads backend option, or the
+            number of CPUs divided by nb_workers
+
+    Returns:
+        generator of the list of batch results of each job, in the order of
+            jobs. Labels are made from them with the _results_to_labels method
+            of the backend.
+    """
+    global _jobs
+
+    backend_opts = backend.backend_opts
+    nb_cpus = os.cpu_count() or 1
+    nb_workers = nb_workers or backend_opts.predict_workers or nb_cpus
+    nb_threads = (nb_threads or backend_opts.predict_worker_threads
+                  or max(nb_cpus // nb_workers, 1))
+
+    backend.load_model(tmp_dir)
+    if backend.client is not None:
+        raise ValueError(
+            'Cannot use worker processes with a model server, as they would '
+            'share its connection.')
+    if backend.device.type == 'cuda':
+        raise ValueError('Worker processes can only be used on the CPU.')
+    backend.model.share_memory()
+
+    ctx = multiprocessing.get_context('fork')
+    job_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for job_ind in range(len(jobs)):
+        job_queue.put(job_ind)
+    for _ in range(nb_workers):
+        job_queue.put(None)
+
+    _jobs = jobs
+    workers = []
+    try:
+        for _ in range(nb_workers):
+            worker = ctx.Process(
+                target=_worker,
+                args=(backend, tmp_dir, batch_sz, nb_threads, job_queue,
+                      result_queue),
+                daemon=True)
+            worker.start()
+            workers.append(worker)
+    except BaseException:
+        _terminate(workers)
+        raise
+    finally:
+        _jobs = None
+
+    return _job_results(len(jobs), workers, result_queue)
+
+
+def _job_results(nb_jobs, workers, result_queue):
+    try:
+        results = {}
+        next_job_ind = 0
+        while next_job_ind < nb_jobs:
+            try:
+                job_ind, job_results, error = result_queue.get(timeout=1)
+            except Empty:
+                if any(worker.exitcode not in (None, 0)
+                       for worker in workers):
+                    raise RuntimeError('A prediction worker died.')
+                continue
+            if error is not None:
+                raise RuntimeError(
+                    'Prediction failed for job {}:\n{}'.format(job_ind, error))
+            results[job_ind] = job_results
+            while next_job_ind in results:
+                yield results.pop(next_job_ind)
+                next_job_ind += 1
+        for worker in workers:
+            worker.join()
+    finally:
+        _terminate(workers)
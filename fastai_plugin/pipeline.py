@@ -0,0 +1,192 @@
+from queue import Queue, Empty, Full
+import threading
+
+import numpy as np
+
+DEFAULT_PREFETCH = 2
+DEFAULT_LABEL_QUEUE_SIZE = 2
+
+# Marks the end of the items put in a queue.
+_DONE = object()
+
+
+class _Error():
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(queue, item, stop):
+    """Put item in queue, giving up if stop is set while waiting.
+
+    Returns:
+        True if item was put in the queue
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _get(queue, stop):
+    """Get an item from queue, returning _DONE if stop is set while waiting."""
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Empty:
+            pass
+    return _DONE
+
+
+def window_batches(raster_source, windows, batch_sz, skip_empty=False):
+    """Read chips for windows in batches.
+
+    Nothing is read until the batches are iterated over, so when used with
+    PredictPipeline, reading happens in its prefetch thread.
+
+    Args:
+        raster_source: RasterSource to read chips from
+        windows: list of Box
+        batch_sz: (int) number of chips per batch
+        skip_empty: (bool) leave out chips that are all zeros, as Raster
+            Vision's Task.predict_scene does. Batches are still filled up to
+            batch_sz chips.
+
+    Returns:
+        generator of (chips, windows) where chips is a (numpy.ndarray) of shape
+            (batch_sz, height, width, nb_channels)
+    """
+    batch_chips, batch_windows = [], []
+    for window in windows:
+        chip = raster_source.get_chip(window)
+        if skip_empty and not np.any(chip):
+            continue
+        batch_chips.append(chip)
+        batch_windows.append(window)
+        if len(batch_chips) == batch_sz:
+            yield np.array(batch_chips), batch_windows
+            batch_chips, batch_windows = [], []
+    if batch_chips:
+        yield np.array(batch_chips), batch_windows
+
+
+class PredictPipeline():
+    """Makes predictions with reading, inference and label making overlapped.
+
+    There are three stages, each in its own thread:
+    1. reading and preprocessing the next batches, at most prefetch of which
+       wait for the model,
+    2. running the model, in the calling thread,
+    3. making labels from the model output for the previous batches, at most
+       label_queue_size of which wait to be processed.
+
+    Torch releases the GIL while computing, so on CPU-only nodes the stages
+    run on different cores.
+    """
+
+    def __init__(self, preprocess, infer, make_labels, prefetch=None,
+                 label_queue_size=None):
+        """Constructor.
+
+        Args:
+            preprocess: function from a chips array to model input
+            infer: function from model input to model output
+            make_labels: function from model output and windows to Labels
+            prefetch: (int or None) number of batches to preprocess ahead
+            label_queue_size: (int or None) number of model outputs that can
+                wait to be turned into labels
+        """
+        self.preprocess = preprocess
+        self.infer = infer
+        self.make_labels = make_labels
+        self.prefetch = prefetch or DEFAULT_PREFETCH
+        self.label_queue_size = label_queue_size or DEFAULT_LABEL_QUEUE_SIZE
+
+    @property
+    def n_buffers(self):
+        """Number of preprocessed batches that can be in use at once."""
+        # The queued ones, the one being preprocessed and the one in the
+        # model.
+        return self.prefetch + 2
+
+    def run(self, batches):
+        """Make predictions for batches.
+
+        Args:
+            batches: iterable of (chips, windows), see window_batches
+
+        Returns:
+            generator of Labels, one per batch and in the same order
+        """
+        input_queue = Queue(self.prefetch)
+        output_queue = Queue(self.label_queue_size)
+        labels_queue = Queue()
+        stop = threading.Event()
+
+        def preprocess_stage():
+            try:
+                for chips, windows in batches:
+                    if not _put(input_queue,
+                                (self.preprocess(chips), windows), stop):
+                        return
+                _put(input_queue, _DONE, stop)
+            except BaseException as e:
+                _put(input_queue, _Error(e), stop)
+
+        def labels_stage():
+            try:
+                while True:
+                    item = _get(output_queue, stop)
+                    if item is _DONE:
+                        return
+                    labels_queue.put(self.make_labels(*item))
+            except BaseException as e:
+                labels_queue.put(_Error(e))
+                stop.set()
+
+        def get_labels(block):
+            while True:
+                try:
+                    labels = labels_queue.get(block=block)
+                except Empty:
+                    return
+                if isinstance(labels, _Error):
+                    raise labels.exc
+                yield labels
+                if block:
+                    return
+
+        threads = [
+            threading.Thread(target=preprocess_stage, daemon=True),
+            threading.Thread(target=labels_stage, daemon=True)
+        ]
+        for thread in threads:
+            thread.start()
+
+        nb_batches = 0
+        nb_labels = 0
+        try:
+            while True:
+                item = _get(input_queue, stop)
+                if item is _DONE:
+                    break
+                if isinstance(item, _Error):
+                    raise item.exc
+                x, windows = item
+                if not _put(output_queue, (self.infer(x), windows), stop):
+                    break
+                nb_batches += 1
+                for labels in get_labels(block=False):
+                    nb_labels += 1
+                    yield labels
+
+            while nb_labels < nb_batches:
+                for labels in get_labels(block=True):
+                    nb_labels += 1
+                    yield labels
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=1)
@@ -0,0 +1,103 @@
+"""Training and inference in reduced precision.
+
+The precision of a backend is one of PRECISIONS:
+- fp32: the model runs in fp32.
+- fp16: the model runs in fp16 on CUDA. For training, fastai's mixed
+  precision keeps fp32 master weights and scales the loss (see
+  utils.to_precision). CPUs have no fast fp16 kernels, so they fall back to
+  fp32 with a warning.
+- bf16: the model runs under torch.autocast in bfloat16, on the CPU as well
+  as on CUDA, and keeps fp32 weights. bfloat16 has the range of fp32, so
+  this needs no loss scaling. This requires torch >= 1.10, and is only
+  faster than fp32 on CPUs with bfloat16 instructions (AVX512-BF16 or AMX).
+
+In reduced precision, model outputs are converted to fp32 before computing
+losses and making predictions from them.
+"""
+import warnings
+
+import torch
+
+from fastai_plugin.graph_export import MODEL_ATTRS
+
+PRECISIONS = ['fp32', 'fp16', 'bf16']
+
+
+def get_precision(train_opts):
+    """Return the precision set in train_opts.
+
+    The precision option defaults to the older fp16 option.
+    """
+    precision = getattr(train_opts, 'precision', None)
+    if precision is None:
+        precision = 'fp16' if train_opts.fp16 else 'fp32'
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}.'.format(precision))
+    return precision
+
+
+def autocast(device_type, dtype=torch.bfloat16):
+    """Return the torch.autocast context for device_type ('cpu' or 'cuda')."""
+    if not hasattr(torch, 'autocast'):
+        raise ValueError('bf16 requires torch >= 1.10.')
+    return torch.autocast(device_type, dtype=dtype)
+
+
+def float_outputs(output):
+    """Convert the floating point tensors in a model output to fp32."""
+    if isinstance(output, torch.Tensor):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, (list, tuple)):
+        return type(output)(float_outputs(o) for o in output)
+    return output
+
+
+def fp16_device(device):
+    """Return whether fp16 is used on device, warning if it isn't."""
+    if device.type == 'cuda':
+        return True
+    warnings.warn('fp16 is only used on CUDA, using fp32 on the CPU.')
+    return False
+
+
+class AutocastModel():
+    """Runs a model under torch.autocast and returns fp32 outputs.
+
+    Like GraphModel, this has the attributes of the model used to interpret
+    its output.
+    """
+
+    def __init__(self, model, dtype=torch.bfloat16):
+        self.model = model
+        self.dtype = dtype
+        for k in MODEL_ATTRS:
+            if hasattr(model, k):
+                setattr(self, k, getattr(model, k))
+
+    def parameters(self):
+        return self.model.parameters()
+
+    def modules(self):
+        return self.model.modules()
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def share_memory(self):
+        self.model.share_memory()
+        return self
+
+    def __call__(self, x):
+        with autocast(x.device.type, self.dtype):
+            output = self.model(x)
+        return float_outputs(output)
+
+
+def to_inference_precision(model, precision, device):
+    """Set up a model (on device) to make predictions in precision."""
+    if precision == 'bf16':
+        return AutocastModel(model.float())
+    if precision == 'fp16' and fp16_device(device):
+        return model.half()
+    return model.float()
@@ -0,0 +1,126 @@
+"""Prediction over whole scenes for the backends of this plugin.
+
+Raster Vision's Task.predict hands chips to Backend.predict one batch at a
+time. The backends of this plugin instead have a predict_scene method, which
+reads chips and makes labels while the model runs (see
+pipeline.PredictPipeline), and which sees all the windows of a scene. The hook
+installed by install_predict_hook makes Task.predict call predict_scenes for
+these backends.
+
+With the predict_workers backend option, the scenes are instead predicted in
+worker processes sharing the model, see parallel.predict_parallel.
+"""
+from functools import wraps
+import logging
+
+from rastervision.task import Task
+
+from fastai_plugin.parallel import predict_parallel
+
+log = logging.getLogger(__name__)
+
+# Task.predict from Raster Vision, once the hook is installed.
+_task_predict = None
+
+
+def install_predict_hook():
+    """Make Task.predict use predict_scenes for backends with predict_scene.
+
+    Other backends keep using Task.predict from Raster Vision. This does
+    nothing if the hook is already installed.
+    """
+    global _task_predict
+    if _task_predict is not None:
+        return
+    _task_predict = Task.predict
+
+    @wraps(_task_predict)
+    def predict(task, scenes, tmp_dir):
+        if hasattr(task.backend, 'predict_scene'):
+            return predict_scenes(task, scenes, tmp_dir)
+        return _task_predict(task, scenes, tmp_dir)
+
+    Task.predict = predict
+
+
+def predict_scenes(task, scenes, tmp_dir):
+    """Make predictions for scenes, like Task.predict.
+
+    The predictions are saved to the prediction_label_store in each scene.
+
+    Args:
+        task: Task whose backend has a predict_scene method
+        scenes: list of Scenes
+        tmp_dir: (str) temporary directory
+    """
+    backend = task.backend
+    backend.load_model(tmp_dir)
+    scene_results = None
+    if backend.backend_opts.predict_workers:
+        scene_results = _predict_parallel(task, scenes, tmp_dir)
+
+    for scene in scenes:
+        with scene.activate():
+            log.info('Making predictions for scene')
+            if scene_results is None:
+                labels = backend.predict_scene(task, scene, tmp_dir)
+            else:
+                labels = backend._scene_labels(
+                    task, scene,
+                    backend._results_to_labels(next(scene_results)))
+            scene.prediction_label_store.save(labels)
+
+            if task.config.debug and task.config.predict_debug_uri:
+                task.save_debug_predict_image(scene,
+                                              task.config.predict_debug_uri)
+
+
+def _predict_parallel(task, scenes, tmp_dir):
+    """Make predictions for scenes in worker processes.
+
+    Returns:
+        generator of the list of batch results of each scene, in order
+    """
+    backend = task.backend
+    nb_workers = backend.backend_opts.predict_workers
+    # With fewer scenes than workers, scenes are split into ranges of
+    # windows to keep all the workers busy.
+    nb_ranges = -(-nb_workers // max(len(scenes), 1))
+    jobs = []
+    scene_nb_jobs = []
+    for scene in scenes:
+        raster_source = scene.raster_source
+        windows = task.get_predict_windows(raster_source.get_extent())
+        range_sz = max(-(-len(windows) // nb_ranges), 1)
+        for start in range(0, len(windows), range_sz):
+            jobs.append((raster_source, windows[start:start + range_sz]))
+        scene_nb_jobs.append(-(-len(windows) // range_sz))
+
+    # Workers are forked here, before any scene is activated.
+    job_results = predict_parallel(backend, jobs, tmp_dir,
+                                   task.config.predict_batch_size)
+
+    def _scene_results():
+        for nb_jobs in scene_nb_jobs:
+            results = []
+            for _ in range(nb_jobs):
+                results.extend(next(job_results))
+            yield results
+
+    return _scene_results()
+
+
+def sum_labels(labels, empty_labels):
+    """Add up the labels of the batches of a scene.
+
+    Args:
+        labels: iterable of Labels
+        empty_labels: Labels to start from, eg. from the empty_labels method
+            of the prediction label store
+
+    Returns:
+        Labels
+    """
+    for batch_labels in labels:
+        empty_labels = empty_labels + batch_labels
+    return empty_labels
@@ -0,0 +1,217 @@
+"""Post-training INT8 quantization of exported models for CPU inference.
+
+Two modes are supported:
+- dynamic: the weights of Linear layers are quantized ahead of time and
+  their activations on the fly. This needs no calibration, but only helps
+  models with large Linear layers, like the head of chip classifiers.
+- static: Conv2d layers run in INT8, with activation ranges calibrated on
+  validation chips. Each convolution quantizes its input and dequantizes its
+  output, so this works with any model structure (fastai hooks, residual
+  additions), at the cost of a conversion around every convolution.
+
+Quantized models are traced and saved with TorchScript next to the exported
+model, along with a report of the accuracy delta on the validation split
+which doubles as their graph_engine metadata (see quantized_uri and
+quantization_report_uri). This requires torch >= 1.3.
+"""
+import copy
+import json
+
+import torch
+from torch import nn
+
+from fastai_plugin.model_artifact import load_model_artifact
+from fastai_plugin.uris import (artifact_uri, quantized_uri,
+                                quantization_report_uri)
+from fastai_plugin.graph_engine import benchmark, load_graph_model
+from fastai_plugin.graph_export import (MODEL_ATTRS, TensorOutputs,
+                                        output_template)
+
+QUANTIZE_MODES = ['dynamic', 'static']
+
+
+def _quantization():
+    if not hasattr(torch, 'quantization'):
+        raise ValueError('Quantization requires torch >= 1.3.')
+    return torch.quantization
+
+
+def _select_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise ValueError('No quantized engine is supported on this machine.')
+
+
+class QuantizedConv(nn.Module):
+    """Runs a convolution in INT8 between float inputs and outputs."""
+
+    def __init__(self, conv):
+        super().__init__()
+        tq = _quantization()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def _wrap_convs(module):
+    """Wrap the Conv2d layers of module in QuantizedConv, return how many."""
+    nb_wrapped = 0
+    for name, child in module.named_children():
+        if type(child) == nn.Conv2d and child.padding_mode == 'zeros':
+            setattr(module, name, QuantizedConv(child))
+            nb_wrapped += 1
+        else:
+            nb_wrapped += _wrap_convs(child)
+    return nb_wrapped
+
+
+def argmax_accuracy(output, y):
+    """Fraction of predictions (argmax over dim 1) equal to the targets.
+
+    This works for both chip classification and semantic segmentation.
+    """
+    pred = output.argmax(dim=1)
+    return (pred == y.view(pred.shape)).float().mean()
+
+
+def _to_cpu(b):
+    if isinstance(b, (list, tuple)):
+        return type(b)(_to_cpu(o) for o in b)
+    if isinstance(b, torch.Tensor):
+        return b.cpu().float() if b.is_floating_point() else b.cpu()
+    return b
+
+
+def cpu_batches(dl, nb_batches=None):
+    """Yield up to nb_batches batches (x, y) of dl on the CPU."""
+    for i, (x, y) in enumerate(dl):
+        if nb_batches is not None and i >= nb_batches:
+            return
+        yield _to_cpu(x), _to_cpu(y)
+
+
+def quantize_model(model, mode='static', calib_batches=None):
+    """Return an INT8 copy of a model.
+
+    Args:
+        model: (nn.Module) float model
+        mode: (str) one of QUANTIZE_MODES
+        calib_batches: iterable of (x, y) batches on the CPU to calibrate
+            activation ranges on, required by static quantization
+
+    Returns:
+        (model, nb_quantized_layers) with the model on the CPU in eval mode
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError('Unknown quantization mode {}.'.format(mode))
+    tq = _quantization()
+    _select_engine()
+    model = copy.deepcopy(model).float().cpu().eval()
+
+    if mode == 'dynamic':
+        nb_layers = sum(type(m) == nn.Linear for m in model.modules())
+        model = tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        return model, nb_layers
+
+    if calib_batches is None:
+        raise ValueError('Static quantization requires calib_batches.')
+    nb_layers = _wrap_convs(model)
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    # Only the wrapped convolutions (and their stubs) inherit the qconfig.
+    model.qconfig = None
+    for m in model.modules():
+        if isinstance(m, QuantizedConv):
+            m.qconfig = qconfig
+    tq.prepare(model, inplace=True)
+    with torch.no_grad():
+        for x, _ in calib_batches:
+            model(x)
+    tq.convert(model, inplace=True)
+    return model, nb_layers
+
+
+def evaluate(model, batches, loss_func, metric=None):
+    """Return the mean loss (and metric) of a model over batches."""
+    losses, metrics = [], []
+    with torch.no_grad():
+        for x, y in batches:
+            ys = y if isinstance(y, (list, tuple)) else [y]
+            output = model(x)
+            losses.append(float(loss_func(output, *ys)))
+            if metric is not None:
+                metrics.append(float(metric(output, *ys)))
+    results = {'loss': sum(losses) / max(len(losses), 1)}
+    if metric is not None:
+        results['accuracy'] = sum(metrics) / max(len(metrics), 1)
+    return results
+
+
+def quantize_export(model_path, valid_dl, loss_func, mode='static',
+                    nb_calib_batches=8, metric=None):
+    """Quantize an exported model and record its accuracy delta.
+
+    The float model is loaded from the inference artifact at model_path, so
+    this quantizes the best model exported during training. Static
+    quantization is calibrated on the first nb_calib_batches batches of
+    valid_dl. Both models are then evaluated on all of valid_dl on the CPU.
+
+    Args:
+        model_path: (str) path of the exported fastai model
+        valid_dl: validation DataLoader
+        loss_func: loss function of the Learner
+        mode: (str) one of QUANTIZE_MODES
+        nb_calib_batches: (int) number of batches to calibrate on
+        metric: function of (output, *y) to report besides the loss, eg.
+            argmax_accuracy
+
+    Returns:
+        (dict) the report, also written to quantization_report_uri(model_path)
+    """
+    model = load_model_artifact(artifact_uri(model_path))[0]
+    qmodel, nb_layers = quantize_model(
+        model, mode, calib_batches=cpu_batches(valid_dl, nb_calib_batches))
+
+    float_results = evaluate(model, cpu_batches(valid_dl), loss_func, metric)
+    int8_results = evaluate(qmodel, cpu_batches(valid_dl), loss_func, metric)
+    x, _ = next(cpu_batches(valid_dl, 1))
+    report = {
+        'mode': mode,
+        'engine': torch.backends.quantized.engine,
+        'nb_quantized_layers': nb_layers,
+        'float': float_results,
+        'int8': int8_results,
+        'delta': {k: int8_results[k] - float_results[k]
+                  for k in float_results},
+        'latency_ms': {
+            'float': benchmark(model, x, nb_runs=3, nb_warmup=1),
+            'int8': benchmark(qmodel, x, nb_runs=3, nb_warmup=1)
+        },
+        'attrs': {k: getattr(model, k) for k in MODEL_ATTRS
+                  if hasattr(model, k)}
+    }
+
+    with torch.no_grad():
+        report['output'] = output_template(qmodel, x)
+        trace_x = torch.cat([x[:1], x[:1]])
+        traced = torch.jit.trace(
+            TensorOutputs(qmodel), trace_x, check_trace=False)
+    traced.save(quantized_uri(model_path))
+    with open(quantization_report_uri(model_path), 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Quantized {} layers ({}). Validation float: {}, int8: {}. CPU '
+          'latency (ms): {}'.format(nb_layers, mode, float_results,
+                                     int8_results, report['latency_ms']))
+    return report
+
+
+def load_quantized_model(path, report_path):
+    """Load a model saved by quantize_export as a GraphModel on the CPU."""
+    _quantization()
+    _select_engine()
+    return load_graph_model(path, report_path, fmt='torchscript')
@@ -1,4 +1,4 @@
-from fastai.vision.models.unet import _get_sfs_idxs, model_sizes, hook_outputs
+from fastai.vision.models.unet import _get_sfs_idxs, model_sizes
 from fastai.vision import *
 
 ratios = [1/2, 1, 2]
@@ -6,32 +6,65 @@ scales = [1, 2**(-1/3), 2**(-2/3)]
 
 
 class LateralUpsampleMerge(nn.Module):
-    "Merge the features coming from the downsample path (in `hook`) with the upsample path."
-    def __init__(self, ch, ch_lat, hook):
+    "Merge the features coming from the downsample path (`lat`, or in `hook`) with the upsample path."
+    def __init__(self, ch, ch_lat, hook=None):
         super().__init__()
         self.hook = hook
         self.conv_lat = conv2d(ch_lat, ch, ks=1, bias=True)
 
-    def forward(self, x):
-        return self.conv_lat(self.hook.stored) + F.interpolate(x, self.hook.stored.shape[-2:], mode='nearest')
+    def forward(self, x, lat=None):
+        if lat is None: lat = self.hook.stored
+        return self.conv_lat(lat) + F.interpolate(x, lat.shape[-2:], mode='nearest')
 
 
 class RetinaNet(nn.Module):
-    "Implements RetinaNet from https://arxiv.org/abs/1708.02002"
-    def __init__(self, encoder:nn.Module, n_classes, final_bias=0., chs=256, n_anchors=9, flatten=True):
+    """Implements RetinaNet from https://arxiv.org/abs/1708.02002
+
+    The pyramid features are identified by their level, the log2 of their stride. The
+    lateral merges produce levels 3 and 2 (in that output order, the upsampling path goes
+    through level 2), followed by levels 5, 6 and 7 computed from the last encoder
+    features. `levels` selects the levels used for predictions. Levels that are not
+    selected and not needed to compute a selected one are not built at all.
+    `ratios` and `scales` define the anchors at each location.
+
+    The last output holds the sizes of the feature maps. With `tensor_sizes` they are returned as a
+    tensor instead of a list, so that a traced graph computes them from its input.
+    """
+    # Defaults for models that were pickled before these were configurable.
+    ratios, scales, levels = ratios, scales, None
+    n_lateral, out_idxs, smooth_idxs = 2, None, [0, 1, 2]
+    lat_idxs, tensor_sizes = None, False
+
+    def __init__(self, encoder:nn.Module, n_classes, final_bias=0., chs=256, n_anchors=None, flatten=True,
+                 levels:Collection[int]=None, ratios:Collection[float]=None, scales:Collection[float]=None):
         super().__init__()
         self.n_classes,self.flatten = n_classes,flatten
+        self.ratios,self.scales = list(ifnone(ratios, RetinaNet.ratios)),list(ifnone(scales, RetinaNet.scales))
+        n_anchors = ifnone(n_anchors, len(self.ratios) * len(self.scales))
         imsize = (256,256)
         sfs_szs = model_sizes(encoder, size=imsize)
         sfs_idxs = list(reversed(_get_sfs_idxs(sfs_szs)))
-        self.sfs = hook_outputs([encoder[i] for i in sfs_idxs])
         self.encoder = encoder
+        # Encoder layers whose outputs feed the lateral merges, from the top of the pyramid down.
+        self.lat_idxs = lat_idxs = [int(i) for i in sfs_idxs[-2:-4:-1]]
+        # Level of each output in the full pyramid, in output order.
+        level = lambda sz: int(round(math.log2(imsize[0] / sz[-1])))
+        c5_level = level(sfs_szs[-1])
+        all_levels = [level(sfs_szs[idx]) for idx in reversed(lat_idxs)] + [c5_level, c5_level+1, c5_level+2]
+        self.levels = list(ifnone(levels, all_levels))
+        if not self.levels or not set(self.levels) <= set(all_levels):
+            raise ValueError(f'levels must be a non-empty subset of {all_levels}, got {self.levels}.')
+        self.n_lateral = len(lat_idxs)
+        self.out_idxs = [i for i,l in enumerate(all_levels) if l in self.levels]
+        # The merges are chained from the top, so the lowest selected merge needs all those before it.
+        n_merges = max(self.n_lateral - min(self.out_idxs), 0)
         self.c5top5 = conv2d(sfs_szs[-1][1], chs, ks=1, bias=True)
-        self.c5top6 = conv2d(sfs_szs[-1][1], chs, stride=2, bias=True)
-        self.p6top7 = nn.Sequential(nn.ReLU(), conv2d(chs, chs, stride=2, bias=True))
-        self.merges = nn.ModuleList([LateralUpsampleMerge(chs, sfs_szs[idx][1], hook)
-                                     for idx,hook in zip(sfs_idxs[-2:-4:-1], self.sfs[-2:-4:-1])])
-        self.smoothers = nn.ModuleList([conv2d(chs, chs, 3, bias=True) for _ in range(3)])
+        self.c5top6 = conv2d(sfs_szs[-1][1], chs, stride=2, bias=True) if max(self.out_idxs) > self.n_lateral else None
+        self.p6top7 = (nn.Sequential(nn.ReLU(), conv2d(chs, chs, stride=2, bias=True))
+                       if max(self.out_idxs) > self.n_lateral+1 else None)
+        self.merges = nn.ModuleList([LateralUpsampleMerge(chs, sfs_szs[idx][1]) for idx in lat_idxs[:n_merges]])
+        self.smooth_idxs = [i for i in range(3) if i in self.out_idxs]
+        self.smoothers = nn.ModuleList([conv2d(chs, chs, 3, bias=True) for _ in self.smooth_idxs])
         self.classifier = self._head_subnet(n_classes, n_anchors, final_bias, chs=chs)
         self.box_regressor = self._head_subnet(4, n_anchors, 0., chs=chs)
 
@@ -53,19 +86,44 @@ class RetinaNet(nn.Module):
         else:
             return torch.cat([func(p).permute(0,2,3,1).contiguous().view(p.size(0),-1,n_classes) for p in p_states],1)
 
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self.lat_idxs is None and getattr(self, 'sfs', None) is not None: self._remove_hooks()
+
+    def _remove_hooks(self):
+        "Switch a model pickled with hooks on its encoder over to the hook-free forward."
+        layers = list(self.encoder.children())
+        layer_idx = lambda hook: next(i for i,l in enumerate(layers) if hook.hook.id in l._forward_hooks)
+        self.lat_idxs = [layer_idx(merge.hook) for merge in self.merges]
+        self.sfs.remove()
+        del self.sfs
+        for merge in self.merges: merge.hook = None
+
+    def _encode(self, x):
+        "Run the encoder, returning its output and the lateral features used by `self.merges`."
+        lat_idxs, lats = self.lat_idxs[:len(self.merges)], {}
+        for i,layer in enumerate(self.encoder.children()):
+            x = layer(x)
+            # Detached, as the hooks this replaces stored them.
+            if i in lat_idxs: lats[i] = x.detach()
+        return x, [lats[i] for i in lat_idxs]
+
     def forward(self, x):
-        c5 = self.encoder(x)
-        p_states = [self.c5top5(c5.clone()), self.c5top6(c5)]
-        p_states.append(self.p6top7(p_states[-1]))
-        for merge in self.merges: p_states = [merge(p_states[0])] + p_states
-        for i, smooth in enumerate(self.smoothers[:3]):
-            p_states[i] = smooth(p_states[i])
+        c5, lats = self._encode(x)
+        p_states = [self.c5top5(c5.clone())]
+        for merge,lat in zip(self.merges, lats): p_states = [merge(p_states[0], lat)] + p_states
+        if self.c5top6 is not None: p_states.append(self.c5top6(c5))
+        if self.p6top7 is not None: p_states.append(self.p6top7(p_states[-1]))
+        # p_states[0] is at position `offset` of the full pyramid when lower merges are not built.
+        offset = self.n_lateral - len(self.merges)
+        for i, smooth in zip(self.smooth_idxs, self.smoothers):
+            p_states[i-offset] = smooth(p_states[i-offset])
+        p_states = [p_states[i-offset] for i in ifnone(self.out_idxs, range(len(p_states)))]
+        if self.tensor_sizes: sizes = torch.stack([torch._shape_as_tensor(p)[2:] for p in p_states])
+        else: sizes = [[p.size(2), p.size(3)] for p in p_states]
         return [self._apply_transpose(self.classifier, p_states, self.n_classes),
                 self._apply_transpose(self.box_regressor, p_states, 4),
-                [[p.size(2), p.size(3)] for p in p_states]]
-
-    def __del__(self):
-        if hasattr(self, "sfs"): self.sfs.remove()
+                sizes]
 
 
 def create_grid(size):
@@ -113,31 +171,72 @@ def cthw2tlbr(boxes):
 
 
 
+# Upper bound in bytes on the `anchors x targets` temporaries created by the
+# IoU functions below. Targets are processed in chunks that fit this budget, so
+# peak memory does not grow with the number of objects in a chip.
+iou_mem_budget = 32 * 2**20
+
+
+def _target_chunk_size(n_anchors, element_size, mem_budget=None):
+    "Number of targets per chunk so the `a x chunk` IoU temporaries fit in `mem_budget` bytes."
+    mem_budget = ifnone(mem_budget, iou_mem_budget)
+    # intersection keeps up to 4 live `a x chunk` tensors (both extents, area and union).
+    return max(1, mem_budget // (4 * element_size * max(n_anchors, 1)))
+
+
 def intersection(anchors, targets):
     "Compute the sizes of the intersections of `anchors` by `targets`."
     ancs, tgts = cthw2tlbr(anchors), cthw2tlbr(targets)
-    a, t = ancs.size(0), tgts.size(0)
-    ancs, tgts = ancs.unsqueeze(1).expand(a,t,4), tgts.unsqueeze(0).expand(a,t,4)
-    top_left_i = torch.max(ancs[...,:2], tgts[...,:2])
-    bot_right_i = torch.min(ancs[...,2:], tgts[...,2:])
-    sizes = torch.clamp(bot_right_i - top_left_i, min=0)
-    return sizes[...,0] * sizes[...,1]
+    # Broadcast one coordinate at a time so no `a x t x 4` tensor is created.
+    h = torch.clamp(torch.min(ancs[:,None,2], tgts[None,:,2]) - torch.max(ancs[:,None,0], tgts[None,:,0]), min=0)
+    w = torch.clamp(torch.min(ancs[:,None,3], tgts[None,:,3]) - torch.max(ancs[:,None,1], tgts[None,:,1]), min=0)
+    return h.mul_(w)
 
 
-def IoU_values(anchors, targets):
-    "Compute the IoU values of `anchors` by `targets`."
+def _IoU_chunk(anchors, anc_sz, targets):
+    "IoU of `anchors` (with precomputed areas `anc_sz`) by a chunk of `targets`."
     inter = intersection(anchors, targets)
-    anc_sz, tgt_sz = anchors[:,2] * anchors[:,3], targets[:,2] * targets[:,3]
+    tgt_sz = targets[:,2] * targets[:,3]
     union = anc_sz.unsqueeze(1) + tgt_sz.unsqueeze(0) - inter
     return inter/(union+1e-8)
 
 
+def IoU_values(anchors, targets, mem_budget=None):
+    "Compute the IoU values of `anchors` by `targets`, processing `targets` in chunks."
+    a, t = anchors.size(0), targets.size(0)
+    anc_sz = anchors[:,2] * anchors[:,3]
+    chunk = _target_chunk_size(a, anchors.element_size(), mem_budget)
+    if t <= chunk: return _IoU_chunk(anchors, anc_sz, targets)
+    ious = anchors.new_empty(a, t)
+    for i in range(0, t, chunk):
+        ious[:,i:i+chunk] = _IoU_chunk(anchors, anc_sz, targets[i:i+chunk])
+    return ious
+
+
+def IoU_max(anchors, targets, mem_budget=None):
+    """Return the max IoU of each of `anchors` over `targets` and the index of that target.
+
+    Equivalent to `IoU_values(anchors, targets).max(1)` but only a running max and
+    argmax are kept, so the full `a x t` matrix is never materialized.
+    """
+    a, t = anchors.size(0), targets.size(0)
+    anc_sz = anchors[:,2] * anchors[:,3]
+    chunk = _target_chunk_size(a, anchors.element_size(), mem_budget)
+    vals, idxs = _IoU_chunk(anchors, anc_sz, targets[:chunk]).max(1)
+    for i in range(chunk, t, chunk):
+        c_vals, c_idxs = _IoU_chunk(anchors, anc_sz, targets[i:i+chunk]).max(1)
+        # Strict comparison keeps the earliest target on ties, like a single max.
+        better = c_vals > vals
+        vals[better] = c_vals[better]
+        idxs[better] = c_idxs[better] + i
+    return vals, idxs
+
+
 def match_anchors(anchors, targets, match_thr=0.5, bkg_thr=0.4):
     "Match `anchors` to targets. -1 is match to background, -2 is ignore."
     matches = anchors.new(anchors.size(0)).zero_().long() - 2
     if targets.numel() == 0: return matches
-    ious = IoU_values(anchors, targets)
-    vals,idxs = torch.max(ious,1)
+    vals,idxs = IoU_max(anchors, targets)
     matches[vals < bkg_thr] = -1
     matches[vals > match_thr] = idxs[vals > match_thr]
     #Overwrite matches with each target getting the anchor that has the max IoU.
@@ -172,6 +271,70 @@ def encode_class(idxs, n_classes):
     return target
 
 
+def unpad(tgt_bbox, tgt_clas, pad_idx=0):
+    i = torch.nonzero(tgt_clas-pad_idx)
+    # Images without objects are all padding.
+    i = torch.min(i) if len(i) else len(tgt_clas)
+    return tlbr2cthw(tgt_bbox[i:]), tgt_clas[i:]-1+pad_idx
+
+
+def anchor_targets(anchors, bbox_tgt, clas_tgt, pad_idx=0):
+    """Match the padded targets of one image to `anchors` and encode them.
+
+    Returns the class id of every anchor (0 for background, -1 for ignored
+    anchors) and the regression target of every anchor (zeros where the
+    anchor is not matched to an object).
+    """
+    bbox_tgt, clas_tgt = unpad(bbox_tgt, clas_tgt, pad_idx)
+    matches = match_anchors(anchors, bbox_tgt)
+    bbox_mask = matches>=0
+    anc_bbox = anchors.new_zeros(anchors.size())
+    if bbox_mask.sum() != 0:
+        anc_bbox[bbox_mask] = bbox_to_activ(bbox_tgt[matches[bbox_mask]], anchors[bbox_mask])
+    clas_tgt = torch.cat([clas_tgt.new_zeros(1).long(), clas_tgt+1])
+    anc_clas = clas_tgt[torch.clamp(matches+1, min=0)]
+    anc_clas[matches == -2] = -1
+    return anc_bbox, anc_clas
+
+
+def model_output_sizes(model, size):
+    "Return the feature map sizes `model` produces for an image of `size`."
+    h, w = size if is_tuple(size) else (size,size)
+    x = next(model.parameters()).new_zeros(1, 3, h, w)
+    training = model.training
+    with torch.no_grad(): sizes = model.eval()(x)[2]
+    model.train(training)
+    return sizes
+
+
+class RetinaNetTargetCollate():
+    """Collate detection samples and precompute the anchor targets of each image.
+
+    This runs `bb_pad_collate` followed by the anchor matching and box encoding
+    that `RetinaNetFocalLoss` would otherwise do on the main process, so it can
+    happen in the dataloader workers. The padded boxes and classes are kept in
+    the targets for metrics, followed by the per-anchor box and class targets.
+
+    Args:
+        sizes: feature map sizes of the model for the (fixed) input size
+        ratios: anchor aspect ratios
+        scales: anchor scales
+        pad_idx: class id used to pad the targets
+        collate_fn: collates the samples like (and by default with) `bb_pad_collate`
+    """
+    def __init__(self, sizes:Sizes, ratios:Collection[float]=None, scales:Collection[float]=None,
+                 pad_idx:int=0, collate_fn:Callable=None):
+        self.pad_idx = pad_idx
+        self.collate_fn = ifnone(collate_fn, partial(bb_pad_collate, pad_idx=pad_idx))
+        self.anchors = create_anchors(sizes, ifnone(ratios, RetinaNet.ratios), ifnone(scales, RetinaNet.scales))
+
+    def __call__(self, samples):
+        xb, (bbox_tgts, clas_tgts) = self.collate_fn(samples)
+        anc_bbox, anc_clas = zip(*[anchor_targets(self.anchors, bt, ct, self.pad_idx)
+                                   for bt, ct in zip(bbox_tgts, clas_tgts)])
+        return xb, (bbox_tgts, clas_tgts, torch.stack(anc_bbox), torch.stack(anc_clas))
+
+
 class RetinaNetFocalLoss(nn.Module):
     def __init__(self, gamma:float=2., alpha:float=0.25,  pad_idx:int=0, scales:Collection[float]=None,
                  ratios:Collection[float]=None, reg_loss:LossFunction=F.smooth_l1_loss):
@@ -190,10 +353,6 @@ class RetinaNetFocalLoss(nn.Module):
         self.sizes = sizes
         self.anchors = create_anchors(sizes, self.ratios, self.scales).to(device)
 
-    def _unpad(self, bbox_tgt, clas_tgt):
-        i = torch.min(torch.nonzero(clas_tgt-self.pad_idx))
-        return tlbr2cthw(bbox_tgt[i:]), clas_tgt[i:]-1+self.pad_idx
-
     def _focal_loss(self, clas_pred, clas_tgt):
         encoded_tgt = encode_class(clas_tgt, clas_pred.size(1))
         ps = torch.sigmoid(clas_pred.detach())
@@ -203,29 +362,30 @@ class RetinaNetFocalLoss(nn.Module):
         clas_loss = F.binary_cross_entropy_with_logits(clas_pred, encoded_tgt, weights, reduction='sum')
         return clas_loss
 
-    def _one_loss(self, clas_pred, bbox_pred, clas_tgt, bbox_tgt):
-        bbox_tgt, clas_tgt = self._unpad(bbox_tgt, clas_tgt)
-        matches = match_anchors(self.anchors, bbox_tgt)
-        bbox_mask = matches>=0
+    def _one_loss(self, clas_pred, bbox_pred, anc_clas, anc_bbox):
+        bbox_mask = anc_clas>0
         if bbox_mask.sum() != 0:
-            bbox_pred = bbox_pred[bbox_mask]
-            bbox_tgt = bbox_tgt[matches[bbox_mask]]
-            bb_loss = self.reg_loss(bbox_pred, bbox_to_activ(bbox_tgt, self.anchors[bbox_mask]))
+            bb_loss = self.reg_loss(bbox_pred[bbox_mask], anc_bbox[bbox_mask])
         else: bb_loss = 0.
-        matches.add_(1)
-        clas_tgt = clas_tgt + 1
-        clas_mask = matches>=0
-        clas_pred = clas_pred[clas_mask]
-        clas_tgt = torch.cat([clas_tgt.new_zeros(1).long(), clas_tgt])
-        clas_tgt = clas_tgt[matches[clas_mask]]
-        return bb_loss + self._focal_loss(clas_pred, clas_tgt)/torch.clamp(bbox_mask.sum(), min=1.)
-
-    def forward(self, output, bbox_tgts, clas_tgts):
+        clas_mask = anc_clas>=0
+        return bb_loss + self._focal_loss(clas_pred[clas_mask], anc_clas[clas_mask])/torch.clamp(bbox_mask.sum(), min=1.)
+
+    def forward(self, output, bbox_tgts, clas_tgts, anc_bbox_tgts=None, anc_clas_tgts=None):
+        "Targets made by `RetinaNetTargetCollate` include `anc_bbox_tgts` and `anc_clas_tgts`."
         clas_preds, bbox_preds, sizes = output
-        if self._change_anchors(sizes): self._create_anchors(sizes, clas_preds.device)
-        n_classes = clas_preds.size(2)
-        return sum([self._one_loss(cp, bp, ct, bt)
-                    for (cp, bp, ct, bt) in zip(clas_preds, bbox_preds, clas_tgts, bbox_tgts)])/clas_tgts.size(0)
+        # The sums over all anchors overflow fp16 and lose precision in bf16,
+        # so the loss is computed in fp32 whatever precision the model ran in.
+        clas_preds, bbox_preds = clas_preds.float(), bbox_preds.float()
+        if anc_clas_tgts is None:
+            if self._change_anchors(sizes) or self.anchors.device != clas_preds.device:
+                self._create_anchors(sizes, clas_preds.device)
+            anc_bbox_tgts, anc_clas_tgts = zip(*[anchor_targets(self.anchors, bt, ct, self.pad_idx)
+                                                 for bt, ct in zip(bbox_tgts, clas_tgts)])
+        else:
+            assert anc_clas_tgts.size(1) == clas_preds.size(1), \
+                'Precomputed anchor targets do not match the model feature sizes.'
+        return sum([self._one_loss(cp, bp, ac, ab)
+                    for (cp, bp, ac, ab) in zip(clas_preds, bbox_preds, anc_clas_tgts, anc_bbox_tgts)])/clas_tgts.size(0)
 
 
 class SigmaL1SmoothLoss(nn.Module):
@@ -240,24 +400,6 @@ def retina_net_split(model):
     return groups + [list(model.children())[1:]]
 
 
-def unpad(tgt_bbox, tgt_clas, pad_idx=0):
-    i = torch.min(torch.nonzero(tgt_clas-pad_idx))
-    return tlbr2cthw(tgt_bbox[i:]), tgt_clas[i:]-1+pad_idx
-
-
-def process_output(output, i, detect_thresh=0.25):
-    "Process `output[i]` and return the predicted bboxes above `detect_thresh`."
-    clas_pred,bbox_pred,sizes = output[0][i], output[1][i], output[2]
-    anchors = create_anchors(sizes, ratios, scales).to(clas_pred.device)
-    bbox_pred = activ_to_bbox(bbox_pred, anchors)
-    clas_pred = torch.sigmoid(clas_pred)
-    detect_mask = clas_pred.max(1)[0] > detect_thresh
-    bbox_pred, clas_pred = bbox_pred[detect_mask], clas_pred[detect_mask]
-    bbox_pred = tlbr2cthw(torch.clamp(cthw2tlbr(bbox_pred), min=-1, max=1))
-    scores, preds = clas_pred.max(1)
-    return bbox_pred, scores, preds
-
-
 def _draw_outline(o:Patch, lw:int):
     "Outline bounding box onto image `Patch`."
     o.set_path_effects([patheffects.Stroke(
@@ -285,7 +427,8 @@ def nms(boxes, scores, thresh=0.3):
     return LongTensor(to_keep)
 
 
-def process_output(output, i, detect_thresh=0.25):
+def process_output(output, i, detect_thresh=0.25, ratios=ratios, scales=scales):
+    "Process `output[i]` and return the predicted bboxes above `detect_thresh`."
     clas_pred,bbox_pred,sizes = output[0][i], output[1][i], output[2]
     anchors = create_anchors(sizes, ratios, scales).to(clas_pred.device)
     bbox_pred = activ_to_bbox(bbox_pred, anchors)
@@ -298,8 +441,8 @@ def process_output(output, i, detect_thresh=0.25):
     return bbox_pred, scores, preds
 
 
-def show_preds(img, output, idx, detect_thresh=0.25, classes=None, ax=None):
-    bbox_pred, scores, preds = process_output(output, idx, detect_thresh)
+def show_preds(img, output, idx, detect_thresh=0.25, classes=None, ax=None, ratios=ratios, scales=scales):
+    bbox_pred, scores, preds = process_output(output, idx, detect_thresh, ratios, scales)
     if len(scores) != 0:
         to_keep = nms(bbox_pred, scores)
         bbox_pred, preds, scores = bbox_pred[to_keep].cpu(), preds[to_keep].cpu(), scores[to_keep].cpu()
@@ -323,11 +466,12 @@ def show_results(learn, start=0, n=5, detect_thresh=0.35, figsize=(10,25)):
     for i in range(n):
         img,bbox = learn.data.valid_ds[start+i]
         img.show(ax=axs[i,0], y=bbox)
-        show_preds(img, z, start+i, detect_thresh=detect_thresh, classes=learn.data.classes, ax=axs[i,1])
+        show_preds(img, z, start+i, detect_thresh=detect_thresh, classes=learn.data.classes, ax=axs[i,1],
+                   ratios=learn.model.ratios, scales=learn.model.scales)
 
 
-def get_predictions(output, idx, detect_thresh=0.05):
-    bbox_pred, scores, preds = process_output(output, idx, detect_thresh)
+def get_predictions(output, idx, detect_thresh=0.05, ratios=ratios, scales=scales):
+    bbox_pred, scores, preds = process_output(output, idx, detect_thresh, ratios, scales)
     if len(scores) == 0: return [],[],[]
     to_keep = nms(bbox_pred, scores)
     return bbox_pred[to_keep], preds[to_keep], scores[to_keep]
@@ -335,50 +479,109 @@ def get_predictions(output, idx, detect_thresh=0.05):
 
 def compute_ap(precision, recall):
     "Compute the average precision for `precision` and `recall` curve."
-    recall = np.concatenate(([0.], list(recall), [1.]))
-    precision = np.concatenate(([0.], list(precision), [0.]))
-    for i in range(len(precision) - 1, 0, -1):
-        precision[i - 1] = np.maximum(precision[i - 1], precision[i])
+    recall = np.concatenate(([0.], np.asarray(recall, dtype=np.float64), [1.]))
+    precision = np.concatenate(([0.], np.asarray(precision, dtype=np.float64), [0.]))
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
     idx = np.where(recall[1:] != recall[:-1])[0]
     ap = np.sum((recall[idx + 1] - recall[idx]) * precision[idx + 1])
     return ap
 
 
+def match_predictions(bbox_pred, preds, scores, tgt_bbox, tgt_clas, iou_thresh=0.5):
+    """Flag each prediction of one image as a true positive (1) or not (0).
+
+    Predictions are matched greedily by decreasing score: a prediction is a true
+    positive if the target it overlaps most has IoU >= `iou_thresh` and the same
+    class, and no higher scoring prediction was already matched to that target.
+    """
+    tps = preds.new_zeros(len(preds))
+    if len(preds) == 0 or len(tgt_bbox) == 0: return tps
+    n = len(preds)
+    order = scores.argsort(descending=True)
+    max_iou, matches = IoU_max(bbox_pred[order], tgt_bbox)
+    eligible = ((max_iou >= iou_thresh) & (tgt_clas[matches] == preds[order])).nonzero().view(-1)
+    if len(eligible) == 0: return tps
+    # Sorting by (target, rank) groups the candidates of each target with the best ranked first.
+    keys, _ = (matches[eligible] * n + eligible).sort()
+    tgts = keys // n
+    first = tgts != torch.cat([tgts.new_tensor([-1]), tgts[:-1]])
+    tps[order[keys[first] % n]] = 1
+    return tps
+
+
+class DetectionAPEvaluator():
+    """Accumulates detections and computes the average precision of each class.
+
+    Matching is vectorized per image and the per-class precision/recall curves
+    are computed with a single sort over all accumulated detections.
+    """
+    def __init__(self, n_classes:int, iou_thresh:float=0.5, detect_thresh:float=0.35,
+                 ratios:Collection[float]=None, scales:Collection[float]=None):
+        self.n_classes,self.iou_thresh,self.detect_thresh = n_classes,iou_thresh,detect_thresh
+        self.ratios,self.scales = ifnone(ratios, RetinaNet.ratios),ifnone(scales, RetinaNet.scales)
+        self.reset()
+
+    def reset(self):
+        self.tps, self.scores, self.clas = [], [], []
+        self.n_gts = torch.zeros(self.n_classes).long()
+
+    def update(self, output, target):
+        "Add the detections in model `output` for the batch with padded `target` boxes and classes."
+        for i in range(target[0].size(0)):
+            tgt_bbox, tgt_clas = unpad(target[0][i], target[1][i])
+            self.n_gts += torch.bincount(tgt_clas.cpu(), minlength=self.n_classes)[:self.n_classes]
+            bbox_pred, preds, scores = get_predictions(output, i, self.detect_thresh, self.ratios, self.scales)
+            if len(bbox_pred) == 0: continue
+            tps = match_predictions(bbox_pred, preds, scores, tgt_bbox, tgt_clas, self.iou_thresh)
+            self.tps.append(tps.cpu())
+            self.scores.append(scores.cpu())
+            self.clas.append(preds.cpu())
+
+    def class_aps(self):
+        "Return the list of average precisions of each class."
+        if len(self.scores) == 0: return [0.] * self.n_classes
+        tps, scores, clas = torch.cat(self.tps).float(), torch.cat(self.scores), torch.cat(self.clas)
+        idx = scores.argsort(descending=True)
+        tps, clas = tps[idx], clas[idx]
+        aps = []
+        for cls in range(self.n_classes):
+            tps_cls = tps[clas==cls]
+            if tps_cls.numel() == 0 or tps_cls.sum() == 0:
+                aps.append(0.)
+                continue
+            tps_cum = tps_cls.cumsum(0)
+            fps_cum = (1-tps_cls).cumsum(0)
+            precision = tps_cum / (tps_cum + fps_cum + 1e-8)
+            recall = tps_cum / (self.n_gts[cls].float() + 1e-8)
+            aps.append(compute_ap(precision.numpy(), recall.numpy()))
+        return aps
+
+
+class MeanAveragePrecision(Callback):
+    "Computes the mean average precision of a RetinaNet over the validation set."
+    def __init__(self, n_classes:int, iou_thresh:float=0.5, detect_thresh:float=0.35,
+                 ratios:Collection[float]=None, scales:Collection[float]=None):
+        self.evaluator = DetectionAPEvaluator(n_classes, iou_thresh, detect_thresh, ratios, scales)
+
+    def on_epoch_begin(self, **kwargs):
+        self.evaluator.reset()
+
+    def on_batch_end(self, last_output, last_target, **kwargs):
+        self.evaluator.update(last_output, last_target)
+
+    def on_epoch_end(self, last_metrics, **kwargs):
+        mean_ap = float(np.mean(self.evaluator.class_aps()))
+        # Don't keep the detections around, the metric is pickled with the exported model.
+        self.evaluator.reset()
+        return add_metrics(last_metrics, mean_ap)
+
+
 def compute_class_AP(model, dl, n_classes, iou_thresh=0.5, detect_thresh=0.35, num_keep=100):
-    tps, clas, p_scores = [], [], []
-    classes, n_gts = LongTensor(range(n_classes)),torch.zeros(n_classes).long()
+    evaluator = DetectionAPEvaluator(n_classes, iou_thresh, detect_thresh, model.ratios, model.scales)
     with torch.no_grad():
         for input,target in progress_bar(dl):
-            output = model(input)
-            for i in range(target[0].size(0)):
-                bbox_pred, preds, scores = get_predictions(output, i, detect_thresh)
-                tgt_bbox, tgt_clas = unpad(target[0][i], target[1][i])
-                if len(bbox_pred) != 0 and len(tgt_bbox) != 0:
-                    ious = IoU_values(bbox_pred, tgt_bbox)
-                    max_iou, matches = ious.max(1)
-                    detected = []
-                    for i in range_of(preds):
-                        if max_iou[i] >= iou_thresh and matches[i] not in detected and tgt_clas[matches[i]] == preds[i]:
-                            detected.append(matches[i])
-                            tps.append(1)
-                        else: tps.append(0)
-                    clas.append(preds.cpu())
-                    p_scores.append(scores.cpu())
-                n_gts += (tgt_clas.cpu()[:,None] == classes[None,:]).sum(0)
-    tps, p_scores, clas = torch.tensor(tps), torch.cat(p_scores,0), torch.cat(clas,0)
-    fps = 1-tps
-    idx = p_scores.argsort(descending=True)
-    tps, fps, clas = tps[idx], fps[idx], clas[idx]
-    aps = []
-    #return tps, clas
-    for cls in range(n_classes):
-        tps_cls, fps_cls = tps[clas==cls].float().cumsum(0), fps[clas==cls].float().cumsum(0)
-        if tps_cls.numel() != 0 and tps_cls[-1] != 0:
-            precision = tps_cls / (tps_cls + fps_cls + 1e-8)
-            recall = tps_cls / (n_gts[cls] + 1e-8)
-            aps.append(compute_ap(precision, recall))
-        else: aps.append(0.)
-    return aps
+            evaluator.update(model(input), target)
+    return evaluator.class_aps()
 
 
 '''
@@ -11,16 +11,13 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from fastai.vision import (SegmentationItemList, get_transforms, models,
-                           unet_learner, Image)
+from fastai.vision import models, unet_learner
 from fastai.callbacks import TrackEpochCallback
-from fastai.basic_train import load_learner
-from fastai.vision.transform import dihedral
 from torch.utils.data.sampler import WeightedRandomSampler
 
 from rastervision.utils.files import (get_local_path, make_dir, upload_or_copy,
-                                      list_paths, download_if_needed,
-                                      sync_from_dir, sync_to_dir, str_to_file)
+                                      list_paths, sync_from_dir, sync_to_dir,
+                                      str_to_file)
 from rastervision.utils.misc import save_img
 from rastervision.backend import Backend
 from rastervision.data.label import SemanticSegmentationLabels
@@ -28,7 +25,26 @@ from rastervision.data.label_source.utils import color_to_triple
 
 from fastai_plugin.utils import (SyncCallback, MySaveModelCallback,
                                  ExportCallback, MyCSVLogger, Precision,
-                                 Recall, FBeta, zipdir)
+                                 Recall, FBeta, StepCheckpointCallback,
+                                 TrainBudgetCallback, ValidationCallback,
+                                 DistributedCallback, budget_epochs,
+                                 shard_batches, stratified_subset, zipdir,
+                                 class_map_meta, load_inference_model,
+                                 to_precision)
+from fastai_plugin.inference import (ChipPreprocessor, InferenceRunner,
+                                     model_dtype, is_channels_last, dihedral,
+                                     inverse_dihedral)
+from fastai_plugin.pipeline import PredictPipeline, window_batches
+from fastai_plugin.file_cache import get_file_cache, cached_download
+from fastai_plugin.lr_cache import lr_find_key, cached_lr_find
+from fastai_plugin.model_server import ModelClient
+from fastai_plugin.quantize import quantize_export, argmax_accuracy
+from fastai_plugin.augment import (ByteSegmentationItemList, BatchAugment,
+                                   augment_batches)
+from fastai_plugin.precision import get_precision
+from fastai_plugin.distributed import (launch, is_distributed,
+                                       is_main_process, is_local_main_process,
+                                       barrier, broadcast_value)
 
 
 # Deprecated and just here so old models can be unpickled.
@@ -132,8 +148,8 @@ def get_weighted_sampler(dataset, rare_class_ids, rare_target_prop):
     return sampler
 
 
-def tta_predict(learner, im_arr):
-    """Use test-time augmentation to make predictions for a single image.
+def tta_predict(model, x):
+    """Use test-time augmentation to make predictions for a batch of images.
 
     This uses the dihedral transform to make 8 flipped/rotated version of the
     input, makes a prediction for each one, and averages the predictive
@@ -141,34 +157,73 @@ def tta_predict(learner, im_arr):
     improvement.
 
     Args:
-        learner: fastai Learner object for semantic segmentation
-        im_arr: (Tensor) of shape (nb_channels, height, width)
+        model: semantic segmentation model in eval mode, or an
+            InferenceRunner
+        x: (Tensor) of shape (batch_sz, nb_channels, height, width)
 
     Returns:
-        (numpy.ndarray) of shape (height, width) containing predicted class ids
+        (numpy.ndarray) of shape (batch_sz, height, width) containing predicted
+            class ids
     """
     # Note: we are not using the TTA method built into fastai because it only
     # works on image classification problems (and this is undocumented).
     # We should consider contributing this upstream to fastai.
-    probs = []
+    probs = 0
     for k in range(8):
-        trans_im = dihedral(Image(im_arr), k)
-        o = learner.predict(trans_im)[2]
-        # https://forums.fast.ai/t/how-best-to-have-get-preds-or-tta-apply-specified-transforms/40731/9
-        o = Image(o)
-        if k == 5:
-            o = dihedral(o, 6)
-        elif k == 6:
-            o = dihedral(o, 5)
-        else:
-            o = dihedral(o, k)
-        probs.append(o.data)
+        o = torch.softmax(model(dihedral(x, k)), dim=1)
+        probs = probs + inverse_dihedral(o, k)
+    return probs.argmax(1).cpu().numpy()
+
+
+class WindowLabelFn():
+    """Label function returning predictions made for a set of windows.
+
+    Unlike a closure, this can be pickled along with the labels using it.
+    """
+
+    def __init__(self, windows, label_arrs):
+        self.windows = windows
+        self.label_arrs = label_arrs
 
-    label_arr = torch.stack(probs).mean(0).argmax(0).numpy()
-    return label_arr
+    def __call__(self, _window):
+        for window, label_arr in zip(self.windows, self.label_arrs):
+            if _window == window:
+                return label_arr
+        raise ValueError('Trying to get labels for unknown window.')
+
+
+class BatchLabelFn():
+    """Label function returning predictions as they are made for a scene.
+
+    The predictions are made batch by batch as the windows are asked for, and
+    each window's label array is dropped once returned, so only the batches
+    in flight are kept in memory. Windows should be asked for once, in the
+    order the batches were made in, as label stores do.
+    """
 
+    def __init__(self, batch_labels):
+        """Constructor.
 
-def subset_training_data(chip_dir, count=None, prop=None):
+        Args:
+            batch_labels: iterable of SemanticSegmentationLabels, one per
+                batch, eg. from predict_batches
+        """
+        self.batch_labels = iter(batch_labels)
+        self.label_arrs = {}
+
+    def __call__(self, window):
+        key = window.tuple_format()
+        while key not in self.label_arrs:
+            labels = next(self.batch_labels, None)
+            if labels is None:
+                raise ValueError('Trying to get labels for unknown window.')
+            for batch_window in labels.get_windows():
+                self.label_arrs[batch_window.tuple_format()] = \
+                    labels.get_label_arr(batch_window)
+        return self.label_arrs.pop(key)
+
+
+def subset_training_data(chip_dir, count=None, prop=None, copy=True):
     """Specify a subset of all the training chips that have been created
 
     This creates uses the train_opts 'train_count' or 'train_prop' parameter to
@@ -179,6 +234,8 @@ def subset_training_data(chip_dir, count=None, prop=None):
 
     Args:
         chip_dir (str): path to the chip directory
+        copy (bool): if False, only return the name of the subset directory,
+            which is made by another process
 
     Returns:
         (str) name of the train subset image directory (e.g. 'train-{n}-img')
@@ -203,6 +260,9 @@ def subset_training_data(chip_dir, count=None, prop=None):
             return 'train-img'
         sample_size = round(prop * len(all_train))
 
+    if not copy:
+        return 'train-{}-img'.format(str(sample_size))
+
     random.seed(100)
     sample_images = random.sample(all_train, sample_size)
 
@@ -226,7 +286,9 @@ class SemanticSegmentationBackend(Backend):
         self.task_config = task_config
         self.backend_opts = backend_opts
         self.train_opts = train_opts
-        self.inf_learner = None
+        self.model = None
+        self.client = None
+        self.cache = get_file_cache(backend_opts)
 
     def print_options(self):
         # TODO get logging to work for plugins
@@ -326,24 +388,33 @@ class SemanticSegmentationBackend(Backend):
         starts training (or resumes from a checkpoint), periodically
         syncs contents of train_dir to train_uri and after training finishes.
 
+        With the train_workers option, this runs in that many processes
+        training in parallel (see fastai_plugin.distributed).
+
         Args:
             tmp_dir: (str) path to temp directory
         """
+        if self.backend_opts.train_workers and not is_distributed():
+            return launch(self.train, self.backend_opts.train_workers, tmp_dir,
+                          backend=self.backend_opts.dist_backend or 'gloo')
         self.print_options()
 
         # Sync output of previous training run from cloud.
         train_uri = self.backend_opts.train_uri
         train_dir = get_local_path(train_uri, tmp_dir)
-        make_dir(train_dir)
-        sync_from_dir(train_uri, train_dir)
-
-        # Get zip file for each group, and unzip them into chip_dir.
         chip_dir = join(tmp_dir, 'chips')
-        make_dir(chip_dir)
-        for zip_uri in list_paths(self.backend_opts.chip_uri, 'zip'):
-            zip_path = download_if_needed(zip_uri, tmp_dir)
-            with zipfile.ZipFile(zip_path, 'r') as zipf:
-                zipf.extractall(chip_dir)
+        # In distributed training, one process per machine gets the data.
+        if is_local_main_process():
+            make_dir(train_dir)
+            sync_from_dir(train_uri, train_dir)
+
+            # Get zip file for each group, and unzip them into chip_dir.
+            make_dir(chip_dir)
+            for zip_uri in list_paths(self.backend_opts.chip_uri, 'zip'):
+                zip_path = cached_download(zip_uri, tmp_dir, self.cache)
+                with zipfile.ZipFile(zip_path, 'r') as zipf:
+                    zipf.extractall(chip_dir)
+        barrier()
 
         # Setup data loader.
         def get_label_path(im_path):
@@ -357,18 +428,24 @@ class SemanticSegmentationBackend(Backend):
         num_workers = 0 if self.train_opts.debug else 4
 
         train_img_dir = subset_training_data(
-            chip_dir, self.train_opts.train_count, self.train_opts.train_prop)
+            chip_dir, self.train_opts.train_count, self.train_opts.train_prop,
+            copy=is_local_main_process())
+        barrier()
 
         def get_data(train_sampler=None):
-            data = (SegmentationItemList.from_folder(chip_dir).split_by_folder(
-                train=train_img_dir, valid='val-img').label_from_func(
-                    get_label_path, classes=classes).transform(
-                        get_transforms(flip_vert=self.train_opts.flip_vert),
-                        size=size,
-                        tfm_y=True).databunch(
+            data = (ByteSegmentationItemList.from_folder(
+                chip_dir).split_by_folder(
+                    train=train_img_dir, valid='val-img').label_from_func(
+                        get_label_path, classes=classes).databunch(
                             bs=self.train_opts.batch_sz,
                             num_workers=num_workers,
                         ))
+            if train_sampler is not None:
+                data.train_dl = data.train_dl.new(
+                    shuffle=False, sampler=train_sampler)
+            # Chips and masks are augmented together by batch.
+            augment_batches(data, size,
+                            BatchAugment(flip_vert=self.train_opts.flip_vert))
             return data
 
         data = get_data()
@@ -379,7 +456,7 @@ class SemanticSegmentationBackend(Backend):
                                            oversample['rare_target_prop'])
             data = get_data(train_sampler=sampler)
 
-        if self.train_opts.debug:
+        if self.train_opts.debug and is_main_process():
             make_debug_chips(data, class_map, tmp_dir, train_uri)
 
         # Setup learner.
@@ -400,19 +477,24 @@ class SemanticSegmentationBackend(Backend):
             path=train_dir)
         learn.unfreeze()
 
-        if self.train_opts.fp16 and torch.cuda.is_available():
-            # This loss_scale works for Resnet 34 and 50. You might need to adjust this
-            # for other models.
-            learn = learn.to_fp16(loss_scale=256)
+        # This loss_scale works for Resnet 34 and 50 in fp16. You might need to
+        # adjust this for other models.
+        learn = to_precision(
+            learn, get_precision(self.train_opts), loss_scale=256)
 
         # Setup callbacks and train model.
         model_path = get_local_path(self.backend_opts.model_uri, tmp_dir)
+        artifact_meta = {
+            'classes': list(data.classes),
+            'class_map': class_map_meta(self.task_config.class_map)
+        }
 
+        # Other processes get the weights of the main one when training begins.
         pretrained_uri = self.backend_opts.pretrained_uri
-        if pretrained_uri:
+        if pretrained_uri and is_main_process():
             print('Loading weights from pretrained_uri: {}'.format(
                 pretrained_uri))
-            pretrained_path = download_if_needed(pretrained_uri, tmp_dir)
+            pretrained_path = cached_download(pretrained_uri, tmp_dir, self.cache)
             learn.model.load_state_dict(
                 torch.load(pretrained_path, map_location=learn.data.device),
                 strict=False)
@@ -421,25 +503,73 @@ class SemanticSegmentationBackend(Backend):
         # TrackEpochCallback will work.
         callbacks = [
             TrackEpochCallback(learn),
-            MySaveModelCallback(learn, every='epoch'),
-            MyCSVLogger(learn, filename='log'),
-            ExportCallback(learn, model_path, monitor='f_beta'),
-            SyncCallback(train_dir, self.backend_opts.train_uri,
-                         self.train_opts.sync_interval)
+            MySaveModelCallback(learn, every='epoch')
         ]
+        if is_main_process():
+            callbacks += [
+                MyCSVLogger(learn, filename='log'),
+                ExportCallback(
+                    learn, model_path, monitor='f_beta',
+                    artifact_meta=artifact_meta,
+                    artifact_fp16=bool(self.backend_opts.artifact_fp16),
+                    graph_formats=self.backend_opts.export_graph_formats,
+                    simplify=self.backend_opts.export_simplify is not False),
+                SyncCallback(train_dir, self.backend_opts.train_uri,
+                             self.train_opts.sync_interval)
+            ]
+        if is_distributed():
+            callbacks.append(DistributedCallback(learn))
+        if self.train_opts.checkpoint_steps:
+            callbacks.append(StepCheckpointCallback(
+                learn, self.train_opts.checkpoint_steps,
+                sync_uri=self.backend_opts.train_uri))
 
-        lr = self.train_opts.lr
         num_epochs = self.train_opts.num_epochs
+        max_hours = self.train_opts.max_hours
+        max_steps = self.train_opts.max_steps
+        if max_hours or max_steps:
+            # The budget decides when to stop instead of num_epochs.
+            num_epochs = budget_epochs(shard_batches(data.train_dl), max_steps)
+            callbacks.append(TrainBudgetCallback(
+                learn, max_time=max_hours * 3600 if max_hours else None,
+                max_steps=max_steps))
+        validate_every = self.train_opts.validate_every or 1
+        valid_count = self.train_opts.valid_count
+        if validate_every > 1 or valid_count:
+            subset = None
+            if valid_count:
+                # Stratify by the rarest class in each chip.
+                label_sets = [data.valid_ds.y[i].data.unique().tolist()
+                              for i in range(len(data.valid_ds))]
+                subset = stratified_subset(label_sets, valid_count)
+            callbacks.append(
+                ValidationCallback(learn, validate_every, subset))
+
+        lr = self.train_opts.lr
         if self.train_opts.one_cycle:
             if lr is None:
-                learn.lr_find()
-                learn.recorder.plot(suggestion=True, return_fig=True)
-                lr = learn.recorder.min_grad_lr
-                print('lr_find() found lr: {}'.format(lr))
+                if is_main_process():
+                    key = lr_find_key(
+                        self.backend_opts.chip_uri, type(self).__name__,
+                        self.train_opts.model_arch, self.train_opts.batch_sz,
+                        self.train_opts.weight_decay)
+                    lr = cached_lr_find(learn, key, train_dir,
+                                        self.backend_opts.lr_cache_uri)
+                lr = broadcast_value(lr)
             learn.fit_one_cycle(num_epochs, lr, callbacks=callbacks)
         else:
             learn.fit(num_epochs, lr, callbacks=callbacks)
 
+        if not is_main_process():
+            return
+
+        if self.backend_opts.quantize:
+            quantize_export(
+                model_path, data.valid_dl, learn.loss_func,
+                mode=self.backend_opts.quantize,
+                nb_calib_batches=self.backend_opts.quantize_calib_batches,
+                metric=argmax_accuracy)
+
         # Since model is exported every epoch, we need some other way to
         # show that training is finished.
         str_to_file('done!', self.backend_opts.train_done_uri)
@@ -449,45 +579,140 @@ class SemanticSegmentationBackend(Backend):
 
     def load_model(self, tmp_dir):
         """Load the model in preparation for one or more prediction calls."""
-        if self.inf_learner is None:
+        if self.model is None and self.client is None:
             self.print_options()
-            model_uri = self.backend_opts.model_uri
-            model_path = download_if_needed(model_uri, tmp_dir)
-            self.inf_learner = load_learner(
-                dirname(model_path), basename(model_path))
+            self.pipeline = PredictPipeline(
+                self._preprocess_batch, self._infer_batch, self._make_labels,
+                prefetch=self.backend_opts.predict_prefetch,
+                label_queue_size=self.backend_opts.predict_label_queue_size)
+            if self.backend_opts.model_server:
+                # The model runs in the server, see fastai_plugin.model_server.
+                self.client = ModelClient(
+                    self.backend_opts.model_server,
+                    authkey=self.backend_opts.model_server_authkey)
+                self.model_info = self.client.info()
+                return
+
+            # Quantized models only run on the CPU.
+            use_cuda = (torch.cuda.is_available()
+                        and not self.backend_opts.predict_quantized)
+            self.device = torch.device("cuda:0" if use_cuda else "cpu")
+            self.model = load_inference_model(
+                self.backend_opts.model_uri, tmp_dir, self.device,
+                engine=self.backend_opts.predict_engine,
+                quantized=bool(self.backend_opts.predict_quantized),
+                cache=self.cache, precision=get_precision(self.train_opts))
+            self.preprocessor = ChipPreprocessor(
+                self.device, model_dtype(self.model),
+                n_buffers=self.pipeline.n_buffers,
+                channels_last=is_channels_last(self.model))
+            mem_budget = self.backend_opts.predict_mem_mb
+            self.runner = InferenceRunner(
+                self.model,
+                mem_budget=mem_budget * 2**20 if mem_budget else None)
+            self.model_info = {}
 
     def predict(self, chips, windows, tmp_dir):
-        """Return a prediction for a single chip.
+        """Return predictions for a batch of chips.
 
         Args:
-            chips: (numpy.ndarray) of shape (1, height, width, nb_channels)
-                containing a single imagery chip
-            windows: List containing a single window which is aligned with the
-                chip
+            chips: (numpy.ndarray) of shape
+                (batch_sz, height, width, nb_channels) containing imagery chips
+            windows: List of windows which are aligned with the chips
 
         Return:
-            (SemanticSegmentationLabels) containing predictions
+            (SemanticSegmentationLabels) containing predictions, where NODATA
+                pixels (all zeros in the imagery) have a class id of 0
         """
         self.load_model(tmp_dir)
+        return self._make_labels(
+            self._infer_batch(self._preprocess_batch(chips)), windows)
 
-        chip = torch.Tensor(chips[0]).permute((2, 0, 1)) / 255.
-        im = Image(chip)
-        self.inf_learner.data.single_ds.tfmargs[
-            'size'] = self.task_config.chip_size
-        self.inf_learner.data.single_ds.tfmargs_y[
-            'size'] = self.task_config.chip_size
+    def predict_batches(self, batches, tmp_dir):
+        """Return predictions for batches of chips.
 
-        if self.train_opts.tta:
-            label_arr = tta_predict(self.inf_learner, chip)
-        else:
-            label_arr = self.inf_learner.predict(im)[1].squeeze().numpy()
+        Unlike predict, this reads and preprocesses the next batches and makes
+        labels for the previous ones while the model runs, see
+        PredictPipeline.
 
-        # Return "trivial" instance of SemanticSegmentationLabels that holds a single
-        # window and has ability to get labels for that one window.
-        def label_fn(_window):
-            if _window == windows[0]:
-                return label_arr
-            else:
-                raise ValueError('Trying to get labels for unknown window.')
+        Args:
+            batches: iterable of (chips, windows) as passed to predict, see
+                window_batches
 
-        return SemanticSegmentationLabels(windows, label_fn)
+        Return:
+            generator of Labels objects, one per batch
+        """
+        return self._results_to_labels(self._batch_results(batches, tmp_dir))
+
+    def predict_scene(self, task, scene, tmp_dir):
+        """Return predictions for a scene, like Task.predict_scene.
+
+        Chips are read in batches of task.config.predict_batch_size and
+        passed to predict_batches as the label store asks for the labels of
+        their windows.
+
+        Args:
+            task: Task the prediction is for
+            scene: activated Scene to predict on
+
+        Return:
+            (SemanticSegmentationLabels) containing predictions
+        """
+        raster_source = scene.raster_source
+        windows = task.get_predict_windows(raster_source.get_extent())
+        batches = self._window_batches(raster_source, windows,
+                                       task.config.predict_batch_size)
+        return self._scene_labels(task, scene,
+                                  self.predict_batches(batches, tmp_dir))
+
+    def _window_batches(self, raster_source, windows, batch_sz):
+        # Every window gets labels, even if its chip is empty.
+        return window_batches(raster_source, windows, batch_sz)
+
+    def _batch_results(self, batches, tmp_dir):
+        self.load_model(tmp_dir)
+        return self.pipeline.run(batches)
+
+    def _results_to_labels(self, batch_labels):
+        # Labels are made for each batch by the pipeline.
+        return batch_labels
+
+    def _scene_labels(self, task, scene, batch_labels):
+        windows = task.get_predict_windows(scene.raster_source.get_extent())
+        return SemanticSegmentationLabels(windows,
+                                          BatchLabelFn(batch_labels))
+
+    def _preprocess(self, chips):
+        if self.client is not None:
+            # The server does the preprocessing.
+            return chips
+        # (batch_size, h, w, nchannels) --> (batch_size, nchannels, h, w)
+        return self.preprocessor(chips)
+
+    def _infer(self, x):
+        if self.client is not None:
+            return self.client.infer(x)
+        if self.train_opts.tta:
+            return tta_predict(self.runner, x)
+        return self.runner(x).argmax(1)
+
+    def _preprocess_batch(self, chips):
+        # NODATA pixels in imagery are set to class 0 (ie. ignored), as done
+        # by SemanticSegmentation.predict_scene in Raster Vision.
+        nodata = np.sum(chips, axis=3) == 0
+        return self._preprocess(chips), nodata
+
+    def _infer_batch(self, batch):
+        x, nodata = batch
+        return self._infer(x), nodata
+
+    def _make_labels(self, output, windows):
+        label_arrs, nodata = output
+        if isinstance(label_arrs, torch.Tensor):
+            label_arrs = label_arrs.cpu().numpy()
+        label_arrs[nodata] = 0
+
+        # Return "trivial" instance of SemanticSegmentationLabels that holds
+        # the windows and has ability to get labels for them.
+        return SemanticSegmentationLabels(
+            windows, WindowLabelFn(windows, label_arrs))
@@ -2,8 +2,6 @@ from copy import deepcopy
 
 import rastervision as rv
 
-from fastai_plugin.semantic_segmentation_backend import (
-    SemanticSegmentationBackend)
 from fastai_plugin.simple_backend_config import (
     SimpleBackendConfig, SimpleBackendConfigBuilder)
 
@@ -15,7 +13,9 @@ class TrainOptions():
                  one_cycle=None,
                  num_epochs=None, model_arch=None, fp16=None,
                  flip_vert=None, sync_interval=None, debug=None,
-                 train_prop=None, train_count=None, tta=None, oversample=None):
+                 train_prop=None, train_count=None, tta=None, oversample=None,
+                 checkpoint_steps=None, max_hours=None, max_steps=None,
+                 validate_every=None, valid_count=None, precision=None):
         self.batch_sz = batch_sz
         self.weight_decay = weight_decay
         self.lr = lr
@@ -30,9 +30,17 @@ class TrainOptions():
         self.train_count = train_count
         self.tta = tta
         self.oversample = oversample
+        self.checkpoint_steps = checkpoint_steps
+        self.max_hours = max_hours
+        self.max_steps = max_steps
+        self.validate_every = validate_every
+        self.valid_count = valid_count
+        self.precision = precision
 
     def __setattr__(self, name, value):
-        if name in ['batch_sz', 'num_epochs', 'sync_interval']:
+        if name in ['batch_sz', 'num_epochs', 'sync_interval',
+                    'checkpoint_steps', 'max_steps', 'validate_every',
+                    'valid_count']:
             value = int(value) if isinstance(value, float) else value
         super().__setattr__(name, value)
 
@@ -40,7 +48,8 @@ class TrainOptions():
 class SemanticSegmentationBackendConfig(SimpleBackendConfig):
     train_opts_class = TrainOptions
     backend_type = FASTAI_SEMANTIC_SEGMENTATION
-    backend_class = SemanticSegmentationBackend
+    backend_class_path = (
+        'fastai_plugin.semantic_segmentation_backend.SemanticSegmentationBackend')
 
 
 class SemanticSegmentationBackendConfigBuilder(SimpleBackendConfigBuilder):
@@ -64,7 +73,13 @@ class SemanticSegmentationBackendConfigBuilder(SimpleBackendConfigBuilder):
             train_prop=1.0,
             train_count=None,
             tta=False,
-            oversample=None):
+            oversample=None,
+            checkpoint_steps=None,
+            max_hours=None,
+            max_steps=None,
+            validate_every=1,
+            valid_count=None,
+            precision=None):
         """Set options for training models.
 
         Args:
@@ -104,6 +119,28 @@ class SemanticSegmentationBackendConfigBuilder(SimpleBackendConfigBuilder):
                 This will make it so chips containing any labels in rare_class_ids
                 will be sampled with a probability of rare_target_prop. This is
                 to help cope with severely imbalanced datasets.
+            checkpoint_steps: (int or None) if set, save a checkpoint every
+                checkpoint_steps training steps, so that training can resume
+                from the middle of an epoch (eg. after a spot instance is
+                preempted) instead of from the last completed epoch.
+            max_hours: (float or None) wall-clock time budget of training in
+                hours. If set, training stops when the budget is used up,
+                regardless of num_epochs, and one_cycle schedules are
+                stretched to fit it, based on the measured throughput.
+            max_steps: (int or None) maximum number of training steps
+                (batches). If set, training stops after max_steps steps,
+                regardless of num_epochs, and one_cycle schedules end there.
+            validate_every: (int) validate every validate_every epochs. The
+                last epoch is always validated.
+            valid_count: (int or None) if set, validate on a fixed subset of
+                about valid_count validation chips, stratified by the rarest
+                class in each chip. The full validation set is only used for
+                the last epoch and to confirm that a model is better before
+                exporting it.
+            precision: (str or None) precision to train and predict in,
+                'fp32', 'fp16' (CUDA only) or 'bf16' (CPU or CUDA, needs
+                torch >= 1.10). Defaults to 'fp16' if fp16 is True and 'fp32'
+                otherwise. See fastai_plugin.precision.
         """
         b = deepcopy(self)
         b.train_opts = TrainOptions(
@@ -112,7 +149,10 @@ class SemanticSegmentationBackendConfigBuilder(SimpleBackendConfigBuilder):
             num_epochs=num_epochs, model_arch=model_arch, fp16=fp16,
             flip_vert=flip_vert, sync_interval=sync_interval, debug=debug,
             train_prop=train_prop, train_count=train_count, tta=tta,
-            oversample=oversample)
+            oversample=oversample, checkpoint_steps=checkpoint_steps,
+            max_hours=max_hours, max_steps=max_steps,
+            validate_every=validate_every, valid_count=valid_count,
+            precision=precision)
         return b
 
     def with_pretrained_uri(self, pretrained_uri):
@@ -1,7 +1,9 @@
-from os.path import join
+from os.path import join, basename
 from copy import deepcopy
 from abc import abstractmethod
+import importlib
 import json
+import shutil
 
 from google.protobuf import struct_pb2
 
@@ -9,16 +11,50 @@ import rastervision as rv
 from rastervision.backend import (BackendConfig, BackendConfigBuilder)
 from rastervision.protos.backend_pb2 import BackendConfig as BackendConfigMsg
 from rastervision.task import SemanticSegmentationConfig
+from rastervision.utils.files import file_exists
+
+from fastai_plugin.file_cache import get_file_cache, is_local
+from fastai_plugin.uris import (artifact_uri, graph_uri, graph_meta_uri,
+                                quantized_uri, quantization_report_uri)
 
 
 class BackendOptions():
     def __init__(self, chip_uri=None, train_uri=None, train_done_uri=None,
-                 model_uri=None, pretrained_uri=None):
+                 model_uri=None, pretrained_uri=None, predict_mem_mb=None,
+                 predict_prefetch=None, predict_label_queue_size=None,
+                 model_server=None, predict_workers=None,
+                 predict_worker_threads=None, artifact_fp16=None,
+                 export_graph_formats=None, predict_engine=None,
+                 quantize=None, quantize_calib_batches=None,
+                 predict_quantized=None, export_simplify=None,
+                 cache_dir=None, cache_size_mb=None, lr_cache_uri=None,
+                 train_workers=None, dist_backend=None,
+                 window_merge_thresh=None, model_server_authkey=None):
         self.chip_uri = chip_uri
         self.train_uri = train_uri
         self.train_done_uri = train_done_uri
         self.model_uri = model_uri
         self.pretrained_uri = pretrained_uri
+        self.predict_mem_mb = predict_mem_mb
+        self.predict_prefetch = predict_prefetch
+        self.predict_label_queue_size = predict_label_queue_size
+        self.model_server = model_server
+        self.predict_workers = predict_workers
+        self.predict_worker_threads = predict_worker_threads
+        self.artifact_fp16 = artifact_fp16
+        self.export_graph_formats = export_graph_formats
+        self.predict_engine = predict_engine
+        self.quantize = quantize
+        self.quantize_calib_batches = quantize_calib_batches
+        self.predict_quantized = predict_quantized
+        self.export_simplify = export_simplify
+        self.cache_dir = cache_dir
+        self.cache_size_mb = cache_size_mb
+        self.lr_cache_uri = lr_cache_uri
+        self.train_workers = train_workers
+        self.dist_backend = dist_backend
+        self.window_merge_thresh = window_merge_thresh
+        self.model_server_authkey = model_server_authkey
 
 
 class SimpleBackendConfig(BackendConfig):
@@ -39,9 +75,19 @@ class SimpleBackendConfig(BackendConfig):
 
     @property
     @abstractmethod
-    def backend_class(self):
+    def backend_class_path(self):
+        """Module and name of the backend class, eg. 'module.Backend'.
+
+        Backend modules import torch and fastai, so they are only imported
+        when a backend is created. This keeps registering the plugin fast.
+        """
         pass
 
+    @property
+    def backend_class(self):
+        module_name, class_name = self.backend_class_path.rsplit('.', 1)
+        return getattr(importlib.import_module(module_name), class_name)
+
     def to_proto(self):
         config = {}
         for k, v in self.backend_opts.__dict__.items():
@@ -57,6 +103,10 @@ class SimpleBackendConfig(BackendConfig):
         return msg
 
     def create_backend(self, task_config):
+        # Tasks predict through the backend's predict_scene. Like the backend
+        # module, this imports torch, so it is only imported here.
+        from fastai_plugin.predict import install_predict_hook
+        install_predict_hook()
         return self.backend_class(
             task_config, self.backend_opts, self.train_opts)
 
@@ -92,15 +142,45 @@ class SimpleBackendConfig(BackendConfig):
         elif command_type == rv.EVAL:
             io_def.add_input()
 
+    def bundle_file(self, uri, bundle_dir):
+        # Copy the file from the download cache if there is one.
+        cache = get_file_cache(self.backend_opts)
+        path = None
+        if cache is not None and not is_local(uri):
+            path = cache.get(uri)
+        if path is None:
+            return super().bundle_file(uri, bundle_dir)
+        local_path = join(bundle_dir, basename(path))
+        shutil.copyfile(path, local_path)
+        return (local_path, basename(local_path))
+
     def save_bundle_files(self, bundle_dir):
         model_uri = self.backend_opts.model_uri
         if not model_uri:
             raise rv.ConfigError('model_uri is not set.')
-        local_path, base_name = self.bundle_file(model_uri, bundle_dir)
+        # The inference artifact is all predict needs, so bundle it instead
+        # of the much larger fastai Learner if there is one.
+        model_artifact_uri = artifact_uri(model_uri)
+        if file_exists(model_artifact_uri):
+            local_path, _ = self.bundle_file(model_artifact_uri, bundle_dir)
+            base_name = basename(model_uri)
+        else:
+            local_path, base_name = self.bundle_file(model_uri, bundle_dir)
+        local_paths = [local_path]
+        extra_uris = []
+        engine = self.backend_opts.predict_engine
+        if engine and file_exists(graph_uri(model_uri, engine)):
+            extra_uris += [graph_uri(model_uri, engine), graph_meta_uri(model_uri)]
+        if (self.backend_opts.predict_quantized
+                and file_exists(quantized_uri(model_uri))):
+            extra_uris += [quantized_uri(model_uri),
+                           quantization_report_uri(model_uri)]
+        for uri in extra_uris:
+            local_paths.append(self.bundle_file(uri, bundle_dir)[0])
         new_config = self.to_builder() \
                          .with_model_uri(base_name) \
                          .build()
-        return (new_config, [local_path])
+        return (new_config, local_paths)
 
     def load_bundle_files(self, bundle_dir):
         model_uri = self.backend_opts.model_uri
@@ -177,3 +257,142 @@ class SimpleBackendConfigBuilder(BackendConfigBuilder):
         b = deepcopy(self)
         b.backend_opts.pretrained_uri = pretrained_uri
         return b
+
+    def with_predict_options(self, predict_mem_mb=None, predict_prefetch=2,
+                             predict_label_queue_size=2, model_server=None,
+                             predict_workers=None,
+                             predict_worker_threads=None, predict_engine=None,
+                             predict_quantized=False,
+                             window_merge_thresh=None,
+                             model_server_authkey=None):
+        """Set options for making predictions.
+
+        Args:
+            predict_mem_mb: (int or None) memory budget in MB for running the
+                model. Batches are split into micro-batches that fit in it.
+                Whatever the budget, micro-batches are halved when running out
+                of memory.
+            predict_prefetch: (int) number of batches read and preprocessed
+                ahead of the model by predict_batches
+            predict_label_queue_size: (int) number of model outputs that can
+                wait for labels to be made from them in predict_batches
+            model_server: (str or None) address (host:port or Unix socket
+                path) of a running fastai_plugin.model_server to send chips to
+                instead of loading the model in this process
+            model_server_authkey: (str or None) key of the model server.
+                Defaults to the FASTAI_MODEL_SERVER_AUTHKEY environment
+                variable, which is preferable as this option is saved with
+                the config.
+            predict_workers: (int or None) if set, scenes are predicted in
+                this many processes sharing the model on the CPU (see
+                fastai_plugin.parallel.predict_parallel)
+            predict_worker_threads: (int or None) number of torch threads of
+                each of these processes, defaults to splitting the CPUs
+                between them
+            predict_engine: (str or None) if 'torchscript' or 'onnx', run the
+                graph exported in that format (see with_export_options)
+                instead of the eager model
+            predict_quantized: (bool) run the INT8 model exported with
+                with_export_options(quantize=...) on the CPU
+            window_merge_thresh: (float or None) object detection only. If
+                set, detections with an IoU above this with a higher scoring
+                detection of the same class from another window of the scene
+                are removed from the predictions (see box_merge).
+        """
+        b = deepcopy(self)
+        b.backend_opts.predict_mem_mb = predict_mem_mb
+        b.backend_opts.predict_prefetch = predict_prefetch
+        b.backend_opts.predict_label_queue_size = predict_label_queue_size
+        b.backend_opts.model_server = model_server
+        b.backend_opts.predict_workers = predict_workers
+        b.backend_opts.predict_worker_threads = predict_worker_threads
+        b.backend_opts.predict_engine = predict_engine
+        b.backend_opts.predict_quantized = predict_quantized
+        b.backend_opts.window_merge_thresh = window_merge_thresh
+        b.backend_opts.model_server_authkey = model_server_authkey
+        return b
+
+    def with_export_options(self, artifact_fp16=False, graph_formats=None,
+                            quantize=None, quantize_calib_batches=8,
+                            simplify=True):
+        """Set options for exporting models.
+
+        Args:
+            artifact_fp16: (bool) store the weights of the inference artifact
+                in fp16, halving its size. They are converted back to fp32
+                when predicting on the CPU.
+            graph_formats: (list or None) also export the model as graphs in
+                these formats ('torchscript', 'onnx') for predict_engine.
+                Exports are checked against the model and their CPU latency
+                logged. Checking ONNX exports requires onnxruntime.
+            quantize: (str or None) after training, quantize the exported
+                model to INT8 for CPU inference, either 'dynamic' (Linear
+                layers only) or 'static' (convolutions, calibrated on
+                validation chips). The loss and accuracy of both models on
+                the validation split are written next to it.
+            quantize_calib_batches: (int) number of validation batches to
+                calibrate static quantization on
+            simplify: (bool) export the model simplified for inference, with
+                BatchNorm layers folded into convolutions, dropout removed and
+                the channels last layout. The simplified model is checked
+                against the model and both their CPU latencies logged.
+        """
+        b = deepcopy(self)
+        b.backend_opts.artifact_fp16 = artifact_fp16
+        b.backend_opts.export_graph_formats = graph_formats
+        b.backend_opts.quantize = quantize
+        b.backend_opts.quantize_calib_batches = quantize_calib_batches
+        b.backend_opts.export_simplify = simplify
+        return b
+
+    def with_cache_options(self, cache_dir=None, cache_size_mb=20000,
+                           lr_cache_uri=None):
+        """Set options for caching downloads and results across runs.
+
+        Models, pretrained weights and chip zip files are downloaded into a
+        cache shared by all runs on a machine, keyed by URI and ETag (or size
+        and modification time), instead of into each run's temporary
+        directory. See fastai_plugin.file_cache.
+
+        The learning rate found by lr_find is always stored in the training
+        directory, and also in lr_cache_uri if set, so that other experiments
+        on the same chips, model_arch, batch size and weight decay skip
+        lr_find. See fastai_plugin.lr_cache.
+
+        Args:
+            cache_dir: (str or None) local directory of the cache, or None to
+                not cache downloads
+            cache_size_mb: (int) size cap of the cache in MB. Least recently
+                used files are evicted beyond it.
+            lr_cache_uri: (str or None) URI of a directory of lr_find results
+                shared between experiments
+        """
+        b = deepcopy(self)
+        b.backend_opts.cache_dir = cache_dir
+        b.backend_opts.cache_size_mb = cache_size_mb
+        b.backend_opts.lr_cache_uri = lr_cache_uri
+        return b
+
+    def with_distributed_options(self, train_workers=None,
+                                 dist_backend='gloo'):
+        """Set options for data-parallel training in several processes.
+
+        Each process trains on its own shard of the training chips, with
+        batch_sz chips per batch, and gradients are averaged between them,
+        so the effective batch size is the number of processes times
+        batch_sz. The learning rate is not scaled. Only the first process
+        logs, exports the model and syncs the training directory. To train
+        on several machines, set the NNODES, NODE_RANK, MASTER_ADDR and
+        MASTER_PORT environment variables on each of them. See
+        fastai_plugin.distributed.
+
+        Args:
+            train_workers: (int or None) number of processes on each machine,
+                or None to train in a single process
+            dist_backend: (str) torch.distributed backend, 'gloo' (CPU or
+                GPU) or 'nccl' (GPU only)
+        """
+        b = deepcopy(self)
+        b.backend_opts.train_workers = train_workers
+        b.backend_opts.dist_backend = dist_backend
+        return b
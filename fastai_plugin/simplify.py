@@ -0,0 +1,164 @@
+"""Export-time simplification of models for inference.
+
+simplify_model returns a copy of a model that computes the same thing with
+fewer kernels:
+- BatchNorm layers that directly follow a convolution are folded into its
+  weights and bias,
+- dropout layers are removed,
+- convolution weights are converted to the channels last layout (if torch
+  supports it), which matches the layout chips come in.
+
+Folded and removed layers are replaced by identities rather than deleted,
+since models like RetinaNet find their layers by position in the encoder.
+"""
+import copy
+import warnings
+
+import torch
+from torch import nn
+
+from fastai_plugin.graph_engine import benchmark
+from fastai_plugin.graph_export import max_diff
+from fastai_plugin.inference import to_channels_last
+
+if hasattr(nn, 'Identity'):
+    Identity = nn.Identity
+else:
+    class Identity(nn.Module):
+        def forward(self, x):
+            return x
+
+
+def _conv_bn_pairs(model, x):
+    """Find (conv, bn) pairs where bn is only ever run on the output of conv.
+
+    This runs model on x, recording the output of each convolution and the
+    input of each BatchNorm layer. Layers that run more than once or have
+    hooks of their own (eg. fastai hooks storing activations) are left out.
+    """
+    outputs, bn_inputs, calls = {}, {}, {}
+    hooks = []
+
+    def count(module):
+        calls[module] = calls.get(module, 0) + 1
+
+    def conv_hook(module, input, output):
+        count(module)
+        outputs[id(output)] = (module, output)
+
+    def bn_hook(module, input):
+        count(module)
+        bn_inputs[module] = input[0]
+
+    for module in model.modules():
+        if module._forward_hooks or module._forward_pre_hooks:
+            continue
+        if type(module) == nn.Conv2d:
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif (type(module) == nn.BatchNorm2d
+              and module.track_running_stats):
+            hooks.append(module.register_forward_pre_hook(bn_hook))
+    try:
+        with torch.no_grad():
+            model(x)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    pairs = []
+    for bn, bn_input in bn_inputs.items():
+        conv, output = outputs.get(id(bn_input), (None, None))
+        if (output is bn_input and calls[conv] == 1 and calls[bn] == 1
+                and conv.out_channels == bn.num_features):
+            pairs.append((conv, bn))
+    return pairs
+
+
+def fold_bn(conv, bn):
+    """Fold the BatchNorm layer bn into the convolution conv that it follows."""
+    std = torch.sqrt(bn.running_var + bn.eps)
+    gamma = bn.weight if bn.affine else torch.ones_like(std)
+    beta = bn.bias if bn.affine else torch.zeros_like(std)
+    scale = gamma / std
+    bias = conv.bias if conv.bias is not None \
+        else torch.zeros_like(bn.running_mean)
+    with torch.no_grad():
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + beta)
+
+
+def _replace(model, should_replace):
+    """Replace the modules for which should_replace is True by identities."""
+    nb_replaced = 0
+    for module in model.modules():
+        for name, child in module.named_children():
+            if should_replace(child):
+                setattr(module, name, Identity())
+                nb_replaced += 1
+    return nb_replaced
+
+
+def _is_dropout(module):
+    return (isinstance(module, nn.modules.dropout._DropoutNd)
+            and not module._forward_hooks)
+
+
+def _max_abs(output):
+    if isinstance(output, torch.Tensor):
+        output = [output]
+    return max(float(o.abs().max()) for o in output
+               if isinstance(o, torch.Tensor))
+
+
+def simplify_model(model, x, channels_last=True, tolerance=1e-4):
+    """Return a simplified copy of a model for inference.
+
+    The copy is made on the CPU in fp32 and checked against the model on a
+    batch made from x. If the outputs differ by more than tolerance (relative
+    to the largest output), the unsimplified copy is returned instead. The
+    CPU latency of both is printed.
+
+    Args:
+        model: (nn.Module) the model
+        x: (Tensor) of shape (batch_sz, nb_channels, height, width), example
+            input with the chip size used for predictions
+        channels_last: (bool) convert to the channels last layout
+        tolerance: (float) maximum relative difference between the outputs
+
+    Returns:
+        (model, simplified) with the model on the CPU in eval mode, and
+            simplified False if checking it failed
+    """
+    model = copy.deepcopy(model).float().cpu().eval()
+    x = x[:1].float().cpu()
+    x = torch.cat([x, torch.rand_like(x)])
+    with torch.no_grad():
+        output = model(x)
+
+    simple_model = copy.deepcopy(model)
+    pairs = _conv_bn_pairs(simple_model, x)
+    for conv, bn in pairs:
+        fold_bn(conv, bn)
+    folded_bns = set(bn for _, bn in pairs)
+    _replace(simple_model, lambda m: m in folded_bns)
+    nb_dropouts = _replace(simple_model, _is_dropout)
+    channels_last = channels_last and to_channels_last(simple_model)
+
+    with torch.no_grad():
+        simple_output = simple_model(x)
+    diff = max_diff(output, simple_output)
+    scale = max(_max_abs(output), 1.)
+    if diff > tolerance * scale:
+        warnings.warn(
+            'The simplified model differs from the model by up to {}, so it '
+            'is not used.'.format(diff))
+        return model, False
+
+    print('Simplified model: folded {} BatchNorm layers, removed {} dropout '
+          'layers{}. Max difference with model: {}. CPU latency for a batch '
+          'of {} (ms): {:.1f} -> {:.1f}'.format(
+              len(pairs), nb_dropouts,
+              ', channels last' if channels_last else '', diff, len(x),
+              benchmark(model, x), benchmark(simple_model, x)))
+    return simple_model, True
+
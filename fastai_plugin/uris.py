@@ -0,0 +1,29 @@
+"""URIs of the files exported next to a model.
+
+This doesn't import torch, so configs can use it when bundling models.
+"""
+
+
+def artifact_uri(model_uri):
+    """Return the URI of the inference artifact exported with model_uri."""
+    return model_uri + '.inference'
+
+
+def graph_uri(model_uri, fmt):
+    """Return the URI of the graph of model_uri exported in format fmt."""
+    return '{}.{}'.format(model_uri, fmt)
+
+
+def graph_meta_uri(model_uri):
+    """Return the URI of the metadata of the graphs exported with model_uri."""
+    return model_uri + '.graph.json'
+
+
+def quantized_uri(model_uri):
+    """Return the URI of the quantized model exported with model_uri."""
+    return model_uri + '.int8'
+
+
+def quantization_report_uri(model_uri):
+    """Return the URI of the report of the quantization of model_uri."""
+    return model_uri + '.int8.json'
@@ -1,19 +1,45 @@
 import csv
 import os
-from os.path import join
+from os.path import join, dirname, basename, relpath
 import os
 import zipfile
 import collections
 import json
+import math
+import random
+import time
 from typing import Any
 
+import numpy as np
+from torch.utils.data import Sampler, WeightedRandomSampler
+from torch.utils.data.distributed import DistributedSampler
+
 from fastai.core import ifnone
+from fastai.callback import annealing_cos, CallbackHandler
 from fastai.callbacks import CSVLogger, Callback, SaveModelCallback, TrackerCallback
+from fastai.callbacks.fp16 import MixedPrecision
 from fastai.metrics import add_metrics
-from fastai.torch_core import dataclass, torch, Tensor, Optional, warn
-from fastai.basic_train import Learner
-
-from rastervision.utils.files import (sync_to_dir)
+from fastai.torch_core import (dataclass, torch, Tensor, Optional, warn,
+                               model2half, batch_to_half)
+from fastai.basic_data import DatasetType
+from fastai.basic_train import Learner, LearnerCallback, load_learner, validate
+
+from rastervision.utils.files import sync_to_dir, file_exists, upload_or_copy
+
+from fastai_plugin.uris import (artifact_uri, graph_uri, graph_meta_uri,
+                                quantized_uri, quantization_report_uri)
+from fastai_plugin.model_artifact import (save_model_artifact, load_model_artifact,
+                                          _torch_load)
+from fastai_plugin.graph_engine import load_graph_model
+from fastai_plugin.graph_export import export_graphs
+from fastai_plugin.simplify import simplify_model
+from fastai_plugin.quantize import load_quantized_model
+from fastai_plugin.file_cache import cached_download
+from fastai_plugin.distributed import (world_size, rank, broadcast_value,
+                                       broadcast_tensors, all_reduce_mean,
+                                       DistributedWeightedSampler)
+from fastai_plugin.precision import (autocast, float_outputs, fp16_device,
+                                     to_inference_precision)
 
 
 class SyncCallback(Callback):
@@ -31,21 +57,50 @@ class SyncCallback(Callback):
 class ExportCallback(TrackerCallback):
     """"Exports the model when monitored quantity is best.
 
-    The exported model is the one used for inference.
+    The exported model is the one used for inference. Besides the fastai
+    Learner, this writes its inference artifact (see model_artifact), which
+    loads much faster, and graphs in graph_formats (see graph_export). If
+    simplify is True, these are made from the model simplified for inference
+    (see simplify).
     """
-    def __init__(self, learn:Learner, model_path:str, monitor:str='valid_loss', mode:str='auto'):
+    def __init__(self, learn:Learner, model_path:str, monitor:str='valid_loss', mode:str='auto',
+                 artifact_meta:Optional[dict]=None, artifact_fp16:bool=False,
+                 graph_formats:Optional[list]=None, simplify:bool=True):
         self.model_path = model_path
+        self.artifact_meta,self.artifact_fp16 = artifact_meta,artifact_fp16
+        self.graph_formats,self.simplify = graph_formats,simplify
         super().__init__(learn, monitor=monitor, mode=mode)
 
+    def on_train_begin(self, **kwargs:Any)->None:
+        super().on_train_begin(**kwargs)
+        self.best_subset = self.best
+
     def on_epoch_end(self, epoch:int, **kwargs:Any)->None:
         current = self.get_monitor_value()
+        validation = getattr(self.learn, 'validation_callback', None)
+        if current is not None and validation is not None and not validation.is_full:
+            # Only check the full validation set when the subset improved.
+            if not self.operator(current, self.best_subset): return
+            self.best_subset = current
+            current = validation.validate_full().get(self.monitor)
 
         if (epoch == 0 or
                 (current is not None and self.operator(current, self.best))):
             print(f'Better model found at epoch {epoch} with {self.monitor} value: {current}.')
-            self.best = current
+            # Epoch 0 is exported even if it wasn't validated.
+            if current is not None: self.best = current
             print(f'Exporting to {self.model_path}')
             self.learn.export(self.model_path)
+            model = self.learn.model
+            # A chip as the model sees it, after the transforms of valid_dl
+            # (eg. scaling uint8 chips to floats, see augment_batches).
+            x = self.learn.data.one_batch(DatasetType.Valid, denorm=False)[0][:1]
+            if self.simplify: model, _ = simplify_model(model, x)
+            save_model_artifact(model, artifact_uri(self.model_path),
+                                meta=self.artifact_meta, fp16=self.artifact_fp16)
+            if self.graph_formats:
+                export_graphs(model, x, self.model_path, self.graph_formats,
+                              meta=self.artifact_meta)
 
 
 class MySaveModelCallback(SaveModelCallback):
@@ -56,6 +111,8 @@ class MySaveModelCallback(SaveModelCallback):
     """
     def on_epoch_end(self, epoch:int, **kwargs:Any)->None:
         "Compare the value monitored to its best score and maybe save the model."
+        # Only the main process saves in distributed training.
+        if rank(): return
         if self.every=="epoch":
             self.learn.save(f'{self.name}_{epoch}')
             prev_model_path = self.learn.path/self.learn.model_dir/f'{self.name}_{epoch-1}.pth'
@@ -69,12 +126,501 @@ class MySaveModelCallback(SaveModelCallback):
                 self.learn.save(f'{self.name}')
 
 
+class MyMixedPrecision(MixedPrecision):
+    """Handles mixed-precision training.
+
+    Modified from fastai version to leave the parts of the model output that
+    aren't tensors (like the feature map sizes returned by RetinaNet) as they
+    are when converting the output to fp32.
+    """
+    # Found at learn.mixed_precision, like the fastai version.
+    cb_name = 'mixed_precision'
+
+    def on_loss_begin(self, last_output:Tensor, **kwargs:Any)->dict:
+        return {'last_output': float_outputs(last_output)}
+
+
+class AutocastCallback(LearnerCallback):
+    """Runs the model under torch.autocast, in training and validation.
+
+    The loss is computed outside of autocast, on the output converted to
+    fp32.
+    """
+    def __init__(self, learn:Learner, dtype:torch.dtype=torch.bfloat16):
+        super().__init__(learn)
+        self.dtype = dtype
+        self.ctx = None
+
+    def on_batch_begin(self, **kwargs:Any)->None:
+        self.ctx = autocast(self.learn.data.device.type, self.dtype)
+        self.ctx.__enter__()
+
+    def _exit(self)->None:
+        if self.ctx is not None:
+            self.ctx.__exit__(None, None, None)
+            self.ctx = None
+
+    def on_loss_begin(self, last_output:Tensor, **kwargs:Any)->dict:
+        self._exit()
+        return {'last_output': float_outputs(last_output)}
+
+    def on_train_end(self, **kwargs:Any)->None:
+        # In case training stopped with an exception in the model.
+        self._exit()
+
+
+def to_precision(learn:Learner, precision:str, loss_scale:Optional[float]=None)->Learner:
+    """Set up learn to train in precision, one of precision.PRECISIONS.
+
+    fp16 uses fastai's mixed-precision training, starting with loss_scale.
+    """
+    if precision == 'fp16' and fp16_device(learn.data.device):
+        learn.to_fp32()
+        learn.model = model2half(learn.model)
+        learn.data.add_tfm(batch_to_half)
+        learn.mp_cb = MyMixedPrecision(learn, loss_scale=loss_scale)
+        learn.callbacks.append(learn.mp_cb)
+    elif precision == 'bf16':
+        # Check that autocast is available before training.
+        autocast(learn.data.device.type)
+        learn.callbacks.append(AutocastCallback(learn))
+    return learn
+
+
+def _rng_states():
+    states = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(),
+              'random': random.getstate()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def _set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+class ResumableSampler(Sampler):
+    """Wraps a sampler so that an epoch can be resumed part way through.
+
+    The order of each epoch only depends on seed and the epoch number, so
+    after set_epoch(epoch, start), iterating gives the same indices as the
+    original epoch minus the first start ones. If rng_states is given, the
+    RNG states are set to it when iteration starts, which is after the
+    DataLoader draws the seeds of its workers and before it loads the first
+    batch.
+    """
+    def __init__(self, sampler, seed=0):
+        self.sampler = sampler
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, start=0, rng_states=None):
+        self.epoch = epoch
+        self.start = start
+        self.rng_states = rng_states
+
+    def __iter__(self):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed + self.epoch)
+            indices = list(self.sampler)
+        if self.rng_states is not None:
+            _set_rng_states(self.rng_states)
+        start = self.start
+        self.start, self.rng_states = 0, None
+        return iter(indices[start:])
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+class DistributedCallback(LearnerCallback):
+    """Trains on a shard of the data in each process of distributed training.
+
+    The training data is split between processes by a DistributedSampler, or
+    by a DistributedWeightedSampler if the data is sampled by a
+    WeightedRandomSampler (eg. to oversample rare classes). The parameters of
+    the model are set to those of rank 0 when training begins, and gradients
+    are averaged over processes after each backward pass. Buffers, like the
+    running statistics of batch norm layers, are set to those of rank 0 at the
+    end of each epoch. See fastai_plugin.distributed.
+    """
+    # Before StepCheckpointCallback, which wraps the sampler, and before
+    # MixedPrecision, which copies the parameters and gradients.
+    _order = -15
+
+    def __init__(self, learn:Learner):
+        super().__init__(learn)
+        self.train_dl, self.sampler = None, None
+
+    def on_train_begin(self, **kwargs:Any)->None:
+        self.train_dl = self.learn.data.train_dl
+        sampler = self.train_dl.dl.sampler
+        if isinstance(sampler, WeightedRandomSampler):
+            self.sampler = DistributedWeightedSampler(
+                sampler.weights, sampler.num_samples, world_size(), rank(),
+                replacement=sampler.replacement)
+        else:
+            self.sampler = DistributedSampler(
+                self.train_dl.dataset, world_size(), rank())
+        self.learn.data.train_dl = self.train_dl.new(
+            shuffle=False, sampler=self.sampler)
+        broadcast_tensors([p.data for p in self.learn.model.parameters()])
+        # Only the main process reports metrics.
+        if rank(): self.learn.recorder.silent = True
+
+    def on_epoch_begin(self, epoch:int, **kwargs:Any)->None:
+        self.sampler.set_epoch(epoch)
+
+    def on_backward_end(self, **kwargs:Any)->None:
+        all_reduce_mean([p.grad.data for p in self.learn.model.parameters()
+                         if p.grad is not None])
+
+    def on_epoch_end(self, **kwargs:Any)->None:
+        broadcast_tensors([b for b in self.learn.model.buffers()
+                           if b.is_floating_point()])
+
+    def on_train_end(self, **kwargs:Any)->None:
+        self.learn.data.train_dl = self.train_dl
+
+
+def shard_batches(dl)->int:
+    """Return the number of batches of dl each process trains on per epoch."""
+    nb_items = math.ceil(len(dl.dataset) / world_size())
+    if dl.drop_last: return nb_items // dl.batch_size
+    return math.ceil(nb_items / dl.batch_size)
+
+
+class StepCheckpointCallback(LearnerCallback):
+    """Saves a checkpoint every `every` training steps to resume mid-epoch.
+
+    The checkpoint holds the model, optimizer state, the position in the
+    epoch and the RNG states, and is uploaded to sync_uri (the training
+    directory in the cloud) if given. It is also saved at the end of each
+    epoch. The training data is iterated through
+    a ResumableSampler, so when training restarts from a checkpoint that is
+    more recent than the last epoch saved by MySaveModelCallback, the batches
+    of the epoch that were already used are skipped, and the OneCycleScheduler
+    (if any) is moved forward to the same step. In distributed training,
+    checkpoints are saved by the process of rank 0, and resuming is only
+    exact for that process.
+    """
+    # After OneCycleScheduler and MixedPrecision, whose state is restored.
+    _order = 1
+
+    def __init__(self, learn:Learner, every:int, sync_uri:Optional[str]=None,
+                 name:str='step_checkpoint'):
+        super().__init__(learn)
+        self.every = every
+        self.path = learn.path/learn.model_dir/f'{name}.pth'
+        self.uri = join(sync_uri, relpath(str(self.path), str(learn.path))) \
+            if sync_uri else None
+        self.sampler, self.resume, self.epoch_rng_states = None, None, None
+
+    def on_train_begin(self, epoch:int, **kwargs:Any):
+        dl = self.learn.data.train_dl
+        self.sampler = dl.dl.sampler
+        if not isinstance(self.sampler, ResumableSampler):
+            self.sampler = ResumableSampler(
+                dl.dl.sampler, int(torch.randint(2**31, (1, ))))
+            self.learn.data.train_dl = dl.new(shuffle=False, sampler=self.sampler)
+
+        # Count steps from the start of training, not of this run.
+        res = {'iteration': epoch * len(self.learn.data.train_dl)}
+        if not self.path.is_file(): return res
+        state = _torch_load(self.path)
+        # Ignore checkpoints older than the last epoch that was saved.
+        if state['epoch'] < epoch: return res
+        print(f'Resuming from step {state["iteration"]} (epoch {state["epoch"]}, '
+              f'batch {state["num_batch"]}).')
+        self.sampler.seed = state['seed']
+        self.resume = state
+        return {'epoch': state['epoch'], 'iteration': state['iteration']}
+
+    def on_epoch_begin(self, epoch:int, **kwargs:Any):
+        if self.resume is None:
+            self.epoch_rng_states = _rng_states()
+            self.sampler.set_epoch(epoch)
+            return
+        state, self.resume = self.resume, None
+        self._restore(state)
+        # Start the epoch with the same RNG states as the original one, so
+        # the DataLoader gives its workers the same seeds. These are the
+        # states of rank 0, so other processes in distributed training keep
+        # their own.
+        self.epoch_rng_states = state['epoch_rng']
+        if not rank(): _set_rng_states(state['epoch_rng'])
+        start = state['num_batch'] * self.learn.data.train_dl.batch_size
+        self.sampler.set_epoch(epoch, start,
+                               rng_states=None if rank() else state['rng'])
+        # Count batches from the start of the epoch, not of the resumed part.
+        return {'num_batch': state['num_batch']}
+
+    def _restore(self, state):
+        self.learn.model.load_state_dict(state['model'])
+        mp = getattr(self.learn, 'mixed_precision', None)
+        if mp is not None and 'master' in state:
+            for master_group, saved_group in zip(mp.master_params, state['master']):
+                for master, saved in zip(master_group, saved_group):
+                    master.data.copy_(saved)
+        self.learn.opt.opt.load_state_dict(state['opt'])
+        sched = getattr(self.learn, 'one_cycle_scheduler', None)
+        if sched is not None:
+            for _ in range(state['num_batch']): sched.on_batch_end(True)
+
+    def on_batch_end(self, train:bool, epoch:int, iteration:int, num_batch:int,
+                     **kwargs:Any)->None:
+        if train and (iteration + 1) % self.every == 0:
+            self.save(epoch, num_batch + 1, iteration + 1)
+
+    def on_epoch_end(self, epoch:int, iteration:int, **kwargs:Any)->None:
+        # Also save at the end of epochs, so that resuming from an epoch
+        # boundary restores the sampler seed and RNG states as well.
+        self.epoch_rng_states = _rng_states()
+        self.save(epoch + 1, 0, iteration)
+
+    def save(self, epoch:int, num_batch:int, iteration:int)->None:
+        if rank(): return
+        state = {
+            'epoch': epoch, 'num_batch': num_batch, 'iteration': iteration,
+            'seed': self.sampler.seed, 'model': self.learn.model.state_dict(),
+            'opt': self.learn.opt.opt.state_dict(), 'epoch_rng': self.epoch_rng_states,
+            # At the start of an epoch, the RNG states are the epoch's.
+            'rng': _rng_states() if num_batch else None}
+        mp = getattr(self.learn, 'mixed_precision', None)
+        if mp is not None:
+            state['master'] = [[p.data for p in group] for group in mp.master_params]
+        # Write to a temporary file first so a preemption can't leave a
+        # truncated checkpoint.
+        tmp_path = self.path.parent/f'{self.path.name}.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.path)
+        if self.uri: upload_or_copy(str(self.path), self.uri)
+
+
+# Upper bound on the number of epochs of training stopped by a time budget.
+MAX_BUDGET_EPOCHS = 1000
+
+
+def budget_epochs(nb_batches, max_steps=None):
+    """Return the number of epochs to fit for when using TrainBudgetCallback.
+
+    Args:
+        nb_batches: (int) number of batches in an epoch
+        max_steps: (int or None) maximum number of training steps, or None if
+            training is only stopped by a time budget
+    """
+    if max_steps:
+        return min(math.ceil(max_steps / nb_batches), MAX_BUDGET_EPOCHS)
+    return MAX_BUDGET_EPOCHS
+
+
+def stretch_one_cycle(sched, nb_steps:int, step:int)->None:
+    """Make a OneCycleScheduler end after nb_steps steps and move it to step."""
+    a1 = int(nb_steps * sched.pct_start)
+    sched.phases = ((a1, annealing_cos), (nb_steps - a1, annealing_cos))
+    low_lr = sched.lr_max/sched.div_factor
+    sched.lr_scheds = sched.steps((low_lr, sched.lr_max), (sched.lr_max, sched.lr_max/sched.final_div))
+    sched.mom_scheds = sched.steps(sched.moms, (sched.moms[1], sched.moms[0]))
+    sched.opt.lr,sched.opt.mom = sched.lr_scheds[0].start,sched.mom_scheds[0].start
+    sched.idx_s = 0
+    for _ in range(step): sched.on_batch_end(True)
+
+
+class TrainBudgetCallback(LearnerCallback):
+    """Stops training after max_steps training steps or max_time seconds.
+
+    The number of steps that fit in max_time is estimated from the
+    throughput of the first measure_steps steps, and again at the end of each
+    epoch from the time the epoch took, including validation. If training
+    uses fit_one_cycle, its schedule is stretched to end at that step. When
+    stopping, the epoch is validated as usual so the model can be exported.
+
+    The plan and the elapsed time are saved in the training directory, so
+    that resumed training keeps to the same schedule and budget. The time
+    spent after the last epoch or plan that was saved is not counted. In
+    distributed training, the time of the process of rank 0 is used.
+    """
+    # After OneCycleScheduler and StepCheckpointCallback.
+    _order = 2
+
+    def __init__(self, learn:Learner, max_time:Optional[float]=None,
+                 max_steps:Optional[int]=None, measure_steps:int=20):
+        super().__init__(learn)
+        self.max_time,self.max_steps,self.measure_steps = max_time,max_steps,measure_steps
+        self.path = learn.path/learn.model_dir/'train_budget.json'
+
+    def on_train_begin(self, n_epochs:int, epoch:int, **kwargs:Any)->None:
+        nb_batches = len(self.learn.data.train_dl)
+        self.max_plan = nb_batches * n_epochs
+        self.nb_steps, self.prev_elapsed = self.max_steps, 0.
+        if self.path.is_file():
+            with open(self.path) as f: plan = json.load(f)
+            self.nb_steps, self.prev_elapsed = plan['nb_steps'], plan['elapsed']
+        # Steps done in this run, to measure throughput.
+        self.run_steps, self.measure_start = 0, None
+        self.start_time = time.time()
+        self.step = epoch * nb_batches
+        # The scheduler is then moved to the step to resume from, if any.
+        if self.nb_steps: self.plan(self.nb_steps, 0)
+
+    def elapsed(self)->float:
+        return self.prev_elapsed + time.time() - self.start_time
+
+    def plan(self, nb_steps:int, step:int)->None:
+        self.nb_steps = min(nb_steps, self.max_plan)
+        sched = getattr(self.learn, 'one_cycle_scheduler', None)
+        if sched is not None: stretch_one_cycle(sched, self.nb_steps, step)
+
+    def replan(self, sec_per_step:float)->None:
+        remaining = self.max_time - self.elapsed()
+        nb_steps = self.step + max(int(remaining / sec_per_step), 0)
+        if self.max_steps: nb_steps = min(nb_steps, self.max_steps)
+        # All processes follow the same schedule in distributed training.
+        nb_steps = int(broadcast_value(nb_steps))
+        if nb_steps == self.nb_steps: return
+        print(f'Planning {nb_steps} training steps to fit in {self.max_time:.0f}s '
+              f'({sec_per_step:.3f}s per step).')
+        self.plan(nb_steps, self.step)
+        self.save()
+
+    def save(self)->None:
+        if rank(): return
+        with open(self.path, 'w') as f:
+            json.dump({'nb_steps': self.nb_steps, 'elapsed': self.elapsed()}, f)
+
+    def on_epoch_begin(self, epoch:int, num_batch:int, **kwargs:Any)->None:
+        self.step = epoch * len(self.learn.data.train_dl) + num_batch
+        self.epoch_start_step, self.epoch_start_time = self.step, time.time()
+
+    def on_batch_end(self, train:bool, **kwargs:Any):
+        if not train: return
+        self.step += 1
+        self.run_steps += 1
+        if self.max_time:
+            # Leave out the first steps, which are slower.
+            if self.run_steps == 2: self.measure_start = time.time()
+            if self.run_steps == self.measure_steps and self.nb_steps == self.max_steps:
+                self.replan((time.time() - self.measure_start) / (self.measure_steps - 2))
+        out_of_time = self.max_time and self.elapsed() >= self.max_time
+        # Processes of distributed training stop together, when rank 0 does.
+        if self.max_time: out_of_time = broadcast_value(out_of_time)
+        if (self.nb_steps and self.step >= self.nb_steps) or out_of_time:
+            print(f'Stopping training after {self.step} steps and {self.elapsed():.0f}s.')
+            return {'stop_epoch': True, 'stop_training': True}
+
+    def on_epoch_end(self, **kwargs:Any)->None:
+        epoch_steps = self.step - self.epoch_start_step
+        if self.max_time and epoch_steps > 0:
+            self.replan((time.time() - self.epoch_start_time) / epoch_steps)
+        self.save()
+
+
+class SubsetSampler(Sampler):
+    """Samples the given indices in order."""
+    def __init__(self, indices):
+        self.indices = indices
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def stratified_subset(label_sets, size, seed=0):
+    """Return the sorted indices of a fixed subset of about size items.
+
+    Items are grouped by the rarest label they contain (items without labels
+    form a group of their own), and each group is sampled in proportion to
+    its size, keeping at least one item per group.
+
+    Args:
+        label_sets: list with the labels (eg. class ids) of each item
+        size: (int) size of the subset
+        seed: (int) seed of the sampling
+    """
+    counts = collections.Counter(l for labels in label_sets for l in set(labels))
+    groups = collections.defaultdict(list)
+    for i, labels in enumerate(label_sets):
+        key = min(labels, key=lambda l: (counts[l], l)) if len(labels) else None
+        groups[key].append(i)
+    rng = np.random.RandomState(seed)
+    indices = []
+    for key in sorted(groups, key=str):
+        group = groups[key]
+        nb = min(len(group), max(1, round(size * len(group) / len(label_sets))))
+        indices.extend(rng.choice(group, nb, replace=False).tolist())
+    return sorted(indices)
+
+
+class ValidationCallback(LearnerCallback):
+    """Validates every `every` epochs, optionally on a subset of the data.
+
+    If subset_indices is given, epochs are validated on those items of the
+    validation set only, and ExportCallback validates on the full set when
+    the subset shows an improvement. The last epoch, including one cut short
+    by TrainBudgetCallback, is always validated on the full set.
+    """
+    # After TrainBudgetCallback, which may stop training.
+    _order = 3
+
+    def __init__(self, learn:Learner, every:int=1, subset_indices:Optional[list]=None):
+        super().__init__(learn)
+        self.every = every
+        self.full_dl = learn.data.valid_dl
+        self.subset_dl = None
+        if subset_indices is not None:
+            self.subset_dl = self.full_dl.new(sampler=SubsetSampler(subset_indices))
+        self.is_full = True
+
+    def use_full(self, full:bool)->None:
+        self.is_full = full or self.subset_dl is None
+        self.learn.data.valid_dl = self.full_dl if self.is_full else self.subset_dl
+
+    def on_epoch_begin(self, epoch:int, n_epochs:int, **kwargs:Any):
+        last = epoch == n_epochs - 1
+        self.use_full(last)
+        return {'skip_validate': not last and (epoch + 1) % self.every != 0}
+
+    def on_batch_end(self, train:bool, stop_training:bool, **kwargs:Any):
+        if train and stop_training:
+            self.use_full(True)
+            return {'skip_validate': False}
+
+    def on_train_end(self, **kwargs:Any)->None:
+        self.learn.data.valid_dl = self.full_dl
+
+    def validate_full(self)->dict:
+        """Validate on the full validation set, return the value of each metric.
+
+        This is called during training, so unlike Learner.validate, it doesn't
+        run the callbacks of the learner: on_train_begin of MixedPrecision
+        would rebuild the optimizer. Only the callbacks handling precision
+        are run, for the batches, as they convert the model output.
+        """
+        learn = self.learn
+        cb_handler = CallbackHandler([], learn.metrics)
+        cb_handler.on_train_begin(1, None, learn.metrics)
+        cb_handler.callbacks = [cb for cb in learn.callbacks
+                                if isinstance(cb, (MixedPrecision, AutocastCallback))]
+        cb_handler.on_epoch_begin()
+        val_loss = validate(learn.model, self.full_dl, learn.loss_func, cb_handler)
+        cb_handler.on_epoch_end(val_loss)
+        values = cb_handler.state_dict['last_metrics']
+        return dict(zip(learn.recorder.names[2:], values))
+
+
 class MyCSVLogger(CSVLogger):
     """Logs metrics to a CSV file after each epoch.
 
     Modified from fastai version to:
     - flush after each epoch
     - append to log if already exists
+    - log epochs without validation
     """
     def __init__(self, learn, filename='history'):
         super().__init__(learn, filename)
@@ -86,6 +632,12 @@ class MyCSVLogger(CSVLogger):
             super().on_train_begin(**kwargs)
 
     def on_epoch_end(self, epoch, smooth_loss, last_metrics, **kwargs):
+        # Epochs without validation only have a valid_loss of None, so fill
+        # the missing metrics for the columns to line up.
+        recorder = self.learn.recorder
+        nb_metrics = len(recorder.names) - 2 - int(recorder.add_time)
+        last_metrics = list(ifnone(last_metrics, []))
+        last_metrics += [None] * (nb_metrics - len(last_metrics))
         out = super().on_epoch_end(
             epoch, smooth_loss, last_metrics, **kwargs)
         self.file.flush()
@@ -203,6 +755,21 @@ class FBeta(CMScores):
     def on_train_end(self, **kwargs): self.average = self.avg
 
 
+def set_collate_fn(dl, collate_fn):
+    """Replace the collate function of a fastai DeviceDataLoader.
+
+    fastai copies collate_fn onto the wrapped DataLoader when it is created,
+    so both need to be set for the change to survive DeviceDataLoader.new().
+
+    Args:
+        dl: (DeviceDataLoader) the data loader to update
+        collate_fn: (callable) function that turns a list of samples into a
+            batch
+    """
+    dl.collate_fn = collate_fn
+    dl.dl.collate_fn = collate_fn
+
+
 def zipdir(dir, zip_path):
     """Create a zip file from a directory.
 
@@ -217,4 +784,57 @@ def zipdir(dir, zip_path):
             for file in files:
                 ziph.write(join(root, file),
                            join('/'.join(dirs),
-                                os.path.basename(file)))
\ No newline at end of file
+                                os.path.basename(file)))
+
+
+def class_map_meta(class_map):
+    """Return a JSON serializable version of a ClassMap."""
+    return [{'id': item.id, 'name': item.name, 'color': item.color}
+            for item in class_map.get_items()]
+
+
+def load_inference_model(model_uri, tmp_dir, device, engine=None, quantized=False,
+                         cache=None, precision=None):
+    """Load the model to make predictions with.
+
+    If quantized is True, this uses the INT8 model exported alongside
+    model_uri (see quantize), which only runs on the CPU. If engine is set,
+    this uses the graph exported in that format alongside model_uri (see
+    graph_engine). Otherwise, or if there is no such model, it uses the
+    inference artifact if there is one, and otherwise the fastai Learner in
+    model_uri.
+
+    Files are downloaded through cache if it isn't None. If precision is set,
+    the eager model is set up to run in that precision (see precision), while
+    graphs and quantized models run in the precision they were exported in.
+
+    Returns:
+        model on device in eval mode
+    """
+    if quantized:
+        model_quantized_uri = quantized_uri(model_uri)
+        if file_exists(model_quantized_uri):
+            model_path = cached_download(model_quantized_uri, tmp_dir, cache)
+            report_path = cached_download(quantization_report_uri(model_uri), tmp_dir, cache)
+            return load_quantized_model(model_path, report_path)
+        warn(f'No quantized model found for {model_uri}, using the float model.')
+
+    if engine:
+        model_graph_uri = graph_uri(model_uri, engine)
+        if file_exists(model_graph_uri):
+            graph_path = cached_download(model_graph_uri, tmp_dir, cache)
+            meta_path = cached_download(graph_meta_uri(model_uri), tmp_dir, cache)
+            return load_graph_model(graph_path, meta_path, fmt=engine, device=device)
+        warn(f'No {engine} graph found for {model_uri}, using the eager model.')
+
+    model_artifact_uri = artifact_uri(model_uri)
+    if file_exists(model_artifact_uri):
+        model_path = cached_download(model_artifact_uri, tmp_dir, cache)
+        model = load_model_artifact(model_path, device)[0]
+    else:
+        model_path = cached_download(model_uri, tmp_dir, cache)
+        learn = load_learner(dirname(model_path), basename(model_path))
+        model = learn.model.to(device).eval()
+    if precision is not None:
+        model = to_inference_precision(model, precision, device)
+    return model
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import PIL
+import torch
+from fastai.vision import Image, ImageBBox, open_image, open_mask
+
+import fastai_plugin.augment as augment
+from fastai_plugin.augment import (BatchAugment, ByteImageSegment,
+                                   open_byte_image, to_float_batch)
+
+# fastai's dihedral_affine(k) flips columns where dihedral(k) flips rows, and
+# rows where it flips columns. This maps k of dihedral to k of
+# dihedral_affine.
+AFFINE_K = {1: 2, 2: 1, 5: 6, 6: 5}
+
+
+class TestBatchAugment(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.x = torch.randint(256, (1, 3, 8, 8), dtype=torch.uint8)
+        bbox = self.make_bbox()
+        self.boxes = bbox.data[0][None]
+        self.labels = torch.tensor(bbox.data[1])[None]
+
+    def make_bbox(self):
+        return ImageBBox.create(
+            8, 8, [[1, 2, 4, 7], [0, 0, 3, 3]], labels=[1, 2],
+            classes=['background', 'a', 'b'])
+
+    def augment(self, aug):
+        return aug(self.x.clone(), boxes=self.boxes.clone(),
+                   labels=self.labels.clone())
+
+    def test_dihedral(self):
+        aug = BatchAugment(
+            flip_vert=True, max_rotate=0., max_zoom=1., max_lighting=0.)
+        for k in range(8):
+            with mock.patch.object(
+                    aug, 'sample_dihedral', return_value=torch.tensor([k])):
+                x, _, boxes, labels = self.augment(aug)
+            img = Image(self.x[0].float() / 255).dihedral(k)
+            bbox = self.make_bbox().dihedral_affine(AFFINE_K.get(k, k))
+            self.assertTrue(
+                torch.equal(x[0], img.px.mul(255).round().byte()), k)
+            self.assertTrue(torch.allclose(boxes[0], bbox.data[0]), k)
+            self.assertEqual(labels[0].tolist(), list(bbox.data[1]))
+
+    def test_zoom(self):
+        aug = BatchAugment(
+            max_rotate=0., max_zoom=2., max_lighting=0., p_affine=1.)
+        # A zoom of 1.5 on (x, y) = (0.5, -0.25), in [-1, 1].
+        uniform = [torch.tensor([1.5]), torch.tensor([[0.5, -0.25]])]
+        with mock.patch.object(
+                aug, 'sample_dihedral', return_value=torch.tensor([0])):
+            with mock.patch.object(augment, '_uniform', side_effect=uniform):
+                _, _, boxes, labels = self.augment(aug)
+        bbox = self.make_bbox().zoom(scale=1.5, row_pct=0.375, col_pct=0.75)
+        self.assertTrue(torch.allclose(boxes[0], bbox.data[0]))
+        self.assertEqual(labels[0].tolist(), list(bbox.data[1]))
+
+    def test_lighting(self):
+        x = torch.arange(256).byte().view(1, 1, 16, 16)
+        aug = BatchAugment(max_lighting=0.2)
+        uniform = [torch.tensor([0.6]), torch.tensor([np.log(1.2)])]
+        with mock.patch.object(
+                augment, '_apply', return_value=torch.tensor([True])):
+            with mock.patch.object(augment, '_uniform', side_effect=uniform):
+                lit = aug.lighting(x.clone())
+        img = Image(x[0].float() / 255).brightness(change=0.6).contrast(
+            scale=1.2)
+        # Only rounding to uint8 differs.
+        self.assertLessEqual(
+            float((lit[0].float() - img.px * 255).abs().max()), 0.5)
+
+    def test_to_float_batch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            img_path = os.path.join(tmp_dir, 'img.png')
+            mask_path = os.path.join(tmp_dir, 'mask.png')
+            PIL.Image.fromarray(
+                np.random.randint(256, size=(5, 6, 3),
+                                  dtype=np.uint8)).save(img_path)
+            PIL.Image.fromarray(
+                np.random.randint(3, size=(5, 6),
+                                  dtype=np.uint8)).save(mask_path)
+            x, y = to_float_batch(
+                (open_byte_image(img_path).px[None],
+                 open_byte_image(mask_path, 'L', ByteImageSegment).px[None]))
+            self.assertTrue(torch.equal(x[0], open_image(img_path).px))
+            self.assertTrue(torch.equal(y[0], open_mask(mask_path).data))
+
+
+if __name__ == '__main__':
+    unittest.main()
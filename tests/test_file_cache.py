@@ -0,0 +1,163 @@
+from os.path import exists, join
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import fastai_plugin.file_cache as file_cache
+from fastai_plugin.file_cache import FileCache
+
+
+class CountingFileCache(FileCache):
+    """FileCache recording its downloads in a file, shared by processes."""
+
+    def _download(self, uri, path):
+        with open(join(self.cache_dir, 'downloads.log'), 'a') as f:
+            f.write(uri + '\n')
+        super()._download(uri, path)
+
+    def downloads(self):
+        log_path = join(self.cache_dir, 'downloads.log')
+        if not exists(log_path):
+            return []
+        with open(log_path) as f:
+            return f.read().splitlines()
+
+
+def slow_download(uri, download_dir):
+    """Copy uri in small chunks, so that concurrent gets overlap."""
+    path = join(download_dir, 'download')
+    with open(uri, 'rb') as src, open(path, 'wb') as dst:
+        while True:
+            chunk = src.read(1024)
+            if not chunk:
+                break
+            dst.write(chunk)
+            dst.flush()
+            time.sleep(0.01)
+    return path
+
+
+def _race_get(cache_dir, uri, start, result_queue):
+    file_cache.download_if_needed = slow_download
+    cache = CountingFileCache(cache_dir, 2**30)
+    start.wait()
+    path = cache.get(uri)
+    with open(path, 'rb') as f:
+        result_queue.put((path, f.read()))
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # A local directory stands in for the remote file system.
+        self.remote_dir = join(self.tmp_dir, 'remote')
+        self.cache_dir = join(self.tmp_dir, 'cache')
+        os.makedirs(self.remote_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_remote(self, name, content):
+        uri = join(self.remote_dir, name)
+        with open(uri, 'wb') as f:
+            f.write(content)
+        return uri
+
+    def set_last_used(self, path, seconds_ago):
+        t = time.time() - seconds_ago
+        os.utime(path, (t, t))
+
+    def test_hit_and_miss(self):
+        cache = CountingFileCache(self.cache_dir, 2**20)
+        uri = self.make_remote('model.pkl', b'a' * 100)
+
+        path = cache.get(uri)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 100)
+        self.assertEqual(cache.get(uri), path)
+        self.assertEqual(len(cache.downloads()), 1)
+
+        # A change of size changes the fingerprint.
+        self.make_remote('model.pkl', b'b' * 200)
+        new_path = cache.get(uri)
+        self.assertNotEqual(new_path, path)
+        with open(new_path, 'rb') as f:
+            self.assertEqual(f.read(), b'b' * 200)
+        self.assertEqual(len(cache.downloads()), 2)
+
+        # So does a change of modification time alone.
+        self.make_remote('model.pkl', b'c' * 200)
+        self.set_last_used(uri, 3600)
+        with open(cache.get(uri), 'rb') as f:
+            self.assertEqual(f.read(), b'c' * 200)
+        self.assertEqual(len(cache.downloads()), 3)
+
+    def test_evicts_least_recently_used(self):
+        cache = CountingFileCache(self.cache_dir, 250, min_age=0)
+        uris = [
+            self.make_remote(name, b'x' * 100) for name in ['a', 'b', 'c']
+        ]
+        path_a = cache.get(uris[0])
+        path_b = cache.get(uris[1])
+        self.set_last_used(path_a, 30)
+        self.set_last_used(path_b, 20)
+        # Using a makes b the least recently used.
+        self.assertEqual(cache.get(uris[0]), path_a)
+        path_c = cache.get(uris[2])
+
+        self.assertTrue(exists(path_a))
+        self.assertFalse(exists(path_b))
+        self.assertTrue(exists(path_c))
+        self.assertEqual(sum(size for _, size, _ in cache.entries()), 200)
+        # Lock files are not in the evicted entry.
+        self.assertTrue(os.listdir(cache.locks_dir))
+
+        # An evicted entry is downloaded again.
+        self.assertEqual(cache.get(uris[1]), path_b)
+        self.assertEqual(len(cache.downloads()), 4)
+
+    def test_min_age(self):
+        cache = CountingFileCache(self.cache_dir, 150, min_age=60)
+        path_a = cache.get(self.make_remote('a', b'x' * 100))
+        path_b = cache.get(self.make_remote('b', b'x' * 100))
+        # Both were just used, so the cache stays over its cap.
+        self.assertTrue(exists(path_a))
+        self.assertTrue(exists(path_b))
+
+        self.set_last_used(path_a, 120)
+        cache.evict()
+        self.assertFalse(exists(path_a))
+        self.assertTrue(exists(path_b))
+
+    def test_concurrent_gets_download_once(self):
+        content = os.urandom(32 * 1024)
+        uri = self.make_remote('model.pkl', content)
+        ctx = multiprocessing.get_context('fork')
+        start = ctx.Event()
+        result_queue = ctx.Queue()
+        workers = [
+            ctx.Process(
+                target=_race_get,
+                args=(self.cache_dir, uri, start, result_queue))
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        start.set()
+        results = [result_queue.get(timeout=60) for _ in workers]
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+        self.assertEqual(len(set(path for path, _ in results)), 1)
+        for _, data in results:
+            self.assertEqual(data, content)
+        cache = CountingFileCache(self.cache_dir, 2**30)
+        self.assertEqual(cache.downloads(), [uri])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+import torch
+from torch import nn
+
+from fastai_plugin.graph_engine import load_graph_model
+from fastai_plugin.graph_export import export_graphs
+from fastai_plugin.retinanet import RetinaNet
+from fastai_plugin.uris import graph_uri, graph_meta_uri
+
+
+def small_retinanet():
+    # Each layer halves the size, like the stages of a ResNet.
+    encoder = nn.Sequential(*[
+        nn.Sequential(
+            nn.Conv2d(3 if i == 0 else 8, 8, 3, stride=2, padding=1),
+            nn.ReLU()) for i in range(5)
+    ])
+    return RetinaNet(encoder, 3, final_bias=-4, chs=16).eval()
+
+
+class TestGraphExport(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.model_path = os.path.join(self.tmp_dir.name, 'export.pkl')
+        self.model = small_retinanet()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_parity(self, fmt):
+        meta = export_graphs(
+            self.model, torch.rand(2, 3, 64, 64), self.model_path,
+            formats=[fmt])
+        self.assertEqual(meta['formats'], [fmt])
+        graph_model = load_graph_model(
+            graph_uri(self.model_path, fmt), graph_meta_uri(self.model_path),
+            fmt=fmt)
+        # Other batch and chip sizes than the ones traced with.
+        for x in [torch.rand(3, 3, 64, 64), torch.rand(1, 3, 96, 128)]:
+            with torch.no_grad():
+                output = self.model(x)
+                graph_output = graph_model(x)
+            self.assertEqual(len(graph_output), len(output))
+            for o, graph_o in zip(output[:2], graph_output[:2]):
+                self.assertEqual(graph_o.shape, o.shape)
+                self.assertLess(float((graph_o - o).abs().max()), 1e-4)
+            # Feature map sizes, from which anchors are made.
+            self.assertEqual(graph_output[2], output[2])
+
+    def test_torchscript(self):
+        self.check_parity('torchscript')
+
+    @unittest.skipIf(
+        importlib.util.find_spec('onnxruntime') is None,
+        'onnxruntime is not installed')
+    def test_onnx(self):
+        self.check_parity('onnx')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+import torch
+from torch import nn
+
+from fastai_plugin.inference import (InferenceRunner, IO_BYTES_FACTOR,
+                                     activation_bytes, tensor_bytes)
+
+
+def small_model():
+    return nn.Sequential(
+        nn.Conv2d(3, 8, 3, padding=1), nn.ReLU(),
+        nn.Conv2d(8, 2, 3, padding=1)).eval()
+
+
+class TestInferenceRunner(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = small_model()
+        self.x = torch.rand(10, 3, 16, 16)
+        # The outputs of the 3 layers, each of 16x16 pixels.
+        self.chip_bytes = (8 + 8 + 2) * 16 * 16 * 4
+
+    def test_eager_budget(self):
+        self.assertEqual(activation_bytes(self.model, self.x[:1]),
+                         self.chip_bytes)
+        runner = InferenceRunner(self.model, mem_budget=3 * self.chip_bytes)
+        with torch.no_grad():
+            expected = self.model(self.x)
+            output = runner(self.x)
+        self.assertEqual(runner.batch_sz, 3)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+
+    def test_torchscript_budget(self):
+        # The leaf modules of TorchScript models can't be hooked, so the
+        # budget is applied to a multiple of the input and output sizes.
+        model = torch.jit.trace(self.model, self.x[:1])
+        self.assertIsNone(activation_bytes(model, self.x[:1]))
+        chip_bytes = IO_BYTES_FACTOR * (
+            tensor_bytes(self.x[:1]) + 2 * 16 * 16 * 4)
+        runner = InferenceRunner(model, mem_budget=2 * chip_bytes)
+        with self.assertLogs('fastai_plugin.inference', level='WARNING'):
+            with torch.no_grad():
+                expected = self.model(self.x)
+                output = runner(self.x)
+        self.assertEqual(runner.batch_sz, 2)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+
+    def test_no_modules(self):
+        # Like GraphModel, which runs exported graphs.
+        class Wrapper():
+            def __init__(self, model):
+                self.model = model
+
+            def modules(self):
+                return []
+
+            def __call__(self, x):
+                return self.model(x)
+
+        self.assertIsNone(activation_bytes(Wrapper(self.model), self.x[:1]))
+        runner = InferenceRunner(Wrapper(self.model), mem_budget=1)
+        with self.assertLogs('fastai_plugin.inference', level='WARNING'):
+            with torch.no_grad():
+                runner(self.x)
+        self.assertEqual(runner.batch_sz, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
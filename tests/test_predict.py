@@ -0,0 +1,347 @@
+from contextlib import contextmanager
+import multiprocessing
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from torch import nn
+
+import rastervision as rv
+from rastervision.core.box import Box
+from rastervision.data import (ChipClassificationLabels,
+                               ObjectDetectionLabels,
+                               SemanticSegmentationLabels)
+from rastervision.task import Task, SemanticSegmentation
+
+import fastai_plugin.chip_classification_backend as cc_backend
+import fastai_plugin.object_detection_backend as od_backend
+import fastai_plugin.semantic_segmentation_backend as ss_backend
+from fastai_plugin.chip_classification_backend_config import (
+    TrainOptions as CCTrainOptions)
+from fastai_plugin.object_detection_backend_config import (
+    TrainOptions as ODTrainOptions)
+from fastai_plugin.semantic_segmentation_backend_config import (
+    TrainOptions as SSTrainOptions)
+from fastai_plugin.pipeline import PredictPipeline, window_batches
+from fastai_plugin.parallel import predict_parallel
+from fastai_plugin.predict import install_predict_hook, predict_scenes
+from fastai_plugin.retinanet import RetinaNet
+from fastai_plugin.simple_backend_config import BackendOptions
+
+CHIP_SIZE = 32
+
+
+class ArraySource():
+    """Raster source reading chips from an array, padded with zeros."""
+
+    def __init__(self, img):
+        self.img = img
+
+    def get_extent(self):
+        return Box(0, 0, self.img.shape[0], self.img.shape[1])
+
+    def get_chip(self, window):
+        chip = np.zeros((window.get_height(), window.get_width(),
+                         self.img.shape[2]), dtype=self.img.dtype)
+        part = self.img[window.ymin:window.ymax, window.xmin:window.xmax]
+        chip[:part.shape[0], :part.shape[1]] = part
+        return chip
+
+
+class SlowSource(ArraySource):
+    def get_chip(self, window):
+        time.sleep(60)
+        return super().get_chip(window)
+
+
+class MemoryLabelStore():
+    def __init__(self, empty_labels):
+        self._empty_labels = empty_labels
+        self.labels = None
+
+    def empty_labels(self):
+        return self._empty_labels()
+
+    def save(self, labels):
+        self.labels = labels
+
+
+class MemoryScene():
+    def __init__(self, raster_source, label_store):
+        self.raster_source = raster_source
+        self.prediction_label_store = label_store
+
+    @contextmanager
+    def activate(self):
+        yield
+
+
+def make_image():
+    img = np.random.randint(1, 256, size=(80, 90, 3), dtype=np.uint8)
+    # An empty window, and NODATA pixels in others.
+    img[:40, :40] = 0
+    img[50:60, 50:] = 0
+    return img
+
+
+def make_task(task_type, backend):
+    task_config = rv.TaskConfig.builder(task_type) \
+                    .with_chip_size(CHIP_SIZE) \
+                    .with_classes(['a', 'b']) \
+                    .with_predict_batch_size(3) \
+                    .build()
+    task = task_config.create_task(backend)
+    # Pruning duplicate boxes needs the Tensorflow Object Detection API.
+    task.post_process_predictions = lambda labels, scene: labels
+    return task
+
+
+def small_retinanet():
+    encoder = nn.Sequential(*[
+        nn.Sequential(
+            nn.Conv2d(3 if i == 0 else 8, 8, 3, stride=2, padding=1),
+            nn.ReLU()) for i in range(5)
+    ])
+    return RetinaNet(encoder, 2, final_bias=0, chs=16).eval()
+
+
+def make_backend(module, backend_class, train_opts, model, tmp_dir,
+                 **backend_opts):
+    backend = backend_class(
+        None, BackendOptions(model_uri='model', **backend_opts), train_opts)
+    with mock.patch.object(module, 'load_inference_model',
+                           return_value=model), \
+            mock.patch('builtins.print'):
+        backend.load_model(tmp_dir)
+    return backend
+
+
+def cc_backend_and_task(tmp_dir, **backend_opts):
+    model = nn.Sequential(
+        nn.Conv2d(3, 4, 3, padding=1), nn.AdaptiveAvgPool2d(1), nn.Flatten(),
+        nn.Linear(4, 2)).eval()
+    backend = make_backend(cc_backend, cc_backend.ChipClassificationBackend,
+                           CCTrainOptions(), model, tmp_dir, **backend_opts)
+    return backend, make_task(rv.CHIP_CLASSIFICATION, backend)
+
+
+def ss_backend_and_task(tmp_dir, **backend_opts):
+    model = nn.Conv2d(3, 3, 1).eval()
+    backend = make_backend(ss_backend,
+                           ss_backend.SemanticSegmentationBackend,
+                           SSTrainOptions(), model, tmp_dir, **backend_opts)
+    return backend, make_task(rv.SEMANTIC_SEGMENTATION, backend)
+
+
+def od_backend_and_task(tmp_dir, **backend_opts):
+    backend = make_backend(od_backend, od_backend.ObjectDetectionBackend,
+                           ODTrainOptions(), small_retinanet(), tmp_dir,
+                           **backend_opts)
+    return backend, make_task(rv.OBJECT_DETECTION, backend)
+
+
+class TestPredict(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.raster_source = ArraySource(make_image())
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_scene(self, empty_labels):
+        return MemoryScene(self.raster_source, MemoryLabelStore(empty_labels))
+
+    def assert_cc_equal(self, labels, expected):
+        self.assertEqual(labels.get_cells(), expected.get_cells())
+        self.assertEqual(labels.get_class_ids(), expected.get_class_ids())
+        np.testing.assert_allclose(
+            labels.get_scores(), expected.get_scores(), rtol=1e-5)
+
+    def assert_od_equal(self, labels, expected):
+        np.testing.assert_allclose(labels.get_npboxes(),
+                                   expected.get_npboxes())
+        np.testing.assert_array_equal(labels.get_class_ids(),
+                                      expected.get_class_ids())
+        np.testing.assert_allclose(labels.get_scores(),
+                                   expected.get_scores(), rtol=1e-5)
+
+    def assert_ss_equal(self, labels, expected, windows):
+        # Both labels may predict when asked for label arrays, which must not
+        # happen at the same time with the same backend.
+        expected_arrs = [expected.get_label_arr(window) for window in windows]
+        # Windows are asked for once, in order, as by label stores.
+        for window, expected_arr in zip(windows, expected_arrs):
+            np.testing.assert_array_equal(
+                labels.get_label_arr(window), expected_arr)
+
+    def check_predict_batches(self, backend, assert_equal, skip_empty):
+        windows = self.raster_source.get_extent().get_windows(
+            CHIP_SIZE, CHIP_SIZE // 2)
+        batches = list(
+            window_batches(self.raster_source, windows, 3,
+                           skip_empty=skip_empty))
+        batch_labels = list(backend.predict_batches(batches, self.tmp_dir.name))
+        self.assertEqual(len(batch_labels), len(batches))
+        for labels, (chips, batch_windows) in zip(batch_labels, batches):
+            expected = backend.predict(chips, batch_windows, self.tmp_dir.name)
+            assert_equal(labels, expected)
+
+    def test_predict_batches(self):
+        backend, _ = cc_backend_and_task(self.tmp_dir.name)
+        self.check_predict_batches(backend, self.assert_cc_equal, True)
+
+        backend, _ = od_backend_and_task(self.tmp_dir.name)
+        self.check_predict_batches(backend, self.assert_od_equal, True)
+
+        backend, _ = ss_backend_and_task(self.tmp_dir.name)
+
+        def assert_ss_equal(labels, expected):
+            self.assert_ss_equal(labels, expected, expected.get_windows())
+
+        self.check_predict_batches(backend, assert_ss_equal, False)
+
+    def test_predict_scene(self):
+        # The pipelined predict_scene matches the one of Raster Vision,
+        # which calls predict for one batch at a time.
+        backend, task = cc_backend_and_task(self.tmp_dir.name)
+        scene = self.make_scene(ChipClassificationLabels)
+        labels = backend.predict_scene(task, scene, self.tmp_dir.name)
+        expected = Task.predict_scene(task, scene, self.tmp_dir.name)
+        self.assertEqual(len(expected), 8)
+        self.assert_cc_equal(labels, expected)
+
+        backend, task = od_backend_and_task(self.tmp_dir.name)
+        scene = self.make_scene(ObjectDetectionLabels.make_empty)
+        labels = backend.predict_scene(task, scene, self.tmp_dir.name)
+        expected = Task.predict_scene(task, scene, self.tmp_dir.name)
+        self.assertGreater(len(expected), 0)
+        self.assert_od_equal(labels, expected)
+
+        backend, task = ss_backend_and_task(self.tmp_dir.name)
+        scene = self.make_scene(SemanticSegmentationLabels)
+        labels = backend.predict_scene(task, scene, self.tmp_dir.name)
+        expected = SemanticSegmentation.predict_scene(task, scene,
+                                                      self.tmp_dir.name)
+        windows = expected.get_windows()
+        self.assertEqual(labels.get_windows(), windows)
+        self.assert_ss_equal(labels, expected, windows)
+        self.assertFalse(labels.label_fn.label_arrs)
+
+    def test_window_merge(self):
+        # An object seen by the 4 overlapping windows containing it.
+        self.raster_source = ArraySource(np.ones((80, 90, 3), np.uint8))
+        obj = np.array([20., 20., 30., 30.])
+
+        def window_boxes(output, windows):
+            boxes, window_ids = [], []
+            for window in windows:
+                if window.to_shapely().contains(
+                        Box(*obj).to_shapely()):
+                    # Each window sees the object a bit differently.
+                    boxes.append(obj + window.ymin / 16)
+                    window_ids.append([window.ymin, window.xmin])
+            return (np.array(boxes).reshape(-1, 4),
+                    np.ones(len(boxes), dtype=np.int32),
+                    np.linspace(0.9, 0.6, len(boxes)),
+                    np.array(window_ids).reshape(-1, 2))
+
+        def predict_scene(**backend_opts):
+            backend, task = od_backend_and_task(self.tmp_dir.name,
+                                                **backend_opts)
+            backend.pipeline = PredictPipeline(lambda x: x, lambda x: x,
+                                               window_boxes)
+            scene = self.make_scene(ObjectDetectionLabels.make_empty)
+            return backend.predict_scene(task, scene, self.tmp_dir.name)
+
+        self.assertEqual(len(predict_scene()), 4)
+        labels = predict_scene(window_merge_thresh=0.5)
+        self.assertEqual(len(labels), 1)
+        np.testing.assert_allclose(labels.get_npboxes(), [obj])
+        np.testing.assert_allclose(labels.get_scores(), [0.9])
+
+    def check_predict_workers(self, backend, task, empty_labels,
+                              assert_equal):
+        sources = [self.raster_source, ArraySource(make_image())]
+
+        def make_scenes():
+            return [
+                MemoryScene(raster_source, MemoryLabelStore(empty_labels))
+                for raster_source in sources
+            ]
+
+        expected = [
+            backend.predict_scene(task, scene, self.tmp_dir.name)
+            for scene in make_scenes()
+        ]
+
+        # With 3 workers, each of the 2 scenes is split into 2 jobs.
+        backend.backend_opts.predict_workers = 3
+        scenes = make_scenes()
+        predict_scenes(task, scenes, self.tmp_dir.name)
+        for scene, scene_expected in zip(scenes, expected):
+            assert_equal(scene.prediction_label_store.labels, scene_expected)
+
+    def test_predict_workers(self):
+        backend, task = cc_backend_and_task(self.tmp_dir.name)
+        self.check_predict_workers(backend, task, ChipClassificationLabels,
+                                   self.assert_cc_equal)
+
+        # Duplicates are merged across jobs.
+        backend, task = od_backend_and_task(self.tmp_dir.name,
+                                            window_merge_thresh=0.5)
+        self.check_predict_workers(backend, task,
+                                   ObjectDetectionLabels.make_empty,
+                                   self.assert_od_equal)
+
+        backend, task = ss_backend_and_task(self.tmp_dir.name)
+
+        def assert_ss_equal(labels, expected):
+            self.assert_ss_equal(labels, expected, expected.get_windows())
+
+        self.check_predict_workers(backend, task, SemanticSegmentationLabels,
+                                   assert_ss_equal)
+
+    def test_predict_parallel_start_error(self):
+        backend, _ = cc_backend_and_task(self.tmp_dir.name)
+        ctx = multiprocessing.get_context('fork')
+        windows = self.raster_source.get_extent().get_windows(
+            CHIP_SIZE, CHIP_SIZE)
+        jobs = [(SlowSource(make_image()), windows)]
+        started = []
+
+        def start_once(*args, **kwargs):
+            if started:
+                raise OSError('Cannot fork.')
+            started.append(multiprocessing.context.ForkProcess(
+                *args, **kwargs))
+            return started[0]
+
+        with mock.patch.object(ctx, 'Process', side_effect=start_once):
+            with self.assertRaises(OSError):
+                predict_parallel(backend, jobs, self.tmp_dir.name, 3,
+                                 nb_workers=2)
+        # The worker which was started is stopped.
+        started[0].join(timeout=10)
+        self.assertFalse(started[0].is_alive())
+
+    def test_predict_hook(self):
+        install_predict_hook()
+        backend, task = cc_backend_and_task(self.tmp_dir.name)
+        scene = self.make_scene(ChipClassificationLabels)
+        with mock.patch.object(
+                backend, 'predict_scene',
+                wraps=backend.predict_scene) as predict_scene:
+            task.predict([scene], self.tmp_dir.name)
+        predict_scene.assert_called_once_with(task, scene, self.tmp_dir.name)
+        self.assert_cc_equal(
+            scene.prediction_label_store.labels,
+            Task.predict_scene(task, scene, self.tmp_dir.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
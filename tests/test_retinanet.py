@@ -0,0 +1,171 @@
+import unittest
+from unittest import mock
+
+import torch
+
+import fastai_plugin.retinanet as retinanet
+from fastai_plugin.retinanet import (
+    DetectionAPEvaluator, IoU_values, IoU_max, MeanAveragePrecision,
+    create_anchors, match_anchors, match_predictions, tlbr2cthw)
+
+
+def chunk_budget(anchors, chunk):
+    """Return the memory budget for which targets are processed in chunks."""
+    return 4 * anchors.element_size() * anchors.size(0) * chunk
+
+
+class TestIoU(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        anchors = create_anchors([(4, 4), (2, 2)], retinanet.ratios,
+                                 retinanet.scales)
+        # An anchor which overlaps no target.
+        self.anchors = torch.cat(
+            [anchors, torch.tensor([[-5.5, -5.5, 1., 1.]])])
+        corners = torch.rand(10, 2, 2) * 2 - 1
+        targets = tlbr2cthw(
+            torch.cat([corners.min(1)[0], corners.max(1)[0]], 1))
+        # Duplicates of an anchor in different chunks, and a box which no
+        # anchor overlaps.
+        targets[2] = self.anchors[5]
+        targets[7] = targets[2]
+        targets[8] = targets[2]
+        targets[9] = torch.tensor([5.5, 5.5, 1., 1.])
+        self.targets = targets
+        self.big_budget = chunk_budget(self.anchors, len(self.targets))
+
+    def test_values(self):
+        expected = IoU_values(self.anchors, self.targets, self.big_budget)
+        for chunk in [1, 3, 4]:
+            ious = IoU_values(self.anchors, self.targets,
+                              chunk_budget(self.anchors, chunk))
+            self.assertTrue(torch.equal(ious, expected))
+        self.assertTrue(torch.equal(expected[:, 7], expected[:, 2]))
+        self.assertEqual(float(expected[:, 9].max()), 0)
+
+    def test_max(self):
+        vals, idxs = IoU_values(self.anchors, self.targets,
+                                self.big_budget).max(1)
+        # Ties go to the first target: the first duplicate, or target 0 for
+        # anchors overlapping no target.
+        self.assertFalse(((idxs == 7) | (idxs == 8) | (idxs == 9)).any())
+        self.assertTrue((idxs == 2).any())
+        self.assertEqual(float(vals[-1]), 0)
+        self.assertEqual(int(idxs[-1]), 0)
+        for chunk in [1, 3, 4, len(self.targets)]:
+            c_vals, c_idxs = IoU_max(self.anchors, self.targets,
+                                     chunk_budget(self.anchors, chunk))
+            self.assertTrue(torch.equal(c_vals, vals))
+            self.assertTrue(torch.equal(c_idxs, idxs))
+
+    def test_empty_targets(self):
+        targets = self.targets[:0]
+        for chunk in [1, 3]:
+            ious = IoU_values(self.anchors, targets,
+                              chunk_budget(self.anchors, chunk))
+            self.assertEqual(ious.shape, (len(self.anchors), 0))
+            with mock.patch.object(retinanet, 'iou_mem_budget',
+                                   chunk_budget(self.anchors, chunk)):
+                matches = match_anchors(self.anchors, targets)
+            self.assertTrue((matches == -2).all())
+
+    def test_match_anchors(self):
+        expected = match_anchors(self.anchors, self.targets)
+        self.assertTrue((expected >= 0).any())
+        self.assertTrue((expected == -1).any())
+        for chunk in [1, 3]:
+            with mock.patch.object(retinanet, 'iou_mem_budget',
+                                   chunk_budget(self.anchors, chunk)):
+                matches = match_anchors(self.anchors, self.targets)
+            self.assertTrue(torch.equal(matches, expected))
+
+
+class TestMatchPredictions(unittest.TestCase):
+    def setUp(self):
+        # Two objects, of class 0 and 1.
+        self.tgt_bbox = tlbr2cthw(torch.tensor([[-1., -1., 0., 0.],
+                                                [0., 0., 1., 1.]]))
+        self.tgt_clas = torch.tensor([0, 1])
+
+    def test_perfect(self):
+        tps = match_predictions(self.tgt_bbox, torch.tensor([0, 1]),
+                                torch.tensor([0.9, 0.8]), self.tgt_bbox,
+                                self.tgt_clas)
+        self.assertEqual(tps.tolist(), [1, 1])
+
+    def test_duplicate(self):
+        # Only the highest scoring detection of an object is a true positive.
+        bbox_pred = self.tgt_bbox[[0, 0, 0]]
+        tps = match_predictions(bbox_pred, torch.tensor([0, 0, 0]),
+                                torch.tensor([0.5, 0.9, 0.7]), self.tgt_bbox,
+                                self.tgt_clas)
+        self.assertEqual(tps.tolist(), [0, 1, 0])
+
+    def test_wrong_class(self):
+        tps = match_predictions(self.tgt_bbox, torch.tensor([1, 0]),
+                                torch.tensor([0.9, 0.8]), self.tgt_bbox,
+                                self.tgt_clas)
+        self.assertEqual(tps.tolist(), [0, 0])
+
+    def test_no_targets(self):
+        tps = match_predictions(self.tgt_bbox, torch.tensor([0, 1]),
+                                torch.tensor([0.9, 0.8]), self.tgt_bbox[:0],
+                                self.tgt_clas[:0])
+        self.assertEqual(tps.tolist(), [0, 0])
+
+
+class TestMeanAveragePrecision(unittest.TestCase):
+    def setUp(self):
+        boxes = torch.tensor([[-1., -1., 0., 0.], [0., 0., 1., 1.]])
+        self.boxes = tlbr2cthw(boxes)
+        # Padded targets of a batch of two images, the first with an object
+        # of class 0 and one of class 1, the second without objects.
+        self.target = (torch.stack([boxes, torch.zeros(2, 4)]),
+                       torch.tensor([[1, 2], [0, 0]]))
+
+    def predictions(self, image_preds):
+        """Patch get_predictions to return image_preds for each image."""
+        def get_predictions(output, idx, *args):
+            return image_preds[idx]
+        return mock.patch.object(retinanet, 'get_predictions',
+                                 get_predictions)
+
+    def test_perfect(self):
+        evaluator = DetectionAPEvaluator(2)
+        with self.predictions([
+                (self.boxes, torch.tensor([0, 1]), torch.tensor([0.9, 0.8])),
+                ([], [], [])]):
+            evaluator.update(None, self.target)
+        aps = evaluator.class_aps()
+        self.assertAlmostEqual(aps[0], 1)
+        self.assertAlmostEqual(aps[1], 1)
+
+    def test_false_positives(self):
+        # Class 0: a false positive in the image without objects (0.95), the
+        # true positive (0.9) and a duplicate (0.8). The precision is 1/2 at
+        # the only recall of 1, so the AP is 1/2. Class 1 is never predicted.
+        evaluator = DetectionAPEvaluator(2)
+        with self.predictions([
+                (self.boxes[[0, 0]], torch.tensor([0, 0]),
+                 torch.tensor([0.9, 0.8])),
+                (self.boxes[[1]], torch.tensor([0]), torch.tensor([0.95]))]):
+            evaluator.update(None, self.target)
+        self.assertEqual(evaluator.n_gts.tolist(), [1, 1])
+        aps = evaluator.class_aps()
+        self.assertAlmostEqual(aps[0], 0.5)
+        self.assertEqual(aps[1], 0)
+
+        metric = MeanAveragePrecision(2)
+        metric.on_epoch_begin()
+        with self.predictions([
+                (self.boxes[[0, 0]], torch.tensor([0, 0]),
+                 torch.tensor([0.9, 0.8])),
+                (self.boxes[[1]], torch.tensor([0]), torch.tensor([0.95]))]):
+            metric.on_batch_end(None, self.target)
+        last_metrics = metric.on_epoch_end([1.])['last_metrics']
+        self.assertEqual(len(last_metrics), 2)
+        self.assertAlmostEqual(last_metrics[1], 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+import torch
+from torch import nn
+from torch.utils.data import TensorDataset
+
+from fastai.basic_data import DataBunch
+from fastai.basic_train import Learner, LearnerCallback
+from fastai.metrics import accuracy
+
+from fastai_plugin.utils import ValidationCallback
+
+
+class ValidateFullCallback(LearnerCallback):
+    """Validates on the full set after each epoch, like ExportCallback."""
+
+    def __init__(self, learn):
+        super().__init__(learn)
+        self.nb_train_begin = 0
+        self.values = []
+
+    def on_train_begin(self, **kwargs):
+        self.nb_train_begin += 1
+
+    def on_epoch_end(self, **kwargs):
+        self.values.append(self.learn.validation_callback.validate_full())
+
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        x = torch.randn(32, 4)
+        y = (x[:, 0] > 0).long()
+        data = DataBunch.create(
+            TensorDataset(x[:16], y[:16]), TensorDataset(x[16:], y[16:]),
+            bs=4, num_workers=0)
+        self.learn = Learner(data, nn.Linear(4, 2),
+                             loss_func=nn.CrossEntropyLoss(),
+                             metrics=[accuracy])
+
+    def test_validate_full(self):
+        learn = self.learn
+        ValidationCallback(learn, subset_indices=[0, 1])
+        cb = ValidateFullCallback(learn)
+        learn.callbacks += [learn.validation_callback, cb]
+        learn.fit(2)
+
+        # The callbacks of the learner are not started again.
+        self.assertEqual(cb.nb_train_begin, 1)
+        self.assertEqual(len(cb.values), 2)
+        self.assertEqual(list(cb.values[-1]), ['valid_loss', 'accuracy'])
+
+        values = cb.values[-1]
+        expected = learn.validate(learn.validation_callback.full_dl)
+        self.assertAlmostEqual(values['valid_loss'], float(expected[0]),
+                               places=5)
+        self.assertAlmostEqual(float(values['accuracy']), float(expected[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()